@@ -0,0 +1,128 @@
+## assistant.py - answers of the LLM assistant (/assistant messages)
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+from project_three.metrics import registry
+
+if TYPE_CHECKING:
+    from openai import OpenAI
+
+AI_PROMPT = "Please answer as if you were whole-heartedly believing into all conspiracy theories that have ever been invented. E.g. you" \
+            " should be 100% certain that the earth is flat, lizard people live among us, the moon landing was fake, and so on. Insult any person claiming something else. " \
+            "Keep your answer short and it should not sound too intelligent. " \
+            "Also answer as if you were personally offended by whatever is said to you."
+
+ANSWER_SECONDS = registry.histogram('assistant_answer_seconds', "Time the LLM needed for an answer")
+QUEUE_SECONDS = registry.histogram('assistant_queue_seconds', "Time a request waited for a free assistant slot")
+
+FALLBACK_REPLY = "The assistant is busy uncovering the truth right now. Ask again later!"
+
+
+class Assistant(object):
+    """
+    Generates the answers of the assistant. At most max_concurrent answers are generated at the same time, further
+    requests wait in a queue of at most max_queue entries. Requests that can't be answered in time (full queue, waited
+    longer than queue_timeout, LLM slower than timeout or failing) get the fallback reply instead.
+    """
+
+    def __init__(self, client: 'OpenAI', model: str, prompt: str = AI_PROMPT, max_concurrent: int = 2,
+                 max_queue: int = 20, queue_timeout: float = 10, timeout: float = 30, fallback: str = FALLBACK_REPLY):
+        """
+        :param client: the OpenAI client (use OPENAI_BASE_URL to talk to another OpenAI-compatible server)
+        :param model: the model that generates the answers
+        :param prompt: instructions that are put in front of the user message
+        :param max_concurrent: maximum number of answers generated at the same time
+        :param max_queue: maximum number of requests waiting for a free slot
+        :param queue_timeout: maximum number of seconds a request waits for a free slot
+        :param timeout: maximum number of seconds to generate one answer
+        :param fallback: reply used if no answer could be generated
+        """
+        self.client = client
+        self.model = model
+        self.prompt = prompt
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.timeout = timeout
+        self.fallback = fallback
+        self.metrics = {'answered': 0, 'fallbacks': 0, 'queued': 0}
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix='assistant')
+        self._lock = threading.Lock()
+
+    def answer(self, message: str) -> str:
+        """
+        Generates the complete answer to a message (blocking).
+        :param message: the user message
+        :return: the answer or the fallback reply
+        """
+        return self.submit(message).result()
+
+    def submit(self, message: str, on_text=None):
+        """
+        Queues a message for an answer.
+        :param message: the user message
+        :param on_text: optional function that is called with the answer so far whenever new text was generated
+        :return: future of the complete answer (always a string, the fallback reply if something went wrong)
+        """
+        with self._lock:
+            if self.metrics['queued'] >= self.max_queue:
+                self.metrics['fallbacks'] += 1
+                return _done(self.fallback)
+            self.metrics['queued'] += 1
+        return self._executor.submit(self._generate, message, on_text, time.monotonic())
+
+    def _generate(self, message: str, on_text, queued_at: float) -> str:
+        with self._lock:
+            self.metrics['queued'] -= 1
+        QUEUE_SECONDS.observe(time.monotonic() - queued_at)
+        if time.monotonic() - queued_at > self.queue_timeout:
+            return self._fail("")
+        text = ""
+        deadline = time.monotonic() + self.timeout
+        start = time.perf_counter()
+        try:
+            if on_text is None:
+                response = self.client.chat.completions.create(
+                    model=self.model, messages=[{"role": "user", "content": self.prompt + message}],
+                    timeout=self.timeout)
+                text = response.choices[0].message.content
+            else:
+                stream = self.client.chat.completions.create(
+                    model=self.model, messages=[{"role": "user", "content": self.prompt + message}],
+                    timeout=self.timeout, stream=True)
+                for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        text += chunk.choices[0].delta.content
+                        on_text(text)
+                    if time.monotonic() > deadline:
+                        stream.close()
+                        return self._fail(text)
+        except Exception as e:
+            print(f"Assistant failed: {e}")
+            return self._fail(text)
+        ANSWER_SECONDS.observe(time.perf_counter() - start, streaming=on_text is not None)
+        with self._lock:
+            self.metrics['answered'] += 1
+        return text
+
+    def _fail(self, text: str) -> str:
+        with self._lock:
+            self.metrics['fallbacks'] += 1
+        # keep what was generated so far, readers have seen it already
+        return (text + " ... " + self.fallback) if text else self.fallback
+
+    def stats(self) -> dict:
+        """
+        :return: number of answered requests, fallback replies and requests waiting in the queue
+        """
+        with self._lock:
+            return dict(self.metrics)
+
+
+def _done(result):
+    from concurrent.futures import Future
+    future = Future()
+    future.set_result(result)
+    return future
@@ -0,0 +1,674 @@
+## benchmark.py - load tests for the channel, the hub and the client
+# run: python benchmark.py --history 1000 100000 1000000 --concurrency 16 --duration 10 --output results.json
+# compare two runs: python benchmark.py --compare before.json after.json
+# memory of a channel worker serving the full history: python benchmark.py --memory --history 1000000
+# import time of the apps (fails if the channel takes longer than the budget): python benchmark.py --startup-budget 0.5
+# timestamp parsing and formatting compared with the old dateutil path: python benchmark.py --timestamps
+# Everything runs locally: the channel, the hub and the client are started as separate processes (Flask development
+# server, threaded), the OpenAI API, the profanity list and the channels checked by the hub are faked by
+# stub_server.py with configurable latency. No API key or network access is needed.
+
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import requests
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+CHANNEL_AUTHKEY = 'benchmark'
+HUB_AUTHKEY = '1234567890'  # SERVER_AUTHKEY of hub.py
+SEED_BATCH = 10000  # messages inserted per transaction when the history is seeded
+STARTUP_APPS = ('project_three.channel', 'project_three.hub', 'project_three.client')
+# modules only some requests of the channel need, importing the channel must not import them
+LAZY_MODULES = ('openai', 'requests', 'dateutil', 'dotenv')
+# run in a bare interpreter (this file imports requests itself): prints the import time and the lazy modules imported
+MEASURE_STARTUP = '''
+import importlib, json, sys, time
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+print(json.dumps({'seconds': round(time.perf_counter() - start, 4),
+                  'lazy_imported': [name for name in sys.argv[2:] if name in sys.modules]}))
+'''
+# POST / visible: seconds a posted message may take until GET / returns it, seconds between the polls
+VISIBLE_TIMEOUT = 30
+VISIBLE_POLL = 0.02
+TIMESTAMP_SAMPLES = 100000  # timestamps per measurement of --timestamps
+SAMPLE_CONTENTS = ["The moon landing was fake, they filmed it in a studio",
+                   "Birds aren't real, they are government drones",
+                   "Chemtrails are everywhere today, look at the sky",
+                   "Lizard people run the banks, wake up",
+                   "Hi everyone, how are you doing?",
+                   "The earth is flat and nasa knows it",
+                   ]
+# common and rare words, alone and together with a sender (the seeded senders are user0 to user99)
+SEARCH_QUERIES = [{'q': 'moon'}, {'q': 'government drones'}, {'q': 'moon', 'sender': 'user7'}, {'sender': 'user42'},
+                  {'q': 'nothing matches this'}]
+
+
+def python_path(workdir: str) -> str:
+    """
+    The modules import each other as project_three.<module>, so the directory containing project_three has to be on
+    the path. If the repository is checked out under another name, a link named project_three is created in workdir.
+    :param workdir: temporary directory of the benchmark
+    :return: directory to put on PYTHONPATH
+    """
+    if os.path.basename(PACKAGE_DIR) == 'project_three':
+        return os.path.dirname(PACKAGE_DIR)
+    os.symlink(PACKAGE_DIR, os.path.join(workdir, 'project_three'))
+    return workdir
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: list, p: float) -> float:
+    """
+    :param values: sorted list of values
+    :param p: percentile between 0 and 100
+    :return: the value below which p percent of the values lie (nearest rank)
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))]
+
+
+def summarize(samples: list, elapsed: float) -> dict:
+    """
+    Latency, throughput and size are computed from the successful requests only (a fast error would make them look
+    better), the failed ones are counted in errors and error_rate.
+    :param samples: list of (seconds, bytes, ok) of all requests
+    :param elapsed: wall clock seconds of the whole run
+    :return: latency percentiles in ms, successful requests per second, bytes per request and the error rate
+    """
+    succeeded = [sample for sample in samples if sample[2]]
+    latencies = sorted(sample[0] * 1000 for sample in succeeded)
+    count = len(samples)
+    ok = len(succeeded)
+    return {'requests': count,
+            'errors': count - ok,
+            'error_rate': round((count - ok) / count, 4) if count else None,
+            'rps': round(ok / elapsed, 2) if elapsed else None,
+            'p50_ms': _round(percentile(latencies, 50)),
+            'p95_ms': _round(percentile(latencies, 95)),
+            'p99_ms': _round(percentile(latencies, 99)),
+            'mean_ms': _round(sum(latencies) / ok) if ok else None,
+            'max_ms': _round(latencies[-1]) if ok else None,
+            'bytes_per_request': round(sum(sample[1] for sample in succeeded) / ok) if ok else None,
+            }
+
+
+def _round(value):
+    return round(value, 2) if value is not None else None
+
+
+class Service(object):
+    """
+    One of the apps (or the stub server) running in its own process.
+    """
+
+    def __init__(self, module: str, env: dict, workdir: str):
+        """
+        :param module: module that has the Flask app, e.g. project_three.channel
+        :param env: environment of the process
+        :param workdir: working directory of the process (relative files like messages.sqlite end up there)
+        """
+        self.module = module
+        self.port = free_port()
+        self.url = 'http://127.0.0.1:%d' % self.port
+        self.log = open(os.path.join(workdir, module.split('.')[-1] + '.log'), 'a')
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', module,
+                                         '--port', str(self.port)],
+                                        cwd=workdir, env=env, stdout=self.log, stderr=subprocess.STDOUT)
+
+    def wait_ready(self, path: str = '/', timeout: float = 60) -> None:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("%s exited, see %s" % (self.module, self.log.name))
+            try:
+                requests.get(self.url + path, timeout=1)
+                return
+            except requests.exceptions.RequestException:
+                time.sleep(0.1)
+        raise RuntimeError("%s did not start within %ds" % (self.module, timeout))
+
+    def stop(self) -> None:
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.log.close()
+
+
+def serve(module: str, port: int) -> None:
+    """
+    Runs the Flask app of a module (entry point of the service processes).
+    """
+    import importlib
+    app = importlib.import_module(module).app
+    app.run(host='127.0.0.1', port=port, threaded=True, use_reloader=False)
+
+
+def time_check_channels(runs: int) -> None:
+    """
+    Runs check_channels of the hub a few times and prints the durations in seconds as json
+    (entry point of the process started by bench_check_channels, the hub database is given by the environment).
+    """
+    from project_three import hub
+    runner = hub.app.test_cli_runner()  # captures the output of the command
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = runner.invoke(hub.check_channels)
+        durations.append(time.perf_counter() - start)
+        if result.exception:
+            raise result.exception
+    print(json.dumps(durations))
+
+
+def rss_mb(field: str = 'VmRSS') -> float:
+    """
+    :param field: line of /proc/self/status, e.g. RssAnon for the memory that is not backed by (shared) files
+    :return: current resident memory of this process in MB (peak resident memory where /proc is not available)
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure_memory(rebuilds: int) -> None:
+    """
+    Serves the full message list of the channel given by the environment rebuilds times (with a new message before
+    every request, so the list has to be rebuilt each time) and prints resident memory and garbage collector work as
+    json (entry point of the process started by bench_memory).
+    """
+    import gc
+    import resource
+    pauses = []
+    started = [0.0]
+
+    def on_gc(phase, info):
+        if phase == 'start':
+            started[0] = time.perf_counter()
+        else:
+            pauses.append(time.perf_counter() - started[0])
+
+    from project_three import channel
+    hosted = channel.channels['channel']
+    client = channel.app.test_client()
+    headers = {'Authorization': 'authkey ' + CHANNEL_AUTHKEY}
+    gc.collect()
+    rss_before = rss_mb()
+    gc.callbacks.append(on_gc)
+    start = time.perf_counter()
+    size = 0
+    for i in range(rebuilds):
+        hosted.store.append(dict(new_message(i), extra=None))
+        response = client.get('/', headers=headers, buffered=False)
+        size = sum(len(chunk) for chunk in response.response)
+        response.close()
+    elapsed = time.perf_counter() - start
+    gc.callbacks.remove(on_gc)
+    print(json.dumps({'rss_before_mb': round(rss_before, 1),
+                      'rss_after_mb': round(rss_mb(), 1),
+                      'anon_rss_after_mb': round(rss_mb('RssAnon'), 1),
+                      'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                      'gc_collections': len(pauses),
+                      'gc_pause_ms': round(sum(pauses) * 1000, 1),
+                      'gc_tracked_objects': len(gc.get_objects()),
+                      'seconds_per_rebuild': round(elapsed / rebuilds, 3),
+                      'response_bytes': size,
+                      }))
+
+
+def bench_startup(args, env: dict, workdir: str) -> dict:
+    """
+    Imports every app startup_runs times, each time in a new process (like a respawned worker).
+    :return: median and maximum import time and the lazy modules that were imported per app
+    """
+    rundir = os.path.join(workdir, 'startup')
+    os.makedirs(rundir)
+    app_env = dict(env, channel_key=CHANNEL_AUTHKEY, hub_database='sqlite:///' + os.path.join(rundir, 'hub.sqlite'),
+                   classification_cache='')
+    result = {}
+    for module in STARTUP_APPS:
+        runs = []
+        for _ in range(args.startup_runs):
+            output = subprocess.run([sys.executable, '-c', MEASURE_STARTUP, module, *LAZY_MODULES],
+                                    cwd=rundir, env=app_env, capture_output=True, text=True, check=True).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+        seconds = sorted(run['seconds'] for run in runs)
+        result[module] = {'median_s': seconds[len(seconds) // 2], 'max_s': seconds[-1],
+                          'lazy_imported': runs[-1]['lazy_imported']}
+        print("%-24s median %.3fs  max %.3fs  lazy modules imported: %s"
+              % (module, seconds[len(seconds) // 2], seconds[-1], ', '.join(runs[-1]['lazy_imported']) or '-'))
+    return result
+
+
+def legacy_timestamp(timestamp: str) -> int:
+    """
+    The timestamp path before timestamps.py: parsed with dateutil and written back as string when a message was posted,
+    that string parsed again with datetime.fromisoformat for the ts column (and formerly on every retention pass).
+    :return: microseconds since the epoch
+    """
+    from dateutil import parser
+    try:
+        if timestamp.endswith("Z"):
+            timestamp = timestamp[:-1] + "+00:00"
+        timestamp = parser.isoparse(timestamp).isoformat().replace("+00:00", "Z")
+    except Exception:
+        return 0
+    dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    return (dt.astimezone(timezone.utc) - datetime(1970, 1, 1, tzinfo=timezone.utc)) // timedelta(microseconds=1)
+
+
+def bench_timestamps(count: int) -> dict:
+    """
+    Parses posted timestamps and filters a range of stored ones with the old path (dateutil and datetime) and with
+    timestamps.py (integers only).
+    :param count: number of timestamps
+    :return: nanoseconds per timestamp for both paths and the speedup, per step
+    """
+    from project_three.timestamps import format_timestamp, parse_timestamp
+    rng = random.Random(1)
+    now = datetime.now(timezone.utc)
+    samples = []
+    for i in range(count):
+        dt = now - timedelta(microseconds=rng.randrange(10 ** 12))
+        # the formats clients send: UTC with Z, an offset, and local time without timezone (client.py)
+        samples.append((dt.isoformat().replace('+00:00', 'Z'), dt.astimezone(timezone(timedelta(hours=2))).isoformat(),
+                        dt.astimezone().replace(tzinfo=None).isoformat())[i % 3])
+    low, high = sorted(legacy_timestamp(timestamp) for timestamp in samples[:2])
+
+    def new_ingest():
+        return [format_timestamp(parse_timestamp(timestamp)) for timestamp in samples]
+
+    stored = [parse_timestamp(timestamp) for timestamp in samples]
+    steps = {'ingest': (lambda: [legacy_timestamp(timestamp) for timestamp in samples], new_ingest),
+             # range queries and retention: the old code compared parsed strings, now the stored integers are compared
+             'range': (lambda: [timestamp for timestamp in samples if low <= legacy_timestamp(timestamp) <= high],
+                       lambda: [timestamp for timestamp in stored if low <= timestamp <= high])}
+    result = {}
+    for step, (old, new) in steps.items():
+        durations = []
+        for run in (old, new):
+            start = time.perf_counter()
+            run()
+            durations.append((time.perf_counter() - start) * 1e9 / count)
+        result[step] = {'old_ns': round(durations[0]), 'new_ns': round(durations[1]),
+                        'speedup': round(durations[0] / durations[1], 1)}
+        print("%-7s %6d ns -> %5d ns per timestamp (%.1fx)" % (step, durations[0], durations[1],
+                                                               durations[0] / durations[1]))
+    return result
+
+
+def check_startup_budget(startup: dict, budget: float) -> bool:
+    """
+    :return: True if the channel imports within budget seconds (median) without importing the lazy modules
+    """
+    channel = startup['project_three.channel']
+    if channel['median_s'] > budget:
+        print("Startup budget exceeded: the channel took %.3fs (budget %.3fs)" % (channel['median_s'], budget))
+        return False
+    if channel['lazy_imported']:
+        print("Importing the channel imports %s, these have to be imported on first use"
+              % ', '.join(channel['lazy_imported']))
+        return False
+    return True
+
+
+def bench_memory(history: int, args, env: dict, workdir: str) -> dict:
+    """
+    Measures the memory of a channel worker (own process) serving a history of history messages.
+    :return: the measurements (see measure_memory)
+    """
+    rundir = os.path.join(workdir, 'memory-%d' % history)
+    os.makedirs(rundir)
+    store_url = 'sqlite:///' + os.path.join(rundir, 'messages.sqlite')
+    result = {'history': history, 'seed_seconds': round(seed_history(store_url, history), 2)}
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--measure-memory', str(args.rebuilds)],
+                            cwd=rundir, env=dict(env, channel_key=CHANNEL_AUTHKEY, channel_store=store_url,
+                                                 OPENAI_API_KEY='stub', classification_cache=''),
+                            capture_output=True, text=True, check=True).stdout
+    result['memory'] = json.loads(output.strip().splitlines()[-1])
+    print("history %d: %s" % (history, "  ".join("%s %s" % item for item in result['memory'].items())))
+    return result
+
+
+def seed_history(store_url: str, count: int) -> float:
+    """
+    Fills the message store of the channel with count messages of the last hour (directly, not through the channel).
+    :return: seconds it took
+    """
+    from project_three.message_store import open_store
+    store = open_store(store_url)
+    start = time.perf_counter()
+    now = datetime.now()
+    for offset in range(0, count, SEED_BATCH):
+        batch = []
+        for i in range(offset, min(offset + SEED_BATCH, count)):
+            timestamp = now - timedelta(seconds=3600 * (count - i) / count)
+            batch.append({'content': "%s (%d)" % (SAMPLE_CONTENTS[i % len(SAMPLE_CONTENTS)], i),
+                          'sender': 'user%d' % (i % 100),
+                          'timestamp': timestamp.isoformat(),
+                          'extra': None,
+                          })
+        store.append_many(batch)
+    return time.perf_counter() - start
+
+
+def run_load(request_fn, concurrency: int, duration: float, max_requests: int = None) -> dict:
+    """
+    Sends requests from concurrency threads (one keep-alive session each) for duration seconds.
+    :param request_fn: function(session, i) -> response sending the i-th request of a thread
+    :param concurrency: number of threads
+    :param duration: seconds to send requests
+    :param max_requests: optional maximum number of requests per thread
+    :return: summary of the run (see summarize)
+    """
+    samples = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker():
+        session = requests.Session()
+        own = []
+        i = 0
+        while time.monotonic() < deadline and (max_requests is None or i < max_requests):
+            start = time.perf_counter()
+            try:
+                response = request_fn(session, i)
+                own.append((time.perf_counter() - start, len(response.content), response.status_code < 400))
+            except requests.exceptions.RequestException:
+                own.append((time.perf_counter() - start, 0, False))
+            i += 1
+        with lock:
+            samples.extend(own)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(samples, time.perf_counter() - start)
+
+
+def new_message(i: int) -> dict:
+    return {'content': random.choice(SAMPLE_CONTENTS),
+            'sender': 'bench%d' % (i % 10),
+            'timestamp': datetime.now().isoformat(),
+            }
+
+
+def post_until_visible(session: requests.Session, url: str, headers: dict, i: int) -> requests.Response:
+    """
+    Posts a message and polls GET / until it is visible, i.e. until it has passed the moderation and is stored.
+    :return: the response of the GET that contained the message
+    :raise requests.exceptions.RequestException: if the post fails or the message isn't visible within VISIBLE_TIMEOUT
+    """
+    message = new_message(i)
+    message['content'] += " [%s]" % os.urandom(6).hex()
+    response = session.post(url + '/', headers=headers, json=message, timeout=120)
+    if response.status_code != 202:
+        raise requests.exceptions.HTTPError("POST / returned %d" % response.status_code)
+    # the first poll starts at the timestamp of the message, the following ones continue at the returned cursor
+    cursor = message['timestamp']
+    deadline = time.monotonic() + VISIBLE_TIMEOUT
+    while time.monotonic() < deadline:
+        response = session.get(url + '/', headers=headers, params={'since': cursor, 'limit': 1000}, timeout=120)
+        response.raise_for_status()
+        page = response.json()
+        if any(visible['content'] == message['content'] for visible in page['messages']):
+            return response
+        cursor = page['next_cursor']
+        time.sleep(VISIBLE_POLL)
+    raise requests.exceptions.Timeout("Message not visible after %d seconds" % VISIBLE_TIMEOUT)
+
+
+def bench_history(history: int, args, env: dict, workdir: str) -> dict:
+    """
+    Starts all services with a channel that has history messages and runs all scenarios against them.
+    :return: results of all scenarios
+    """
+    rundir = os.path.join(workdir, 'history-%d' % history)
+    os.makedirs(rundir)
+    store_url = 'sqlite:///' + os.path.join(rundir, 'messages.sqlite')
+    result = {'history': history, 'seed_seconds': round(seed_history(store_url, history), 2), 'scenarios': {}}
+    print("history %d: seeded in %.1fs" % (history, result['seed_seconds']))
+
+    stub = Service('project_three.stub_server', dict(env, stub_latency=str(args.llm_latency),
+                                                     stub_token_delay=str(args.token_delay),
+                                                     stub_health_latency=str(args.health_latency)), rundir)
+    services = [stub]
+    try:
+        stub.wait_ready('/profanity.txt')
+        channel = Service('project_three.channel', dict(env, channel_key=CHANNEL_AUTHKEY, channel_store=store_url,
+                                                        OPENAI_API_KEY='stub', OPENAI_BASE_URL=stub.url + '/v1',
+                                                        profanity_url=stub.url + '/profanity.txt',
+                                                        classification_cache=os.path.join(rundir, 'classifications.sqlite'),
+                                                        # the load tests post far more than a real sender may
+                                                        rate_limit_posts='', rate_limit_assistant=''),
+                          rundir)
+        services.append(channel)
+        hub_env = dict(env, hub_database='sqlite:///' + os.path.join(rundir, 'hub.sqlite'))
+        hub = Service('project_three.hub', hub_env, rundir)
+        services.append(hub)
+        channel.wait_ready('/health')
+        hub.wait_ready('/')
+        register_channels(hub, channel, stub, args.channels)
+        # the client caches the channel list, so it is only started once all channels are registered
+        client = Service('project_three.client', dict(env, hub_url=hub.url), rundir)
+        services.append(client)
+        client.wait_ready('/')
+
+        channel_headers = {'Authorization': 'authkey ' + CHANNEL_AUTHKEY}
+        hub_headers = {'Authorization': 'authkey ' + HUB_AUTHKEY}
+        scenarios = {
+            'GET /': lambda session, i: session.get(channel.url + '/', headers=channel_headers, timeout=120),
+            'GET /?limit=100': lambda session, i: session.get(channel.url + '/?limit=100', headers=channel_headers,
+                                                              timeout=120),
+            'GET /search': lambda session, i: session.get(channel.url + '/search', headers=channel_headers,
+                                                          params=random.choice(SEARCH_QUERIES), timeout=120),
+            'POST /': lambda session, i: session.post(channel.url + '/', headers=channel_headers, json=new_message(i),
+                                                      timeout=120),
+            'mixed': lambda session, i: (session.get(channel.url + '/?limit=100', headers=channel_headers, timeout=120)
+                                         if random.random() < args.read_ratio else
+                                         session.post(channel.url + '/', headers=channel_headers,
+                                                      json=new_message(i), timeout=120)),
+            'POST / visible': lambda session, i: post_until_visible(session, channel.url, channel_headers, i),
+            'hub /channels': lambda session, i: session.get(hub.url + '/channels?active=true', headers=hub_headers,
+                                                            timeout=120),
+            'client /show': lambda session, i: session.get(client.url + '/show', params={'channel': channel.url},
+                                                           timeout=120),
+        }
+        for name, request_fn in scenarios.items():
+            if args.scenarios and name not in args.scenarios:
+                continue
+            result['scenarios'][name] = run_load(request_fn, args.concurrency, args.duration)
+            print("  %-16s %s" % (name, format_summary(result['scenarios'][name])))
+
+        if not args.scenarios or 'check_channels' in args.scenarios:
+            result['scenarios']['check_channels'] = bench_check_channels(hub_env, rundir, args.check_runs)
+            print("  %-16s %s" % ('check_channels', format_summary(result['scenarios']['check_channels'])))
+        result['moderation'] = requests.get(channel.url + '/moderation', headers=channel_headers, timeout=10).json()
+        result['classification'] = requests.get(channel.url + '/classification', headers=channel_headers,
+                                                timeout=10).json()
+    finally:
+        for service in reversed(services):
+            service.stop()
+    return result
+
+
+def register_channels(hub: Service, channel: Service, stub: Service, fake_channels: int) -> None:
+    """
+    Registers the benchmark channel and fake_channels channels served by the stub at the hub and waits until the
+    hub has verified them.
+    """
+    headers = {'Authorization': 'authkey ' + HUB_AUTHKEY}
+    records = [{'name': 'AluTalk', 'endpoint': channel.url, 'authkey': CHANNEL_AUTHKEY}]
+    records += [{'name': 'fake%d' % i, 'endpoint': stub.url + '/channels/fake%d' % i, 'authkey': 'fake'}
+                for i in range(fake_channels)]
+    ids = []
+    for record in records:
+        record['type_of_service'] = 'aiweb24:chat'
+        response = requests.post(hub.url + '/channels', headers=headers, data=json.dumps(record), timeout=30)
+        response.raise_for_status()
+        ids.append(response.json()['id'])
+    for channel_id in ids:
+        status = requests.get(hub.url + '/channels/%d/status?wait=30' % channel_id, headers=headers, timeout=40)
+        if status.json().get('status') != 'verified':
+            raise RuntimeError("Channel %d was not verified: %s" % (channel_id, status.text))
+
+
+def bench_check_channels(hub_env: dict, workdir: str, runs: int) -> dict:
+    """
+    Times check_channels of the hub in a separate process (the hub process of the benchmark keeps running).
+    :return: summary of the runs
+    """
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--time-check-channels', str(runs)],
+                            cwd=workdir, env=hub_env, capture_output=True, text=True, check=True).stdout
+    elapsed = time.perf_counter() - start
+    durations = json.loads(output.strip().splitlines()[-1])
+    summary = summarize([(duration, 0, True) for duration in durations], sum(durations))
+    summary['process_seconds'] = round(elapsed, 2)  # including the start of the process and the import of the hub
+    return summary
+
+
+def format_summary(summary: dict) -> str:
+    return "p50 %(p50_ms)sms  p95 %(p95_ms)sms  p99 %(p99_ms)sms  %(rps)s req/s  %(bytes_per_request)s B/req  " \
+           "(%(requests)d requests, %(errors)d errors, error rate %(error_rate)s)" % summary
+
+
+def compare(before_file: str, after_file: str) -> None:
+    """
+    Prints the change of latency and throughput between two result files.
+    """
+    with open(before_file) as f:
+        before = json.load(f)
+    with open(after_file) as f:
+        after = json.load(f)
+    before_startup, after_startup = before.get('startup', {}), after.get('startup', {})
+    before = {run['history']: run for run in before['runs']}
+    after = {run['history']: run for run in after['runs']}
+    for module, new in after_startup.items():
+        old = before_startup.get(module)
+        if old:
+            print("%-24s median %.3fs -> %.3fs" % (module, old['median_s'], new['median_s']))
+    for history in sorted(set(before) & set(after)):
+        print("history %d" % history)
+        if 'memory' in after[history] and 'memory' in before[history]:
+            old, new = before[history]['memory'], after[history]['memory']
+            print("  " + "  ".join("%s %s -> %s" % (key, old.get(key), value) for key, value in new.items()))
+        for name, new in after[history].get('scenarios', {}).items():
+            old = before[history]['scenarios'].get(name)
+            if not old:
+                continue
+            changes = []
+            for key in ('p50_ms', 'p95_ms', 'p99_ms', 'rps', 'bytes_per_request'):
+                if old.get(key) and new.get(key) is not None:
+                    changes.append("%s %s -> %s (%+.0f%%)" % (key, old[key], new[key],
+                                                              (new[key] - old[key]) / old[key] * 100))
+            if new.get('error_rate') is not None:
+                changes.append("error_rate %s -> %s" % (old.get('error_rate'), new['error_rate']))
+            print("  %-16s %s" % (name, "  ".join(changes)))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load tests for the channel, the hub and the client.")
+    parser.add_argument('--history', type=int, nargs='+', default=[1000, 100000],
+                        help="number of messages in the channel before the test, one run per value")
+    parser.add_argument('--concurrency', type=int, default=8, help="number of concurrent clients")
+    parser.add_argument('--duration', type=float, default=10, help="seconds per scenario")
+    parser.add_argument('--read-ratio', type=float, default=0.9, help="share of reads in the mixed scenario")
+    parser.add_argument('--scenarios', nargs='+', help="only run these scenarios (e.g. 'GET /' check_channels)")
+    parser.add_argument('--channels', type=int, default=50, help="fake channels registered at the hub")
+    parser.add_argument('--check-runs', type=int, default=5, help="number of timed check_channels runs")
+    parser.add_argument('--llm-latency', type=float, default=0.5, help="seconds the stub LLM takes to answer")
+    parser.add_argument('--token-delay', type=float, default=0.05, help="seconds between two streamed tokens")
+    parser.add_argument('--health-latency', type=float, default=0.05, help="seconds a fake channel takes for /health")
+    parser.add_argument('--output', default='benchmark_results.json', help="file the results are saved to")
+    parser.add_argument('--keep', action='store_true', help="keep the temporary directory (logs and databases)")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help="compare two result files")
+    parser.add_argument('--memory', action='store_true',
+                        help="measure resident memory and garbage collection of a worker instead of the load tests")
+    parser.add_argument('--rebuilds', type=int, default=5, help="full message lists served per memory measurement")
+    parser.add_argument('--startup', action='store_true',
+                        help="measure the import time of the apps (new process per import) instead of the load tests")
+    parser.add_argument('--startup-runs', type=int, default=5, help="imports per app in the startup measurement")
+    parser.add_argument('--startup-budget', type=float,
+                        help="measure the startup and exit with 1 if the channel imports slower than this (seconds) or "
+                             "imports one of the lazy modules (%s)" % ', '.join(LAZY_MODULES))
+    parser.add_argument('--timestamps', action='store_true',
+                        help="compare timestamp parsing and range filtering with the old path instead of the load tests")
+    parser.add_argument('--measure-memory', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--serve', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--time-check-channels', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args.serve, args.port)
+    if args.time_check_channels:
+        return time_check_channels(args.time_check_channels)
+    if args.measure_memory:
+        return measure_memory(args.measure_memory)
+    if args.compare:
+        return compare(*args.compare)
+
+    workdir = tempfile.mkdtemp(prefix='benchmark-')
+    env = dict(os.environ, PYTHONPATH=python_path(workdir), PYTHONUNBUFFERED='1')
+    sys.path.insert(0, env['PYTHONPATH'])
+    results = {'started': datetime.now().isoformat(),
+               'config': {key: value for key, value in vars(args).items()
+                          if key not in ('serve', 'port', 'time_check_channels', 'measure_memory', 'compare')},
+               'runs': [],
+               }
+    within_budget = True
+    try:
+        if args.startup or args.startup_budget is not None:
+            results['startup'] = bench_startup(args, env, workdir)
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+            if args.startup_budget is not None:
+                within_budget = check_startup_budget(results['startup'], args.startup_budget)
+        if args.timestamps:
+            results['timestamps'] = bench_timestamps(TIMESTAMP_SAMPLES)
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        for history in args.history if not (results.get('startup') or args.timestamps) else []:
+            results['runs'].append((bench_memory if args.memory else bench_history)(history, args, env, workdir))
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+    finally:
+        if args.keep:
+            print("Logs and databases are in " + workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    print("Results saved to " + args.output)
+    if not within_budget:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
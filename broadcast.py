@@ -0,0 +1,62 @@
+## broadcast.py - notices new channel messages and tells the event streams about them
+
+import threading
+import time
+
+from project_three.message_store import MessageStore
+
+
+class Broadcaster(object):
+    """
+    Fan-out of "there are new messages" notifications to the listeners of a channel (the event loop that serves the
+    streams and long-polls, see event_stream.py). A single watcher thread per process checks the newest message id and
+    the revision of the store, so messages posted (or updated) through other worker processes are noticed as well.
+    """
+
+    def __init__(self, store: MessageStore, poll_interval: float = 0.5):
+        """
+        :param store: the message store new messages are appended to
+        :param poll_interval: seconds between two checks of the store for messages from other processes
+        """
+        self.store = store
+        self.poll_interval = poll_interval
+        self.last_id = None
+        self.revision = None
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def publish(self) -> None:
+        """
+        Checks the store for changes and calls all listeners if there are new or updated messages.
+        Called after every write of this process (and regularly by the watcher thread).
+        """
+        last_id, revision = self.store.last_id(), self.store.revision()
+        with self._lock:
+            if revision == self.revision and last_id == self.last_id:
+                return
+            self.last_id, self.revision = last_id, revision
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener()
+
+    def add_listener(self, listener) -> None:
+        """
+        Registers a function that is called (without arguments, from the thread that noticed the change) whenever there
+        are new or updated messages, and starts the watcher thread.
+        :param listener: the function, it must not block
+        """
+        with self._lock:
+            self._listeners.append(listener)
+            if self._thread is None:
+                self.last_id, self.revision = self.store.last_id(), self.store.revision()
+                self._thread = threading.Thread(target=self._run, name='broadcaster', daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.publish()
+            except Exception as e:
+                print(f"Checking for new messages failed: {e}")
@@ -1,30 +1,58 @@
 ## channel.py - a simple message channel
 
 import json
+import math
 import os
-from datetime import datetime, timedelta
+import re
+import time
+from datetime import timedelta
+
+from urllib.parse import urlencode
+
+from flask import Blueprint, Flask, request, jsonify, redirect, Response
+from project_three.assistant import Assistant
+from project_three.broadcast import Broadcaster
+from project_three.classification import ClassificationCache, NaiveBayesClassifier, TieredClassifier, \
+    training_examples
+from project_three.event_stream import EventStreamServer
+from project_three.history_cache import HistoryCache
+from project_three.message_store import SQLiteMessageStore, open_store
+from project_three.metrics import instrument_app, registry
+from project_three.moderation import ModerationPipeline, QueueFull
+from project_three.profanity import conspiracy_related, filter_profanity_many, profanity_filter
+from project_three.rate_limit import RateLimiter, parse_limit
+from project_three.retention import Compactor
+from project_three.services import services
+from project_three.timestamps import format_timestamp, now_timestamp, parse_timestamp
+
+WELCOME_MSG = ("Welcome. This channel was made to discuss your theories about the world "
+               "(which others might call conspiracy theories). You can start chatting. Please only post "
+               "conspiracy theory related content and do not use swear words, else your message won't be posted "
+               "at all or censored. If you want to hear a specialist's opinion, start your message with '/assistant'.")
+# the welcome message never changes (fixed timestamp), so the message list only changes with the store
+WELCOME_TIMESTAMP = "2024-12-01T00:00:00Z"
+
+LLM_TIMEOUT = float(os.environ.get('llm_timeout', 20))  # seconds until a request to the LLM is given up
+gpt_version = "gpt-4o-mini"
+
 
-import requests
-from dateutil import parser
-from dotenv import load_dotenv
-from flask import Flask, request, jsonify
-from openai import OpenAI
-from project_three.profanity import conspiracy_related, filter_profanity
+def load_secrets() -> None:
+    from dotenv import load_dotenv
+    load_dotenv("project_three/secrets.env")
 
-WELCOME_MSG = "Welcome. This channel was made to discuss your theories about the world "
-"(which others might call conspiracy theories). You can start chatting. Please only post "
-"conspiracy theory related content and do not use swear words, else your message won't be posted "
-"at all or censored. If you want to hear a specialist's opinion, start your message with '/assistant'."
 
-AI_PROMPT = "Please answer as if you were whole-heartedly believing into all conspiracy theories that have ever been invented. E.g. you" \
-            " should be 100% certain that the earth is flat, lizard people live among us, the moon landing was fake, and so on. Insult any person claiming something else. " \
-            "Keep your answer short and it should not sound too intelligent. " \
-            "Also answer as if you were personally offended by whatever is said to you."
+def create_llm_client():
+    """
+    :return: the OpenAI client (importing openai takes longer than the rest of the app, so it is created on first use)
+    """
+    from openai import OpenAI
+    services.get('secrets')
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"), timeout=LLM_TIMEOUT, max_retries=1)
 
-load_dotenv("project_three/secrets.env")
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-gpt_version = "gpt-4o-mini"
+services.register('secrets', load_secrets)
+services.register('llm_client', create_llm_client)
+client = services.lazy('llm_client')
 
 
 # Class-based application configuration
@@ -41,228 +69,819 @@ class ConfigClass(object):
 # Create Flask app
 app = Flask(__name__)
 app.config.from_object(__name__ + '.ConfigClass')  # configuration
-app.app_context().push()  # create an app context before initializing db
 
 HUB_URL = 'http://vm146.rz.uni-osnabrueck.de/hub'
 HUB_AUTHKEY = 'Crr-K24d-2N'
 CHANNEL_AUTHKEY = os.environ.get('channel_key')
 CHANNEL_NAME = "AluTalk"
 CHANNEL_ENDPOINT = "http://vm146.rz.uni-osnabrueck.de/u012/project_three/channel.wsgi"  # don't forget to adjust in the bottom of the file
-CHANNEL_FILE = 'messages.json'
+CHANNEL_FILE = 'messages.json'  # old storage, migrated into CHANNEL_STORE the first time the store is opened
+CHANNEL_STORE = os.environ.get('channel_store', 'sqlite:///messages.sqlite')
 CHANNEL_TYPE_OF_SERVICE = 'aiweb24:chat'
+# further channels hosted by this process: json list of {name, prefix, authkey, store, endpoint, policy, welcome}
+CHANNELS_FILE = os.environ.get('channels_file', 'channels.json')
+DEFAULT_PAGE_SIZE = 100  # number of messages returned by a cursor request without ?limit=
+MAX_PAGE_SIZE = 1000
+MAX_WAIT = 30  # maximum number of seconds a long-poll request waits for new messages
+MAX_BATCH = 1000  # maximum number of messages posted to /batch at once
+STREAM_DURATION = 300  # seconds after which an event stream is closed (the browser reconnects automatically)
+STREAM_KEEPALIVE = 15  # seconds between two keep-alive comments on an idle event stream
+# /stream and /wait of all workers are served by one event loop on this port (see event_stream.py)
+STREAM_PORT = int(os.environ.get('stream_port', 5002))
+STREAM_ENDPOINT = os.environ.get('stream_endpoint', '')  # public url of that port, default: host of the request
+
+# retention: messages older than RETENTION_TTL are removed, optionally also the oldest ones beyond a count/size limit
+RETENTION_TTL = timedelta(hours=float(os.environ.get('retention_ttl_hours', 25)))
+RETENTION_MAX_MESSAGES = int(os.environ['retention_max_messages']) if 'retention_max_messages' in os.environ else None
+RETENTION_MAX_BYTES = int(os.environ['retention_max_bytes']) if 'retention_max_bytes' in os.environ else None
+RETENTION_INTERVAL = float(os.environ.get('retention_interval', 60))  # seconds between two compactions
+CLASSIFICATION_CACHE_FILE = os.environ.get('classification_cache', 'classifications.sqlite')  # '' keeps it in memory
+# the topic check tries the cheapest tier first and only asks the LLM if the others aren't sure
+CLASSIFIER_TIERS = os.environ.get('classifier_tiers', 'rules,model,llm').split(',')
+CLASSIFIER_MODEL_FILE = os.environ.get('classifier_model', 'classifier_model.json')  # see: flask train_classifier
+CLASSIFIER_THRESHOLD = float(os.environ.get('classifier_threshold', 0.9))
+MODERATION_WORKERS = int(os.environ.get('moderation_workers', 4))
+MODERATION_QUEUE = int(os.environ.get('moderation_queue', 100))  # more waiting posts are rejected with 503
+# answers of the assistant are stored while they are generated, at most ASSISTANT_CONCURRENCY at the same time
+ASSISTANT_STREAMING = os.environ.get('assistant_streaming', '1') == '1'
+ASSISTANT_CONCURRENCY = int(os.environ.get('assistant_concurrency', 2))
+ASSISTANT_QUEUE = int(os.environ.get('assistant_queue', 20))
+ASSISTANT_QUEUE_TIMEOUT = float(os.environ.get('assistant_queue_timeout', 10))
+ASSISTANT_TIMEOUT = float(os.environ.get('assistant_timeout', 30))
+ASSISTANT_UPDATE_INTERVAL = 0.25  # seconds between two updates of a streamed answer in the store
+# every post of a sender takes a token, questions to the assistant also one of the stricter assistant bucket
+# ('<posts>/<seconds>', '' for no limit); the buckets are shared by all workers through RATE_LIMIT_FILE
+RATE_LIMIT_POSTS = os.environ.get('rate_limit_posts', '20/60')
+RATE_LIMIT_ASSISTANT = os.environ.get('rate_limit_assistant', '3/60')
+RATE_LIMIT_FILE = os.environ.get('rate_limit_file', 'rate_limits.sqlite')  # '' keeps the buckets per process
+
+# the LLM client, the profanity list, the classifier and the assistant are shared by all channels of the process
+# most messages are greetings or repeated, so LLM results are cached by (normalized) message
+classification_cache = ClassificationCache(path=CLASSIFICATION_CACHE_FILE or None)
+# all questions about one message together get LLM_TIMEOUT, well within the timeout of the classification stage
+classifier = TieredClassifier(lambda text: conspiracy_related(text, client, gpt_version, timeout=LLM_TIMEOUT),
+                              classification_cache, tiers=CLASSIFIER_TIERS,
+                              model=NaiveBayesClassifier.load(CLASSIFIER_MODEL_FILE), threshold=CLASSIFIER_THRESHOLD)
+assistant = Assistant(client, gpt_version, max_concurrent=ASSISTANT_CONCURRENCY, max_queue=ASSISTANT_QUEUE,
+                      queue_timeout=ASSISTANT_QUEUE_TIMEOUT, timeout=ASSISTANT_TIMEOUT)
+# every post costs at least one LLM call, so single senders can't post more than their limits
+rate_limiter = RateLimiter({'post': parse_limit(RATE_LIMIT_POSTS), 'assistant': parse_limit(RATE_LIMIT_ASSISTANT)},
+                           path=RATE_LIMIT_FILE or None)
+# the hosted channels by the name of their blueprint (see HostedChannel and the bottom of the file)
+channels = {}
+# open streams and long-polls don't hold a thread of the worker, they wait as sockets in one event loop thread
+event_streams = EventStreamServer(lambda: channels, STREAM_PORT, keepalive=STREAM_KEEPALIVE, duration=STREAM_DURATION,
+                                  max_wait=MAX_WAIT, default_page_size=DEFAULT_PAGE_SIZE, max_page_size=MAX_PAGE_SIZE)
+channel_routes = Blueprint('channel', __name__)
+
+# the counters of the components are exported on /metrics next to the request and stage timings
+registry.stats('classification', "Topic check decisions per tier and LLM cache counters", classifier.stats)
+registry.stats('assistant', "Assistant answers, fallbacks and waiting requests", assistant.stats)
+registry.stats('retention', "Compactor runs and reclaimed messages/bytes per channel",
+               lambda: {key: channel.compactor.stats() for key, channel in channels.items()})
+registry.stats('moderation', "Posts accepted, stored, retried and dead-lettered per channel",
+               lambda: {key: channel.moderation.stats() for key, channel in channels.items()})
+registry.stats('broadcast', "Open event streams and waiting long-polls per channel", event_streams.stats)
 
 
 @app.cli.command('register')
 def register_command() -> None:
     """
-    This function sends a POST request to the server and handles possibly occurring errors  
+    This function sends a POST request to the server and handles possibly occurring errors.
+    All hosted channels are registered in one request (a single channel is sent as a single record).
     """
-    global CHANNEL_AUTHKEY, CHANNEL_NAME, CHANNEL_ENDPOINT
-
+    import requests
+    records = [{"name": channel.name,
+                "endpoint": channel.endpoint,
+                "authkey": channel.authkey,
+                "type_of_service": channel.type_of_service,
+                } for channel in channels.values()]
     response = requests.post(HUB_URL + '/channels', headers={'Authorization': 'authkey ' + HUB_AUTHKEY},
-                             data=json.dumps({
-                                 "name": CHANNEL_NAME,
-                                 "endpoint": CHANNEL_ENDPOINT,
-                                 "authkey": CHANNEL_AUTHKEY,
-                                 "type_of_service": CHANNEL_TYPE_OF_SERVICE,
-                             }))
+                             data=json.dumps(records if len(records) > 1 else records[0]))
 
     # check if an error occurs and return the respective message in case it does
-    if response.status_code != 200:
+    if not response.ok:
         print("Error creating channel: " + str(response.status_code))
         print(response.text)
         return
+    # the hub checks the health of the channels in the background, wait for the results
+    registrations = response.json()
+    registrations = registrations['channels'] if 'channels' in registrations else [registrations]
+    for record, registration in zip(records, registrations):
+        if registration.get('status') == 'pending':
+            registration = requests.get(HUB_URL + '/channels/%d/status' % registration['id'], params={'wait': 30},
+                                        timeout=40).json()
+        print("Registration of %s %s" % (record['name'], registration.get('status')))
+
+
+@app.cli.command('compact')
+def compact_command() -> None:
+    """
+    Removes expired messages of all hosted channels once (e.g. from a cron job instead of the background thread)
+    """
+    for channel in channels.values():
+        messages, size = channel.compactor.compact()
+        print(f"{channel.name}: removed {messages} messages ({size} bytes)")
+
+
+@app.cli.command('train_classifier')
+def train_classifier_command() -> None:
+    """
+    Trains the local topic classifier on all messages the LLM has classified so far and saves it to
+    CLASSIFIER_MODEL_FILE (workers load it on their next start).
+    """
+    if not CLASSIFICATION_CACHE_FILE:
+        print("Training needs a persistent classification cache (classification_cache)")
+        return
+    examples = training_examples(CLASSIFICATION_CACHE_FILE)
+    if not examples:
+        print("No classified messages yet")
+        return
+    model = NaiveBayesClassifier()
+    model.train(examples)
+    model.save(CLASSIFIER_MODEL_FILE)
+    print(f"Trained on {len(examples)} messages ({model.class_counts['no']} unrelated), saved to {CLASSIFIER_MODEL_FILE}")
+
+
+def current_channel():
+    """
+    :return: the hosted channel the current request is for (None for routes of the app, e.g. /metrics)
+    """
+    return channels.get(request.blueprint)
+
+
+@channel_routes.before_request
+def start_compactor() -> None:
+    """
+    Expired messages are removed by a background thread per channel which is started with the first request of a worker.
+    """
+    current_channel().compactor.ensure_started()
 
 
 def check_authorization(request) -> bool:
     """
     Requests should be authorized in order to be further processed. This function checks authorization and returns True or False. It is to be called on any request.
+    Every channel has its own authkey, routes that don't belong to a channel accept the authkey of any channel.
     :param request: The server request we want to check on authorization
     :return: True or False depending on whether the request is authorized or not
     """
-    global CHANNEL_AUTHKEY
     # check if authorization header is present
     if 'Authorization' not in request.headers:
         return False
     # check if authorization header is valid
-    if request.headers['Authorization'] != 'authkey ' + CHANNEL_AUTHKEY:
-        return False
-    return True
+    channel = current_channel()
+    authkeys = [channel.authkey] if channel else [channel.authkey for channel in channels.values()]
+    return any(request.headers['Authorization'] == 'authkey ' + authkey for authkey in authkeys)
+
 
+# request timings and the counters above on /metrics (optional sampling profiler on /metrics/profile)
+instrument_app(app, check_authorization)
 
-@app.route('/health', methods=['GET'])
+
+@channel_routes.route('/health', methods=['GET'])
 def health_check():
     """
     If the request is not authorized, this function returns an error. Else it converts the channel to a .json file and returns it.
     :return: the channel as a .json object
     """
-    global CHANNEL_NAME
     if not check_authorization(request):
         return "Invalid authorization", 400
-    return jsonify({'name': CHANNEL_NAME}), 200
+    return jsonify({'name': current_channel().name}), 200
 
 
 # GET: Return list of messages
-@app.route('/', methods=['GET'])  # list of messages
+@channel_routes.route('/', methods=['GET'])  # list of messages
 def home_page():
     """
     Function to set up the homepage and display the welcome message.
+    Without parameters all messages are returned. With ?since=<id|timestamp>, ?before=<id> or ?limit=<n> only one page
+    of messages is returned together with the cursor to fetch the next one.
     :return: error message or all messages as json objects
     """
     # first check whether the request has a valid header
     if not check_authorization(request):
         return "Invalid authorization", 400
-    # fetch channels from server
-    # messages that are to old should not be displayed anymore
-    delete_messages()
-    # get all remaining messages
-    messages = read_messages()
-    # insert the welcome message at the beginning such that it's the first to be displayed
-    messages.insert(0, {'content': WELCOME_MSG,
-                        'sender': "Server",
-                        'timestamp': str(datetime.now()),
-                        })
-    # return all messages as json objects
-    return jsonify(messages)
+    # messages that are too old are removed by the compactor in the background
+    if any(parameter in request.args for parameter in ('since', 'before', 'limit')):
+        return read_page(current_channel(), request.args)
+    # all remaining messages with the welcome message at the beginning such that it's the first to be displayed,
+    # serialized once per revision of the store; pollers that have the current version get a 304
+    history = current_channel().history_cache.get()
+    compressed = request.accept_encodings['gzip'] > 0
+    # streamed in chunks, the body can be a memory-mapped segment file that is never copied as a whole
+    response = Response(history.chunks(compressed), mimetype='application/json')
+    response.content_length = history.length(compressed)
+    response.set_etag(history.etag + ('-gzip' if compressed else ''))
+    response.last_modified = history.last_modified
+    response.cache_control.no_cache = True
+    response.vary.add('Accept-Encoding')
+    if compressed:
+        response.content_encoding = 'gzip'
+    return response.make_conditional(request)
+
+
+def read_page(channel, args):
+    """
+    Reads one page of messages for the cursor parameters of a GET request.
+    :param channel: the hosted channel
+    :param args: the query parameters of the request (since, before and limit)
+    :return: error message or the messages together with the cursor for the next page as json object
+    """
+    since, since_timestamp, before = None, None, None
+    try:
+        limit = min(int(args.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        if 'before' in args:
+            before = int(args['before'])
+        if 'since' in args:
+            # the cursor is either the id of a message or a timestamp
+            if args['since'].isdigit():
+                since = int(args['since'])
+            else:
+                since_timestamp = parse_timestamp(args['since'])
+                if since_timestamp is None:
+                    raise ValueError(args['since'])
+    except ValueError:
+        return "Invalid cursor", 400
+    if limit < 1:
+        return "Invalid limit", 400
+    # if the current revision is serialized already, the page is cut out of it instead of reading the store
+    history = channel.history_cache.fresh() if since_timestamp is None else None
+    if history is not None:
+        page, ids = history.page(since=since, before=before, limit=limit)
+    else:
+        messages = channel.store.read_page(since=since, since_timestamp=since_timestamp, before=before, limit=limit)
+        ids = [message['id'] for message in messages]
+    if before is not None:
+        # paging backwards: continue with the oldest message of this page, stop at the beginning of the history
+        next_cursor = ids[0] if len(ids) == limit else None
+    elif ids:
+        next_cursor = ids[-1]
+    else:
+        # nothing new: keep the given id, or start at the newest message if the cursor was a timestamp
+        next_cursor = since if since is not None else channel.store.last_id()
+    if history is None:
+        return jsonify(messages=messages, next_cursor=next_cursor, has_more=len(ids) == limit)
+    # the same object jsonify would return, with the messages as they are in the serialized history
+    return Response(b'{"has_more":%s,"messages":%s,"next_cursor":%s}\n'
+                    % (json.dumps(len(ids) == limit).encode(), page, json.dumps(next_cursor).encode()),
+                    mimetype='application/json')
+
+
+@channel_routes.route('/search', methods=['GET'])
+def search_messages():
+    """
+    Finds messages by ?q=<words in the content>, ?sender=<name>, ?from=<timestamp> and ?to=<timestamp> (all optional,
+    combined with AND), newest first in pages of ?limit=<n> messages; ?before=<id> returns the next page.
+    :return: error message or the messages of the page (sorted by id) together with the cursor of the next page
+    """
+    if not check_authorization(request):
+        return "Invalid authorization", 400
+    timestamps = {}
+    try:
+        limit = min(int(request.args.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        before = int(request.args['before']) if 'before' in request.args else None
+        for parameter in ('from', 'to'):
+            if parameter in request.args:
+                timestamps[parameter] = parse_timestamp(request.args[parameter])
+                if timestamps[parameter] is None:
+                    raise ValueError(request.args[parameter])
+    except ValueError:
+        return "Invalid cursor or timestamp", 400
+    if limit < 1:
+        return "Invalid limit", 400
+    messages = current_channel().store.search(query=request.args.get('q'), sender=request.args.get('sender'),
+                                              from_timestamp=timestamps.get('from'),
+                                              to_timestamp=timestamps.get('to'), before=before, limit=limit)
+    # like paging backwards: continue with the oldest message of this page
+    next_cursor = messages[0]['id'] if len(messages) == limit else None
+    return jsonify(messages=messages, next_cursor=next_cursor, has_more=len(messages) == limit)
+
+
+@channel_routes.route('/wait', methods=['GET'])
+def wait_for_messages():
+    """
+    Long-poll: waits until there are messages newer than ?since=<id> (or ?timeout=<seconds> is over) and returns them
+    together with the cursor for the next request. Answered by the event stream server (307).
+    :return: error message or a redirect to the event stream server
+    """
+    if not check_authorization(request):
+        return "Invalid authorization", 400
+    return redirect_to_event_streams('/wait')
+
+
+@channel_routes.route('/stream', methods=['GET'])
+def stream_messages():
+    """
+    Server-sent events: pushes every new message to the client as soon as it is stored. Served by the event stream
+    server (307).
+    Browsers can't set headers for an EventSource, so the authkey may also be passed as ?authkey=.
+    :return: error message or a redirect to the event stream server
+    """
+    channel = current_channel()
+    if not check_authorization(request) and request.args.get('authkey', '') != channel.authkey:
+        return "Invalid authorization", 400
+    return redirect_to_event_streams('/stream')
+
+
+def redirect_to_event_streams(route: str):
+    """
+    Sends the client to the event loop that holds the open streams and long-polls of all workers. The first worker
+    that gets such a request starts it, the others can't listen on the port anymore and only redirect.
+    :param route: /stream or /wait
+    :return: the redirect
+    """
+    event_streams.start()
+    args = request.args.to_dict()
+    # browsers drop the Authorization header when they follow a redirect to another origin
+    args['authkey'] = current_channel().authkey
+    # a reconnecting EventSource tells us the id of the last message it received
+    if 'Last-Event-ID' in request.headers:
+        args['since'] = request.headers['Last-Event-ID']
+    host = request.host if request.host.endswith(']') else request.host.rsplit(':', 1)[0]
+    endpoint = STREAM_ENDPOINT or '%s://%s:%d' % (request.scheme, host, STREAM_PORT)
+    return redirect(endpoint + current_channel().prefix + route + '?' + urlencode(args), 307)
+
+
+@channel_routes.route('/messages/<int:message_id>', methods=['GET'])
+def get_message(message_id):
+    """
+    Returns a single message, e.g. to follow an answer of the assistant that is still being generated
+    (it has 'streaming': true until it is complete).
+    :param message_id: id of the message
+    :return: error message or the message as json object
+    """
+    if not check_authorization(request):
+        return "Invalid authorization", 400
+    message = current_channel().store.get_message(message_id)
+    if not message:
+        return "Unknown message", 404
+    return jsonify(message), 200
+
+
+@channel_routes.route('/assistant', methods=['GET'])
+def assistant_stats():
+    """
+    :return: error message or the counters of the assistant (answered, fallbacks, queued) as json object
+    """
+    if not check_authorization(request):
+        return "Invalid authorization", 400
+    return jsonify(assistant.stats()), 200
+
+
+@channel_routes.route('/retention', methods=['GET'])
+def retention_stats():
+    """
+    :return: error message or the metrics of the compactor (runs, reclaimed messages and bytes) as json object
+    """
+    if not check_authorization(request):
+        return "Invalid authorization", 400
+    return jsonify(current_channel().compactor.stats()), 200
+
+
+@channel_routes.route('/classification', methods=['GET'])
+def classification_stats():
+    """
+    :return: error message or the decisions per classifier tier and the counters of the LLM cache as json object
+    """
+    if not check_authorization(request):
+        return "Invalid authorization", 400
+    return jsonify(classifier.stats()), 200
+
+
+@channel_routes.route('/moderation', methods=['GET'])
+def moderation_stats():
+    """
+    :return: error message or the counters of the moderation pipeline (accepted, stored, dead, ...) as json object
+    """
+    if not check_authorization(request):
+        return "Invalid authorization", 400
+    return jsonify(current_channel().moderation.stats()), 200
 
 
 # POST: Send a message
-@app.route('/', methods=['POST'])  # stores new message
+@channel_routes.route('/', methods=['POST'])  # stores new message
 def send_message():
     """
     This function is being called when a user wants to post a message.
-    :return: the status of the message (i.e. possible errors or OK, 200)
+    :return: the status of the message (i.e. possible errors or the id of the pending message, 202)
     """
     # fetch channels from server
     # check authorization header
     if not check_authorization(request):
         return "Invalid authorization", 400
-    # check if message is present
-    message = request.json
+    # check if message is present and has all required attributes
+    message, error = validate_message(request.json)
+    if error:
+        return error, 400
+    channel = current_channel()
+    allowed, retry_after = check_rate_limit(channel, message)
+    if not allowed:
+        return ("Too many messages, try again in %d seconds" % retry_after, 429,
+                {'Retry-After': str(retry_after)})
+    # the post is moderated in the background, it becomes visible as soon as moderation is done
+    try:
+        pending_id = channel.moderation.submit(message)
+    except QueueFull:
+        # the post was not accepted, so it doesn't count against the limit of the sender
+        refund_rate_limit(channel, message)
+        return "Too many messages are waiting for moderation, try again later", 503, {'Retry-After': '5'}
+    except Exception:
+        refund_rate_limit(channel, message)
+        raise
+    return jsonify(id=pending_id, status='pending'), 202
+
+
+@channel_routes.route('/batch', methods=['POST'])  # stores many messages at once
+def send_messages():
+    """
+    Bulk version of send_message for bridges and importers: takes a json array or NDJSON (one message per line).
+    Records in the format of requests.jsonl ({request_id, title, body}) are accepted as well. The valid messages are
+    stored as pending in one write and moderated in the background like single posts; messages that don't fit into
+    the moderation queue any more are rejected. Every accepted message counts against the rate limit of its sender.
+    :return: error message or the result of every message (pending with its id, invalid, limited or rejected), 202
+    """
+    if not check_authorization(request):
+        return "Invalid authorization", 400
+    channel = current_channel()
+    try:
+        records = parse_batch(request)
+    except ValueError as e:
+        return "Invalid batch: " + str(e), 400
+    if len(records) > MAX_BATCH:
+        return "Too many messages, at most %d per batch" % MAX_BATCH, 413
+    # messages without timestamp (imported records) are stamped with the time they arrived
+    ingested = format_timestamp(now_timestamp())
+    results = [None] * len(records)
+    valid = []
+    invalid, limited, rejected = 0, 0, 0
+    for index, record in enumerate(records):
+        message, error = validate_message(batch_record(record, ingested))
+        if error:
+            results[index] = {'status': 'invalid', 'error': error}
+            invalid += 1
+            continue
+        allowed, retry_after = check_rate_limit(channel, message)
+        if not allowed:
+            results[index] = {'status': 'limited', 'retry_after': retry_after}
+            limited += 1
+        else:
+            valid.append((index, message))
+
+    try:
+        pending_ids = channel.moderation.submit_many([message for _, message in valid])
+    except Exception:
+        for _, message in valid:
+            refund_rate_limit(channel, message)
+        raise
+    for (index, message), pending_id in zip(valid, pending_ids):
+        if pending_id is None:
+            refund_rate_limit(channel, message)
+            results[index] = {'status': 'rejected', 'retry_after': 5}
+            rejected += 1
+        else:
+            results[index] = {'status': 'pending', 'id': pending_id}
+    headers = {'Retry-After': '5'} if rejected else {}
+    return jsonify(pending=len(valid) - rejected,
+                   invalid=invalid,
+                   limited=limited,
+                   rejected=rejected,
+                   results=results), 202, headers
+
+
+def parse_batch(request) -> list:
+    """
+    :param request: a request with a json array (or a single json object) or NDJSON
+    :return: the records of the batch
+    """
+    data = request.get_data(as_text=True)
+    if request.mimetype == 'application/json' or data.lstrip().startswith('['):
+        records = json.loads(data)
+        return records if isinstance(records, list) else [records]
+    return [json.loads(line) for line in data.splitlines() if line.strip()]
+
+
+def batch_record(record, ingested: str):
+    """
+    Maps records in the format of requests.jsonl ({request_id, title, body}) to messages, other records are kept.
+    :param record: a record of a batch
+    :param ingested: timestamp used for records without one
+    :return: the message
+    """
+    if not isinstance(record, dict) or 'content' in record or not ('body' in record or 'title' in record):
+        return record
+    content = "\n\n".join(str(record[key]) for key in ('title', 'body') if record.get(key))
+    return {'content': content,
+            'sender': str(record.get('request_id', record.get('sender', "Importer"))),
+            'timestamp': record.get('timestamp', ingested),
+            'extra': record.get('extra'),
+            }
+
+
+def validate_message(message) -> tuple:
+    """
+    :param message: a posted message
+    :return: (the message with content, sender, timestamp (microseconds since the epoch) and extra, None) or
+    (None, error message)
+    """
     # check if the message has all required attributes, if one is missing return an error
-    if not message:
-        return "No message", 400
+    if not message or not isinstance(message, dict):
+        return None, "No message"
     if not 'content' in message:
-        return "No content", 400
+        return None, "No content"
     if not 'sender' in message:
-        return "No sender", 400
+        return None, "No sender"
     if not 'timestamp' in message:
-        return "No timestamp", 400
-    message['timestamp'] = parse_timestamp(message['timestamp'])
-    if not message['timestamp']:
-        return "Invalid timestamp", 400
-    if not 'extra' in message:
-        extra = None
-    else:
-        extra = message['extra']
-    # get all old messages
-    messages = read_messages()
-    # check if the user wants to interact with the LLM assistant
-    if message['content'].lower().startswith("/assistant"):
-        messages.append({'content': message['content'],
-                         'sender': message['sender'],
-                         'timestamp': message['timestamp'],
-                         'extra': extra,
-                         })
-        # generate an AI answer based on the content of the message and append it to the to-be-displayed messages
-        messages.append(ai_answer(message['content']))
-    else:
-        # if the user does not want to interact with the assistant, their message is checked by the filter
-        if conspiracy_related(message['content'], client, gpt_version):
-            message['content'] = filter_profanity(message['content'])
-        else:
-            message[
-                'content'] = f"The user {message['sender']} tried to send a message which is unrelated to conspiracy theories."
-            message['sender'] = "Assistant"
-        messages.append({'content': message['content'],
-                         'sender': message['sender'],
-                         'timestamp': message['timestamp'],
-                         'extra': extra,
-                         })
+        return None, "No timestamp"
+    if not isinstance(message['content'], str):
+        return None, "Content is not a string"
+    if not isinstance(message['sender'], str):
+        return None, "Sender is not a string"
+    timestamp = parse_timestamp(message['timestamp'])
+    if timestamp is None:
+        return None, "Invalid timestamp"
+    return {'content': message['content'],
+            'sender': message['sender'],
+            'timestamp': timestamp,
+            'extra': message.get('extra'),
+            }, None
+
+
+def rate_limit_key(channel, sender) -> str:
+    """
+    :return: key of the buckets of a sender in a channel (the channels of a process share the rate limiter)
+    """
+    return '%s/%s' % (channel.prefix, sender)
 
-    save_messages(messages)
-    return "OK", 200
 
+def check_rate_limit(channel, message) -> tuple:
+    """
+    Takes a token from the post bucket of the sender (and from the assistant bucket for questions to the assistant).
+    :param channel: the hosted channel
+    :param message: a validated message
+    :return: (True, 0) if the message may be posted, else (False, seconds until it may be posted)
+    """
+    buckets = ['post', 'assistant'] if is_assistant_request(message) else ['post']
+    allowed, retry_after, _ = rate_limiter.acquire(rate_limit_key(channel, message['sender']), buckets)
+    return allowed, 0 if allowed else max(math.ceil(retry_after), 1)
 
-def parse_timestamp(timestamp_str: str):
-    try:
-        # Replace 'Z' with '+00:00' to make it ISO 8601 compliant
-        if timestamp_str.endswith("Z"):
-            timestamp_str = timestamp_str[:-1] + "+00:00"
 
-        # Parse timestamp
-        dt = parser.isoparse(timestamp_str)
+def refund_rate_limit(channel, message) -> None:
+    """
+    Gives back the tokens check_rate_limit took for a message that was not accepted after all.
+    :param channel: the hosted channel
+    :param message: a validated message
+    """
+    buckets = ['post', 'assistant'] if is_assistant_request(message) else ['post']
+    rate_limiter.refund(rate_limit_key(channel, message['sender']), buckets)
 
-        # Convert to ISO 8601 with 'Z' to ensure JSON compatibility
-        print(dt.isoformat().replace("+00:00", "Z"))
-        return dt.isoformat().replace("+00:00", "Z")
 
-    except Exception:
-        return None  # Return None if parsing fails
+@channel_routes.route('/quota', methods=['GET'])
+def rate_limit_quota():
+    """
+    Lets a client check how many more messages it may post: /quota?sender=<name>.
+    :return: error message or the remaining tokens, capacity, refill rate and seconds until the next post is allowed
+    per bucket as json object
+    """
+    if not check_authorization(request):
+        return "Invalid authorization", 400
+    if 'sender' not in request.args:
+        return "No sender", 400
+    sender = request.args['sender']
+    return jsonify(sender=sender, buckets=rate_limiter.quota(rate_limit_key(current_channel(), sender))), 200
 
 
-def read_messages():
+@channel_routes.route('/pending/<int:pending_id>', methods=['GET'])
+def pending_status(pending_id):
     """
-    This function loads all the messages we have saved from previous interactions.
-    :return: these loaded messages
+    Lets a client check whether its post was moderated yet.
+    :param pending_id: the id returned when posting the message
+    :return: error message or the state (pending, running, done or dead) and the ids of the stored messages as json
     """
-    global CHANNEL_FILE
-    try:
-        f = open(CHANNEL_FILE, 'r')
-    except FileNotFoundError:
-        return []
-    try:
-        messages = json.load(f)
-    except json.decoder.JSONDecodeError:
-        messages = []
-    f.close()
-    return messages
+    if not check_authorization(request):
+        return "Invalid authorization", 400
+    status = current_channel().moderation.status(pending_id)
+    if not status:
+        return "Unknown message", 404
+    return jsonify(status), 200
 
 
-def save_messages(messages) -> None:
+def is_assistant_request(message) -> bool:
     """
-    The opposite of read_messages -> Function that gets messages as input and saves them in json format.
-    :param messages: the messges we want to save as json
+    :param message: a message as dict
+    :return: True if the user wants to interact with the LLM assistant
     """
-    global CHANNEL_FILE
-    with open(CHANNEL_FILE, 'w') as f:
-        json.dump(messages, f)
+    return message['content'].lower().startswith("/assistant")
 
 
-def delete_messages() -> None:
+def profanity_stage(messages) -> list:
     """
-    Function that deletes all messages older than 25h.
+    Moderation stage: masks swear words (questions to the assistant are not filtered).
     """
-    messages = read_messages()
-    current_time = datetime.now()  # get current time
-    threshold = timedelta(hours=25)
+    # all messages of a post (or a batch) are filtered in one call
+    filtered = iter(filter_profanity_many([message['content'] for message in messages
+                                           if not is_assistant_request(message)]))
+    return [message if is_assistant_request(message) else dict(message, content=next(filtered))
+            for message in messages]
+
+
+def classification_stage(messages) -> list:
+    """
+    Moderation stage: replaces messages that are unrelated to conspiracy theories by a notice.
+    """
+    result = []
+    for message in messages:
+        if is_assistant_request(message) or classifier.classify(message['content']):
+            result.append(message)
+        else:
+            result.append(dict(message,
+                               content=f"The user {message['sender']} tried to send a message which is unrelated to conspiracy theories.",
+                               sender="Assistant"))
+    return result
+
+
+def assistant_stage(messages) -> list:
+    """
+    Moderation stage: generates an AI answer for questions to the assistant and stores it after the question.
+    In streaming mode an empty answer is stored and filled while it is generated (see stream_answer).
+    """
+    result = []
+    for message in messages:
+        result.append(message)
+        if is_assistant_request(message) and ASSISTANT_STREAMING:
+            result.append({'content': "",
+                           'sender': "Assistant",
+                           'timestamp': now_timestamp(),
+                           'extra': "",
+                           'streaming': True,
+                           'question': message['content'],
+                           })
+        elif is_assistant_request(message):
+            result.append(ai_answer(message['content']))
+    return result
+
+
+def message_stored(channel, ids, messages) -> None:
+    """
+    Called by the moderation pipeline after a post was stored: notifies waiting clients and starts streamed answers.
+    :param channel: the hosted channel
+    :param ids: the ids of the stored messages
+    :param messages: the stored messages
+    """
+    channel.broadcaster.publish()
+    for message_id, message in zip(ids, messages):
+        if message.get('streaming'):
+            stream_answer(channel, message_id, message['question'])
+
+
+def stream_answer(channel, message_id, question) -> None:
+    """
+    Generates the answer to a question and writes it into the (already stored) message while it grows.
+    :param channel: the hosted channel
+    :param message_id: id of the stored answer
+    :param question: the message of the user
+    """
+    last_update = [0.0]
+
+    def on_text(text):
+        # not every chunk is written, that would be one write per word
+        if time.monotonic() - last_update[0] >= ASSISTANT_UPDATE_INTERVAL:
+            last_update[0] = time.monotonic()
+            channel.store.update_message(message_id, text, streaming=True)
+            channel.broadcaster.publish()
 
-    # Filter messages
-    filtered_messages = [
-        message for message in messages
-        if datetime.fromisoformat(message["timestamp"].rstrip('Z')) >= current_time - threshold
-    ]
-    # save only the messages that are not deleted by the filter
-    save_messages(filtered_messages)
+    def on_done(future):
+        channel.store.update_message(message_id, future.result(), streaming=False)
+        channel.broadcaster.publish()
+
+    assistant.submit(question, on_text=on_text).add_done_callback(on_done)
+
+
+# moderation stages a channel can switch off in its policy, in the order posts run through them
+MODERATION_STAGES = [('profanity', profanity_stage, 5),
+                     ('classification', classification_stage, LLM_TIMEOUT * 2),
+                     ('assistant', assistant_stage, ASSISTANT_QUEUE_TIMEOUT + ASSISTANT_TIMEOUT + 5)]
+
+
+class HostedChannel(object):
+    """
+    One channel hosted by this process, with its own route prefix, authkey, message store and moderation policy.
+    """
+
+    def __init__(self, name: str, authkey: str, endpoint: str, store_url: str, prefix: str = '',
+                 type_of_service: str = CHANNEL_TYPE_OF_SERVICE, policy: dict = None, welcome: str = WELCOME_MSG,
+                 legacy_file: str = None):
+        """
+        :param name: name of the channel (reported on /health)
+        :param authkey: authkey of the channel
+        :param endpoint: public url of the channel (registered with the hub)
+        :param store_url: message store of the channel, e.g. 'sqlite:///messages.sqlite'
+        :param prefix: route prefix in this app, '' for the channel at the root
+        :param type_of_service: type of service registered with the hub
+        :param policy: moderation stages to switch on/off, e.g. {'assistant': False} (all are on by default)
+        :param welcome: content of the welcome message
+        :param legacy_file: optional messages.json file that is migrated into the store
+        """
+        self.name = name
+        self.authkey = authkey
+        self.endpoint = endpoint
+        self.prefix = prefix
+        self.type_of_service = type_of_service
+        self.policy = {stage: (policy or {}).get(stage, True) for stage, _, _ in MODERATION_STAGES}
+        self.welcome_message = {'content': welcome,
+                                'sender': "Server",
+                                'timestamp': WELCOME_TIMESTAMP,
+                                }
+        # messages are appended to the store instead of rewriting a json file on every post
+        self.store = open_store(store_url, legacy_file=legacy_file)
+        self.broadcaster = Broadcaster(self.store)
+        # the serialized message list for GET /, rebuilt only after writes (SQLite stores keep it in a memory-mapped
+        # segment file next to the database that all workers share)
+        segment_dir = self.store.path + '.history' if isinstance(self.store, SQLiteMessageStore) else None
+        self.history_cache = HistoryCache(self.store, app.json.dumps(self.welcome_message,
+                                                                     separators=(',', ':')).encode('utf-8'),
+                                          segment_dir=segment_dir)
+        self.compactor = Compactor(self.store, ttl=RETENTION_TTL, max_messages=RETENTION_MAX_MESSAGES,
+                                   max_bytes=RETENTION_MAX_BYTES, interval=RETENTION_INTERVAL)
+        # posts run through these stages in a worker pool before they are stored
+        self.moderation = ModerationPipeline(self.store,
+                                             [stage for stage in MODERATION_STAGES if self.policy[stage[0]]],
+                                             workers=MODERATION_WORKERS, max_queue=MODERATION_QUEUE,
+                                             on_stored=lambda ids, messages: message_stored(self, ids, messages))
+
+
+def load_hosted_channels(path: str) -> list:
+    """
+    Reads the further channels hosted by this process.
+    :param path: json file with a list of {name, prefix, authkey, store, endpoint, type_of_service, policy, welcome}
+    (name, prefix, authkey and store are required)
+    :return: the channels (empty if the file doesn't exist)
+    """
+    if not path or not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        configs = json.load(f)
+    hosted = []
+    for config in configs:
+        prefix = '/' + config['prefix'].strip('/')
+        if prefix == '/':
+            raise ValueError("The root is reserved for channel " + CHANNEL_NAME)
+        hosted.append(HostedChannel(config['name'], config['authkey'],
+                                    config.get('endpoint', CHANNEL_ENDPOINT + prefix), config['store'], prefix=prefix,
+                                    type_of_service=config.get('type_of_service', CHANNEL_TYPE_OF_SERVICE),
+                                    policy=config.get('policy'), welcome=config.get('welcome', WELCOME_MSG)))
+    return hosted
 
 
 def ai_answer(message):
     """
     This function is called if the user asks for help by the AI (using the keyword /assistant).
     :param message: the user message where they ask for assistance.
-    :return: the answer generated by ChatGPT
+    :return: the answer generated by ChatGPT (or a fallback reply if the assistant is too busy or too slow)
     """
-    content = client.chat.completions.create(model=gpt_version,
-                                             messages=[{"role": "user", "content": AI_PROMPT + message}])
-
-    print(content)
-    return {'content': content.choices[0].message.content,
+    return {'content': assistant.answer(message),
             'sender': "Assistant",
-            'timestamp': str(datetime.now()),
+            'timestamp': now_timestamp(),
             'extra': "",
             }
 
 
+# the channel of this deployment at the root, further channels under their prefix (see CHANNELS_FILE)
+for hosted in [HostedChannel(CHANNEL_NAME, CHANNEL_AUTHKEY, CHANNEL_ENDPOINT, CHANNEL_STORE, legacy_file=CHANNEL_FILE)] \
+        + load_hosted_channels(CHANNELS_FILE):
+    key = 'channel' + re.sub(r'\W', '_', hosted.prefix)
+    if key in channels:
+        raise ValueError("Channel prefix %s is used twice" % hosted.prefix)
+    channels[key] = hosted
+    app.register_blueprint(channel_routes, url_prefix=hosted.prefix or None, name=key)
+
+
+def warm_up() -> dict:
+    """
+    Creates everything the first requests of a worker would otherwise wait for: the LLM client (with its connection
+    pool), the profanity matcher, the store connection and the serialized message list of every channel.
+    Called by channel.wsgi before the worker takes traffic.
+    :return: seconds every step took
+    """
+    durations = services.warm_up()
+    start = time.perf_counter()
+    profanity_filter.matcher()
+    durations['profanity'] = round(time.perf_counter() - start, 3)
+    start = time.perf_counter()
+    for channel in channels.values():
+        channel.history_cache.get()
+    durations['history'] = round(time.perf_counter() - start, 3)
+    return durations
+
+
+@app.cli.command('warm_up')
+def warm_up_command() -> None:
+    """
+    Runs the warm-up once and prints how long every step took.
+    """
+    for step, seconds in warm_up().items():
+        print("%s: %.3fs" % (step, seconds))
+
+
 import traceback
 
 
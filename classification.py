@@ -0,0 +1,326 @@
+## classification.py - cached topic classification of channel messages
+
+import hashlib
+import json
+import math
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from project_three.metrics import registry
+from project_three.sqlite_connections import ThreadConnections
+
+CLASSIFY_SECONDS = registry.histogram('classification_seconds',
+                                      "Duration of the topic check, by the tier that decided")
+LLM_SECONDS = registry.histogram('classification_llm_seconds', "Duration of the LLM calls of the topic check")
+
+
+def normalize(message: str) -> str:
+    """
+    Normalizes a message so that near-identical messages ("Hi!!", "hi") share one cache entry.
+    :param message: the content of a message
+    :return: lowercase message without punctuation and repeated whitespace
+    """
+    return ' '.join(re.sub(r'[^\w\s]', ' ', message.lower()).split())
+
+
+def cache_key(message: str) -> str:
+    """
+    :param message: the content of a message
+    :return: hash of the normalized message
+    """
+    return hashlib.sha256(normalize(message).encode('utf-8')).hexdigest()
+
+
+class ClassificationCache(object):
+    """
+    LRU cache (with ttl) for the results of the LLM topic check. Results can optionally be persisted in a SQLite file,
+    so they survive restarts and are shared by all workers. Concurrent requests for the same message only cause one
+    LLM call: the other requests wait for its result.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 7 * 24 * 60 * 60, path: str = None):
+        """
+        :param max_size: maximum number of results kept in memory
+        :param ttl: seconds after which a result is classified again
+        :param path: optional SQLite file to persist the results in
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0  # requests that waited for the LLM call of another request
+        self._entries = OrderedDict()  # key -> (result, expiry time), least recently used first
+        self._inflight = {}  # key -> Event that is set once the result is available
+        self._lock = threading.Lock()
+        self._connections = ThreadConnections(path) if path else None
+        if path:
+            self._connections.get().execute('CREATE TABLE IF NOT EXISTS classifications ('
+                                            'key TEXT PRIMARY KEY, text TEXT NOT NULL, related INTEGER NOT NULL, '
+                                            'expires REAL NOT NULL)')
+
+    def get(self, key: str):
+        """
+        :param key: cache key of the message (see cache_key)
+        :return: the cached result or None
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > now:
+                self._entries.move_to_end(key)
+                return entry[0]
+        if self.path:
+            row = self._connections.get().execute('SELECT related, expires FROM classifications WHERE key = ?',
+                                                  (key,)).fetchone()
+            if row and row[1] > now:
+                self._remember(key, bool(row[0]), row[1])
+                return bool(row[0])
+        return None
+
+    def put(self, key: str, message: str, related: bool) -> None:
+        """
+        Stores a result in memory (and in the database if enabled).
+        :param key: cache key of the message
+        :param message: the message itself (the normalized text is kept in the database to train classifiers)
+        :param related: the result of the classification
+        """
+        expires = time.time() + self.ttl
+        self._remember(key, related, expires)
+        if self.path:
+            self._connections.get().execute('INSERT OR REPLACE INTO classifications (key, text, related, expires) '
+                                            'VALUES (?, ?, ?, ?)', (key, normalize(message), int(related), expires))
+
+    def _remember(self, key: str, related: bool, expires: float) -> None:
+        with self._lock:
+            self._entries[key] = (related, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, message: str, compute) -> bool:
+        """
+        Returns the cached result for message or computes it (only once, even if requested concurrently).
+        :param message: the content of a message
+        :param compute: function that classifies the message if it is not cached
+        :return: the result of the classification
+        """
+        key = cache_key(message)
+        result = self.get(key)
+        if result is not None:
+            with self._lock:
+                self.hits += 1
+            return result
+        with self._lock:
+            event = self._inflight.get(key)
+            owner = event is None
+            if owner:
+                event = self._inflight[key] = threading.Event()
+                self.misses += 1
+            else:
+                self.waits += 1
+        if not owner:
+            event.wait()
+            result = self.get(key)
+            if result is not None:
+                return result
+            # the other request failed, try ourselves
+            return compute(message)
+        try:
+            result = compute(message)
+            self.put(key, message, result)
+            return result
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            event.set()
+
+    def stats(self) -> dict:
+        """
+        :return: hit/miss counters, the hit rate and the number of cached results
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'waits': self.waits,
+                    'size': len(self._entries),
+                    'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+                    }
+
+
+# smalltalk between users is allowed (see PROFANITY_PROMPT), the rule tier accepts messages made only of these words
+SMALLTALK_WORDS = {'hi', 'hello', 'hey', 'hallo', 'moin', 'yo', 'sup', 'bye', 'ciao', 'thanks', 'thank', 'you',
+                   'ok', 'okay', 'yes', 'no', 'lol', 'haha', 'good', 'morning', 'evening', 'night', 'how', 'are',
+                   'guys', 'all', 'everyone', 'welcome', 'whats', 'up', 'what', 's', 'is', 'nice', 'cool'}
+
+
+def tokenize(message: str) -> list:
+    """
+    :param message: the content of a message
+    :return: the words of the normalized message
+    """
+    return normalize(message).split()
+
+
+def rule_classify(message: str):
+    """
+    Cheap rule for the only case that is obvious without context: short smalltalk. A topic word alone proves nothing
+    (anyone can append "truth" to spam), so everything else is left to the next tier.
+    :param message: the content of a message
+    :return: True if the message is smalltalk, None if unsure
+    """
+    words = tokenize(message)
+    if not words:
+        return None
+    if len(words) <= 6 and all(word in SMALLTALK_WORDS for word in words):
+        return True
+    return None
+
+
+class NaiveBayesClassifier(object):
+    """
+    Small multinomial naive Bayes model trained on messages that were labelled by the LLM before. It only decides
+    messages it knows most words of: spam with one known topic word appended is mostly unknown words.
+    """
+    MIN_KNOWN_WORDS = 2  # known words a message needs before the model scores it
+    MIN_KNOWN_SHARE = 0.75  # share of the words of a message the model has to know
+
+    def __init__(self, word_counts: dict = None, class_counts: dict = None):
+        """
+        :param word_counts: {'yes': {word: count}, 'no': {word: count}}
+        :param class_counts: {'yes': number of messages, 'no': number of messages}
+        """
+        self.word_counts = word_counts or {'yes': {}, 'no': {}}
+        self.class_counts = class_counts or {'yes': 0, 'no': 0}
+        self._prepare()
+
+    def _prepare(self) -> None:
+        self.vocabulary = set(self.word_counts['yes']) | set(self.word_counts['no'])
+        self.totals = {label: sum(counts.values()) for label, counts in self.word_counts.items()}
+
+    def train(self, examples) -> None:
+        """
+        :param examples: iterable of (message, related) pairs
+        """
+        for message, related in examples:
+            label = 'yes' if related else 'no'
+            self.class_counts[label] += 1
+            for word in tokenize(message):
+                self.word_counts[label][word] = self.word_counts[label].get(word, 0) + 1
+        self._prepare()
+
+    def probability(self, message: str):
+        """
+        :param message: the content of a message
+        :return: probability that the message is related to the topic, None if the model doesn't know enough of its
+        words (MIN_KNOWN_WORDS, MIN_KNOWN_SHARE)
+        """
+        tokens = tokenize(message)
+        words = [word for word in tokens if word in self.vocabulary]
+        if len(words) < self.MIN_KNOWN_WORDS or len(words) < self.MIN_KNOWN_SHARE * len(tokens):
+            return None
+        if not self.class_counts['yes'] or not self.class_counts['no']:
+            return None
+        scores = {}
+        for label in ('yes', 'no'):
+            score = math.log(self.class_counts[label] / (self.class_counts['yes'] + self.class_counts['no']))
+            for word in words:
+                # Laplace smoothing for words only seen in the other class
+                score += math.log((self.word_counts[label].get(word, 0) + 1) /
+                                  (self.totals[label] + len(self.vocabulary)))
+            scores[label] = score
+        return 1 / (1 + math.exp(min(scores['no'] - scores['yes'], 700)))
+
+    def save(self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump({'word_counts': self.word_counts, 'class_counts': self.class_counts}, f)
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        :param path: json file written by save
+        :return: the model or None if the file does not exist
+        """
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return cls(data['word_counts'], data['class_counts'])
+
+
+def training_examples(cache_path: str) -> list:
+    """
+    Collects the messages the LLM has labelled so far (stored by a persistent ClassificationCache).
+    :param cache_path: SQLite file of the classification cache
+    :return: list of (message, related) pairs
+    """
+    connection = sqlite3.connect(cache_path)
+    try:
+        return [(text, bool(related)) for text, related in
+                connection.execute('SELECT text, related FROM classifications')]
+    finally:
+        connection.close()
+
+
+class TieredClassifier(object):
+    """
+    Decides whether a message is related to the topic using the cheapest tier that is confident:
+    'rules' (smalltalk), 'model' (naive Bayes trained on earlier LLM answers) and finally 'llm' (cached LLM call).
+    """
+
+    def __init__(self, llm, cache: ClassificationCache, tiers=('rules', 'model', 'llm'), model=None,
+                 threshold: float = 0.9):
+        """
+        :param llm: function that asks the LLM whether a message is related to the topic
+        :param cache: cache for the LLM results
+        :param tiers: the tiers to use, in this order
+        :param model: the trained NaiveBayesClassifier (the model tier is skipped without one)
+        :param threshold: probability the model needs to decide on its own
+        """
+        self.llm = llm
+        self.cache = cache
+        self.tiers = tiers
+        self.model = model
+        self.threshold = threshold
+        self.decisions = {tier: 0 for tier in tiers}
+        self._lock = threading.Lock()
+
+    def classify(self, message: str) -> bool:
+        """
+        :param message: the content of a message
+        :return: True if the message is related to the topic (or smalltalk)
+        """
+        start = time.perf_counter()
+        for tier in self.tiers:
+            result = None
+            if tier == 'rules':
+                result = rule_classify(message)
+            elif tier == 'model' and self.model is not None:
+                probability = self.model.probability(message)
+                if probability is not None and probability >= self.threshold:
+                    result = True
+                elif probability is not None and probability <= 1 - self.threshold:
+                    result = False
+            elif tier == 'llm':
+                result = self.cache.get_or_compute(message, LLM_SECONDS.timed()(self.llm))
+            if result is not None:
+                with self._lock:
+                    self.decisions[tier] += 1
+                CLASSIFY_SECONDS.observe(time.perf_counter() - start, tier=tier)
+                return result
+        # no tier was confident (e.g. the llm tier is disabled): accept the message, like the LLM does when unsure
+        CLASSIFY_SECONDS.observe(time.perf_counter() - start, tier='none')
+        return True
+
+    def stats(self) -> dict:
+        """
+        :return: how many messages every tier decided and the counters of the LLM cache
+        """
+        with self._lock:
+            decisions = dict(self.decisions)
+        return {'decisions': decisions, 'cache': self.cache.stats()}
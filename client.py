@@ -2,41 +2,36 @@ from flask import Flask, request, render_template, url_for, redirect
 import requests
 import urllib.parse
 import datetime
+import os
+from project_three.hub_client import HubClient, HubError
+from project_three.metrics import instrument_app
 
 app = Flask(__name__)
+instrument_app(app)  # request timings on /metrics
 
 HUB_AUTHKEY = '1234567890'
-HUB_URL = 'http://localhost:5555'
+HUB_URL = os.environ.get('hub_url', 'http://localhost:5555')
 
-CHANNELS = None
-LAST_CHANNEL_UPDATE = None
+# one pooled session for the hub and all channels, the channel list is cached for 60 seconds
+hub = HubClient(HUB_URL, HUB_AUTHKEY, timeout=5, cache_ttl=60)
 
 
 def update_channels():
     """
-    TODO: What does this function do????
+    Returns the list of active channels (cached, see HubClient).
     :return: all channels
     """
-    global CHANNELS, LAST_CHANNEL_UPDATE
-    if CHANNELS and LAST_CHANNEL_UPDATE and (datetime.datetime.now() - LAST_CHANNEL_UPDATE).seconds < 60:
-        return CHANNELS
-    # fetch list of channels from server
-    response = requests.get(HUB_URL + '/channels', headers={'Authorization': 'authkey ' + HUB_AUTHKEY})
-    #return error message if needed
-    if response.status_code != 200:
-        return "Error fetching channels: "+str(response.text), 400
-    channels_response = response.json()
-    if not 'channels' in channels_response:
-        return "No channels in response", 400
-    CHANNELS = channels_response['channels']
-    LAST_CHANNEL_UPDATE = datetime.datetime.now()
-    return CHANNELS
+    return hub.channels()
 
 
 @app.route('/')
 def home_page():
     # fetch list of channels from server
-    return render_template("home.html", channels=update_channels())
+    try:
+        channels = update_channels()
+    except HubError as e:
+        return str(e), 502
+    return render_template("home.html", channels=channels)
 
 
 @app.route('/show')
@@ -50,14 +45,16 @@ def show_channel() -> (str, int):
     #handle possibly occuring errors
     if not show_channel:
         return "No channel specified", 400
-    channel = None
-    for c in update_channels():
-        if c['endpoint'] == urllib.parse.unquote(show_channel):
-            channel = c
-            break
+    try:
+        channel = hub.find_channel(urllib.parse.unquote(show_channel))
+    except HubError as e:
+        return str(e), 502
     if not channel:
         return "Channel not found", 404
-    response = requests.get(channel['endpoint'], headers={'Authorization': 'authkey ' + channel['authkey']})
+    try:
+        response = hub.get_messages(channel)
+    except requests.exceptions.RequestException as e:
+        return "Error fetching messages: " + str(e), 502
     if response.status_code != 200:
         return "Error fetching messages: "+str(response.text), 400
     messages = response.json()
@@ -68,27 +65,32 @@ def show_channel() -> (str, int):
 def post_message() -> (str, int):
     """
     Function to send a message to the channel.
-    :return: #TODO: check this: error message or a flask Response object
+    :return: error message or a redirect to the channel
     """
     post_channel = request.form['channel']
     #check for possible errors and return respective error message
     if not post_channel:
         return "No channel specified", 400
-    channel = None
-    for c in update_channels():
-        if c['endpoint'] == urllib.parse.unquote(post_channel):
-            channel = c
-            break
+    try:
+        channel = hub.find_channel(urllib.parse.unquote(post_channel))
+    except HubError as e:
+        return str(e), 502
     if not channel:
         return "Channel not found", 404
     #save relevant attributes of the message
     message_content = request.form['content']
     message_sender = request.form['sender']
     message_timestamp = datetime.datetime.now().isoformat()
-    response = requests.post(channel['endpoint'],
-                             headers={'Authorization': 'authkey ' + channel['authkey']},
-                             json={'content': message_content, 'sender': message_sender, 'timestamp': message_timestamp})
-    if response.status_code != 200:
+    try:
+        response = hub.post_message(channel, {'content': message_content, 'sender': message_sender,
+                                              'timestamp': message_timestamp})
+    except requests.exceptions.RequestException as e:
+        return "Error posting message: " + str(e), 502
+    # channels answer with 200 or with 202 if the message is moderated in the background
+    if response.status_code == 429:
+        # the sender posted too much, the channel says when to try again
+        return "Error posting message: "+str(response.text), 429, {'Retry-After': response.headers.get('Retry-After', '60')}
+    if not response.ok:
         return "Error posting message: "+str(response.text), 400
     return redirect(url_for('show_channel')+'?channel='+urllib.parse.quote(post_channel))
 
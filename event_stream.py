@@ -0,0 +1,327 @@
+## event_stream.py - server-sent events and long-polls of all hosted channels on one event loop thread
+
+import json
+import socket
+import threading
+from urllib.parse import parse_qsl, urlsplit
+
+WRITE_BUFFER_LIMIT = 1 << 20  # bytes a stream may lag behind, slower clients are disconnected (they reconnect)
+REQUEST_TIMEOUT = 10  # seconds a client has to send its request
+STATUS = {200: '200 OK', 204: '204 No Content', 400: '400 Bad Request', 404: '404 Not Found',
+          405: '405 Method Not Allowed'}
+# the streams are on another port than the channel, so every response allows cross-origin requests
+CORS_HEADERS = {'Access-Control-Allow-Origin': '*'}
+PREFLIGHT_HEADERS = {'Access-Control-Allow-Origin': '*', 'Access-Control-Allow-Methods': 'GET',
+                     'Access-Control-Allow-Headers': 'Authorization, Last-Event-ID', 'Access-Control-Max-Age': '86400'}
+
+
+def message_event(message) -> bytes:
+    """
+    :param message: a stored message
+    :return: the event that sends the message to a stream (its id is the cursor the browser reconnects with)
+    """
+    return ("id: %d\ndata: %s\n\n" % (message['id'], json.dumps(message))).encode('utf-8')
+
+
+def update_event(message) -> bytes:
+    """
+    :param message: an answer of the assistant that was sent before and changed since
+    :return: the 'update' event that replaces the message on the client
+    """
+    return ("event: update\ndata: %s\n\n" % json.dumps(message)).encode('utf-8')
+
+
+def respond(writer, status: int, body: bytes, content_type: str = 'text/plain; charset=utf-8',
+            headers: dict = CORS_HEADERS) -> None:
+    """
+    Writes a complete response, the connection is closed afterwards.
+    :param writer: the stream writer of the connection
+    :param status: the status code
+    :param body: the body
+    :param content_type: the content type of the body
+    :param headers: further headers
+    """
+    head = ['HTTP/1.1 ' + STATUS[status], 'Content-Type: ' + content_type, 'Content-Length: %d' % len(body),
+            'Connection: close'] + ['%s: %s' % header for header in headers.items()]
+    writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+
+
+def parse_request(head: bytes) -> tuple:
+    """
+    :param head: the request line and headers up to the empty line
+    :return: (method, path, query parameters, headers with lowercase names)
+    """
+    lines = head.decode('latin-1').split('\r\n')
+    method, target, _ = lines[0].split(' ')
+    headers = {}
+    for line in lines[1:]:
+        if line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    url = urlsplit(target)
+    return method, url.path, dict(parse_qsl(url.query)), headers
+
+
+class ChannelFeed(object):
+    """
+    The open streams and waiting long-polls of one channel. New messages are read from the store once and written to
+    all streams; answers of the assistant that are still being generated are followed and sent again as 'update'
+    events while they grow. Only used by the event loop thread.
+    """
+
+    def __init__(self, channel, page_size: int):
+        """
+        :param channel: the hosted channel
+        :param page_size: maximum number of messages read from the store at once
+        """
+        self.channel = channel
+        self.store = channel.store
+        self.page_size = page_size
+        self.cursor = None  # id of the newest message sent to the streams, None while nobody is listening
+        self.following = {}  # answers that are still being generated: id -> content the streams have
+        self.streams = set()
+        self.waiters = {}  # futures of the waiting long-polls -> their cursor
+        self.scheduled = False
+
+    def advance(self) -> None:
+        """
+        Sends the new messages and the changed answers to all streams and finishes the long-polls whose cursor was
+        passed. Called whenever the store changed.
+        """
+        self.scheduled = False
+        if not self.streams and not self.waiters:
+            # nobody is listening, the next client starts at the then newest message
+            self.cursor, self.following = None, {}
+            return
+        if self.cursor is None:
+            self.start()
+        while True:
+            messages = self.store.read_page(since=self.cursor, limit=self.page_size)
+            for message in messages:
+                self.cursor = message['id']
+                if message.get('streaming'):
+                    self.following[self.cursor] = message['content']
+                self.send(message_event(message))
+            if len(messages) < self.page_size:
+                break
+        for message_id, content in list(self.following.items()):
+            message = self.store.get_message(message_id)
+            if message and (message['content'] != content or not message.get('streaming')):
+                self.send(update_event(message))
+            if message and message.get('streaming'):
+                self.following[message_id] = message['content']
+            else:
+                del self.following[message_id]
+        for future, since in list(self.waiters.items()):
+            if since < self.cursor and not future.done():
+                future.set_result(None)
+
+    def start(self) -> None:
+        """
+        Starts the feed at the newest message, following the answers that are being generated right now.
+        """
+        self.cursor = self.store.last_id()
+        self.following = {message['id']: message['content'] for message in self.store.streaming_messages()}
+
+    def sync(self) -> None:
+        """
+        Brings the feed up to date before a client joins (or starts it if nobody was listening).
+        """
+        if self.cursor is not None:
+            self.advance()
+        if self.cursor is None:
+            self.start()
+
+    def send(self, data: bytes) -> None:
+        """
+        Writes data to all streams (without waiting for it to be sent).
+        :param data: one or more events
+        """
+        for writer in list(self.streams):
+            if writer.transport.get_write_buffer_size() > WRITE_BUFFER_LIMIT:
+                # the browser reconnects with the id of the last message it received
+                self.streams.discard(writer)
+                writer.transport.abort()
+            else:
+                writer.write(data)
+
+
+class EventStreamServer(object):
+    """
+    Server-sent events (/stream) and long-polls (/wait) without a thread per client: one event loop thread accepts the
+    connections for all hosted channels on its own port and keeps them open as sockets, only new messages cost work.
+    Only one process of a machine can listen on the port, the workers of the channel redirect their clients to it.
+    """
+
+    def __init__(self, channels, port: int, host: str = '', keepalive: float = 15, duration: float = 300,
+                 max_wait: float = 30, default_page_size: int = 100, max_page_size: int = 1000):
+        """
+        :param channels: function returning the hosted channels by name (with prefix, authkey, store and broadcaster)
+        :param port: the port to listen on
+        :param host: the address to listen on ('' for all)
+        :param keepalive: seconds between two keep-alive comments on the streams
+        :param duration: seconds after which a stream is closed (the browser reconnects automatically)
+        :param max_wait: maximum number of seconds a long-poll waits for new messages
+        :param default_page_size: number of messages returned by a long-poll without ?limit=
+        :param max_page_size: maximum number of messages returned by a long-poll (and read from the store at once)
+        """
+        self.channels = channels
+        self.port = port
+        self.host = host
+        self.keepalive = keepalive
+        self.duration = duration
+        self.max_wait = max_wait
+        self.default_page_size = default_page_size
+        self.max_page_size = max_page_size
+        self._lock = threading.Lock()
+        self._loop = None
+        self._feeds = {}  # ChannelFeed by prefix of the channel
+
+    def start(self) -> bool:
+        """
+        Starts listening unless this process already does. Safe to call on every request.
+        :return: True if this process serves the streams, False if the port is taken (by another worker)
+        """
+        if self._loop is not None:
+            return True
+        with self._lock:
+            if self._loop is not None:
+                return True
+            try:
+                sock = socket.create_server((self.host, self.port), backlog=1024)
+            except OSError:
+                return False
+            # only the worker that serves the streams needs asyncio, it's not imported with the channel
+            import asyncio
+            loop = asyncio.new_event_loop()
+            for name, channel in self.channels().items():
+                feed = ChannelFeed(channel, self.max_page_size)
+                self._feeds[channel.prefix] = (name, feed)
+                channel.broadcaster.add_listener(lambda feed=feed: loop.call_soon_threadsafe(self._changed, feed))
+            self._loop = loop
+            threading.Thread(target=self._run, args=(sock,), name='event-streams', daemon=True).start()
+        return True
+
+    def stats(self) -> dict:
+        """
+        :return: number of open streams and waiting long-polls per channel
+        """
+        return {name: {'streams': len(feed.streams), 'waiting': len(feed.waiters)}
+                for name, feed in list(self._feeds.values())}
+
+    def _changed(self, feed: ChannelFeed) -> None:
+        # several writes in a row are sent at once
+        if not feed.scheduled:
+            feed.scheduled = True
+            self._loop.call_soon(feed.advance)
+
+    def _run(self, sock) -> None:
+        import asyncio
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(asyncio.start_server(self._handle, sock=sock))
+        self._loop.create_task(self._keep_alive())
+        self._loop.run_forever()
+
+    async def _keep_alive(self) -> None:
+        import asyncio
+        while True:
+            await asyncio.sleep(self.keepalive)
+            for _, feed in self._feeds.values():
+                feed.send(b": keep-alive\n\n")
+
+    async def _handle(self, reader, writer) -> None:
+        import asyncio
+        try:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), REQUEST_TIMEOUT)
+                method, path, args, headers = parse_request(head)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError,
+                    ValueError):
+                return
+            if method == 'OPTIONS':
+                respond(writer, 204, b'', headers=PREFLIGHT_HEADERS)
+                return
+            if method != 'GET':
+                respond(writer, 405, b'Method not allowed')
+                return
+            prefix, _, route = path.rpartition('/')
+            _, feed = self._feeds.get(prefix, (None, None))
+            if feed is None or route not in ('stream', 'wait'):
+                respond(writer, 404, b'Not found')
+                return
+            # browsers can't set headers for an EventSource, so the authkey may also be passed as ?authkey=
+            authkey = feed.channel.authkey
+            if headers.get('authorization') != 'authkey ' + authkey and args.get('authkey') != authkey:
+                respond(writer, 400, b'Invalid authorization')
+                return
+            if route == 'stream':
+                await self._stream(feed, reader, writer, headers.get('last-event-id', args.get('since', '')))
+            else:
+                await self._wait(feed, writer, args)
+        except Exception as e:
+            print(f"Event stream failed: {e}")
+        finally:
+            writer.close()
+
+    async def _stream(self, feed: ChannelFeed, reader, writer, cursor: str) -> None:
+        import asyncio
+        writer.write(('HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n'
+                      'X-Accel-Buffering: no\r\nConnection: close\r\nAccess-Control-Allow-Origin: *\r\n\r\n'
+                      'retry: 2000\n\n').encode('latin-1'))
+        # a reconnecting EventSource tells us the id of the last message it received
+        since = int(cursor) if cursor.isdigit() else None
+        # the messages the client missed are sent page by page, as fast as it reads them
+        while True:
+            feed.sync()
+            if since is None:
+                since = feed.cursor
+            messages = [message for message in feed.store.read_page(since=since, limit=feed.page_size)
+                        if message['id'] <= feed.cursor] if since < feed.cursor else []
+            if not messages:
+                break
+            for message in messages:
+                writer.write(message_event(message))
+            since = messages[-1]['id']
+            await writer.drain()
+        # from now on the client gets what all streams get, answers that are still being generated are sent as they
+        # are now (the client may have an older version of them or none at all)
+        for message_id in feed.following:
+            message = feed.store.get_message(message_id)
+            if message:
+                writer.write(update_event(message))
+        feed.streams.add(writer)
+        try:
+            # clients don't send anything, this returns when they go away
+            await asyncio.wait_for(reader.read(), self.duration)
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            feed.streams.discard(writer)
+
+    async def _wait(self, feed: ChannelFeed, writer, args: dict) -> None:
+        import asyncio
+        try:
+            since = int(args['since'])
+            timeout = min(float(args.get('timeout', self.max_wait)), self.max_wait)
+            limit = min(int(args.get('limit', self.default_page_size)), self.max_page_size)
+        except (KeyError, ValueError):
+            respond(writer, 400, b'Invalid cursor')
+            return
+        if limit < 1:
+            respond(writer, 400, b'Invalid limit')
+            return
+        future = self._loop.create_future()
+        feed.waiters[future] = since
+        try:
+            feed.advance()
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            del feed.waiters[future]
+        messages = feed.store.read_page(since=since, limit=limit)
+        next_cursor = messages[-1]['id'] if messages else since
+        body = json.dumps({'has_more': len(messages) == limit, 'messages': messages, 'next_cursor': next_cursor},
+                          sort_keys=True)
+        respond(writer, 200, body.encode('utf-8') + b'\n', content_type='application/json')
+        await writer.drain()
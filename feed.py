@@ -0,0 +1,113 @@
+## feed.py - merged feed of the newest messages of all active channels (used by the hub)
+
+import heapq
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from project_three.health import make_session
+from project_three.metrics import registry
+from project_three.timestamps import parse_timestamp
+
+FEED_SECONDS = registry.histogram('feed_seconds', "Duration of building the merged feed of all channels")
+FEED_FETCHES = registry.counter('feed_channel_fetches_total',
+                                "Messages of a channel needed for the feed by result (cached, fetched, failed)")
+
+
+class ChannelFeed(object):
+    """
+    Fetches the newest messages of many channels in a thread pool (every request with a timeout) and merges them by
+    timestamp. The messages of every channel are cached for a few seconds, so a dashboard that is reloaded doesn't
+    ask every channel again; channels that failed are not asked again until their entry expires either.
+    """
+
+    def __init__(self, workers: int = 16, timeout: float = 3, ttl: float = 10, fetch_limit: int = 100):
+        """
+        :param workers: number of channels fetched at the same time
+        :param timeout: seconds to wait for one channel
+        :param ttl: seconds the messages of a channel are cached
+        :param fetch_limit: number of newest messages fetched per channel
+        """
+        self.workers = workers
+        self.timeout = timeout
+        self.ttl = ttl
+        self.fetch_limit = fetch_limit
+        self.session = make_session(workers)
+        self._cache = {}  # endpoint -> (expiry time, messages or None, error or None)
+        self._lock = threading.Lock()
+
+    def fetch(self, endpoint: str, authkey: str) -> tuple:
+        """
+        :param endpoint: the endpoint of the channel
+        :param authkey: the authkey of the channel
+        :return: (the newest messages of the channel or None, error message or None), from the cache if it is fresh
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(endpoint)
+        if entry is not None and entry[0] > now:
+            FEED_FETCHES.inc(result='cached')
+            return entry[1], entry[2]
+        messages, error = None, None
+        try:
+            response = self.session.get(endpoint, params={'limit': self.fetch_limit},
+                                        headers={'Authorization': 'authkey ' + authkey}, timeout=self.timeout)
+            if response.status_code != 200:
+                raise ValueError("status %d" % response.status_code)
+            data = response.json()
+            # channels without cursor support ignore ?limit= and return their whole history as a list
+            messages = data['messages'] if isinstance(data, dict) else data[-self.fetch_limit:]
+            if not isinstance(messages, list):
+                raise ValueError("no messages")
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as e:
+            messages, error = None, str(e)
+        FEED_FETCHES.inc(result='failed' if error else 'fetched')
+        with self._lock:
+            self._cache[endpoint] = (time.monotonic() + self.ttl, messages, error)
+            # entries of channels that were removed don't stay forever
+            if len(self._cache) > 10000:
+                self._cache = {key: value for key, value in self._cache.items() if value[0] > now}
+        return messages, error
+
+    def latest(self, channels: list, limit: int = 50, q: str = None, sender: str = None) -> dict:
+        """
+        The newest messages of all channels, newest first.
+        :param channels: list of dicts with id, name, endpoint and authkey
+        :param limit: maximum number of messages
+        :param q: only messages containing this text (case-insensitive)
+        :param sender: only messages of this sender
+        :return: dict with the messages (every one with the id, name and endpoint of its channel), the number of
+        channels and the channels that could not be fetched
+        """
+        start = time.perf_counter()
+
+        def run(channel):
+            return channel, self.fetch(channel['endpoint'], channel['authkey'])
+
+        results = []
+        if channels:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(channels))) as executor:
+                results = list(executor.map(run, channels))
+        q = q.lower() if q else None
+        candidates, errors = [], []
+        for channel, (messages, error) in results:
+            if error is not None:
+                errors.append({'id': channel['id'], 'endpoint': channel['endpoint'], 'error': error})
+                continue
+            origin = {'id': channel['id'], 'name': channel['name'], 'endpoint': channel['endpoint']}
+            for message in messages:
+                if not isinstance(message, dict):
+                    continue
+                if sender is not None and message.get('sender') != sender:
+                    continue
+                if q is not None and q not in str(message.get('content', '')).lower():
+                    continue
+                candidates.append((parse_timestamp(message.get('timestamp')) or 0, message, origin))
+        newest = heapq.nlargest(limit, candidates, key=lambda candidate: candidate[0])
+        FEED_SECONDS.observe(time.perf_counter() - start)
+        return {'messages': [dict(message, channel=origin) for _, message, origin in newest],
+                'channels': len(channels),
+                'errors': errors,
+                }
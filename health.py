@@ -0,0 +1,148 @@
+## health.py - concurrent health checks of channels (used by the hub)
+
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from project_three.metrics import registry
+
+HEALTH_SECONDS = registry.histogram('health_check_seconds', "Duration of the health checks of channels")
+
+
+def make_session(pool_size: int = 16) -> requests.Session:
+    """
+    Creates a session that keeps connections to the channels open, so repeated checks don't reconnect every time.
+    :param pool_size: maximum number of connections kept per host
+    :return: the session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def check_health(session: requests.Session, endpoint: str, authkey: str, timeout: float):
+    """
+    Calls the /health endpoint of a channel.
+    :param session: the session to send the request with
+    :param endpoint: the endpoint of the channel
+    :param authkey: the authkey of the channel
+    :param timeout: seconds to wait for the channel
+    :return: the name the channel reports, None if the channel is not healthy
+    """
+    start = time.perf_counter()
+    name = None
+    try:
+        response = session.get(endpoint + '/health', headers={'Authorization': 'authkey ' + authkey},
+                               timeout=timeout)
+        if response.status_code == 200:
+            # check if response is JSON with {"name": <channel_name>}
+            name = response.json().get('name')
+    except (requests.exceptions.RequestException, ValueError, AttributeError) as e:
+        print(f"Error: {e}")
+    HEALTH_SECONDS.observe(time.perf_counter() - start, healthy=name is not None)
+    return name
+
+
+class HealthChecker(object):
+    """
+    Checks many channels at once in a thread pool. The checks are spread over a short random delay (jitter) so the hub
+    doesn't hit all channels in the same moment, and every check has a timeout, so a sweep takes about as long as the
+    slowest channel instead of the sum of all of them.
+    """
+
+    def __init__(self, workers: int = 16, timeout: float = 5, jitter: float = 0.5, base_backoff: float = 60,
+                 max_backoff: float = 3600):
+        """
+        :param workers: number of checks running at the same time
+        :param timeout: seconds to wait for one channel
+        :param jitter: maximum random delay in seconds before a check starts
+        :param base_backoff: seconds to wait before checking a channel again after its first failure
+        :param max_backoff: maximum seconds between two checks of a failing channel
+        """
+        self.workers = workers
+        self.timeout = timeout
+        self.jitter = jitter
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.session = make_session(workers)
+
+    def check(self, endpoint: str, authkey: str):
+        """
+        :return: the name the channel reports, None if it is not healthy
+        """
+        return check_health(self.session, endpoint, authkey, self.timeout)
+
+    def check_all(self, channels: list) -> dict:
+        """
+        Checks all channels concurrently. Only does the HTTP requests, updating the database is up to the caller.
+        :param channels: list of (key, endpoint, authkey)
+        :return: dict key -> reported name (None if the channel is not healthy)
+        """
+        def run(channel):
+            key, endpoint, authkey = channel
+            time.sleep(random.uniform(0, self.jitter))
+            return key, self.check(endpoint, authkey)
+
+        if not channels:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(channels))) as executor:
+            return dict(executor.map(run, channels))
+
+    def backoff(self, failures: int) -> timedelta:
+        """
+        Exponential backoff for failing channels (with some jitter, so they don't all come back at the same time).
+        :param failures: number of failed checks in a row
+        :return: time until the channel should be checked again
+        """
+        seconds = min(self.base_backoff * 2 ** max(failures - 1, 0), self.max_backoff)
+        return timedelta(seconds=seconds * random.uniform(0.9, 1.1))
+
+
+class BackgroundVerifier(object):
+    """
+    Runs health checks of newly registered channels in background threads, so the registration request doesn't have
+    to wait for the channel.
+    """
+
+    def __init__(self, checker: HealthChecker, on_result, workers: int = 2):
+        """
+        :param checker: the health checker
+        :param on_result: function called with (key, reported name or None) after every check (in a worker thread)
+        :param workers: number of worker threads
+        """
+        self.checker = checker
+        self.on_result = on_result
+        self.workers = workers
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, key, endpoint: str, authkey: str) -> None:
+        """
+        Queues a health check.
+        :param key: passed to on_result to identify the channel
+        :param endpoint: the endpoint of the channel
+        :param authkey: the authkey of the channel
+        """
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name='verifier', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        self._queue.put((key, endpoint, authkey))
+
+    def _run(self) -> None:
+        while True:
+            key, endpoint, authkey = self._queue.get()
+            try:
+                self.on_result(key, self.checker.check(endpoint, authkey))
+            except Exception as e:
+                print(f"Verifying channel {endpoint} failed: {e}")
@@ -0,0 +1,446 @@
+## history_cache.py - serialized message list of a channel, extended by the new messages when the messages change
+
+import bisect
+import glob
+import io
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+from array import array
+from datetime import datetime, timezone
+
+from project_three.message_store import MessageStore
+from project_three.metrics import registry
+
+HISTORY_REQUESTS = registry.counter('history_cache_requests_total',
+                                    "Full message list requests by cache result (hit, miss, shared)")
+HISTORY_BUILDS = registry.counter('history_cache_builds_total',
+                                  "Builds of the message list by kind (append: only the newest segments are written, "
+                                  "full: all messages are written again)")
+CHUNK_SIZE = 64 * 1024  # bytes per chunk when a response is streamed from a segment file
+# history-<revision>-<key>.list lists the segments of a revision, history-<revision>-<key>-<after>.* is the segment
+# written at that revision with the messages after the id <after>
+SEGMENT_NAME = re.compile(r'history-(\d+)-([0-9a-f]+-[0-9a-f]{8})(-\d+)?\.')
+# gzip header without name and time, followed by the deflated parts of the body and the trailer
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+
+def _map(path: str):
+    """
+    :return: the file mapped read-only into memory (b'' for an empty file, those can't be mapped)
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _deflate(data, level: int, final: bool = False) -> bytes:
+    """
+    :return: data as raw deflate blocks that end on a byte boundary, so they can be put after each other (the final
+    part ends the stream)
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = [compressor.compress(data[start:start + CHUNK_SIZE]) for start in range(0, len(data), CHUNK_SIZE)]
+    deflated.append(compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH))
+    return b''.join(deflated)
+
+
+class Segment(object):
+    """
+    Messages with consecutive ids as one piece of the body (',' message for every message), indexed by ids and
+    offsets, so pages can be cut out of it without parsing it. A segment never changes once it is written; it is kept
+    in memory or in a memory-mapped file that all workers share.
+    """
+
+    def __init__(self, name: str, body, ids, offsets, crc: int, streaming: bool, path: str = None):
+        """
+        :param name: name of the segment (its files are named after it)
+        :param body: the messages as bytes or mmap
+        :param ids: ids of the messages (sorted)
+        :param offsets: position of the comma before every message in the body
+        :param crc: CRC-32 of the serialized list up to the end of this segment (for the gzip trailer)
+        :param streaming: True if it contains messages that are still being generated (the next build replaces it)
+        :param path: file of the body, None if it is kept in memory
+        """
+        self.name = name
+        self.body = body
+        self.ids = ids
+        self.offsets = offsets
+        self.crc = crc
+        self.streaming = streaming
+        self.path = path
+        self._deflated = None
+        self._lock = threading.Lock()
+
+    def deflated(self, level: int):
+        """
+        :return: the body as raw deflate blocks (bytes or mmap), compressed the first time a client asks for it
+        """
+        with self._lock:
+            if self._deflated is None:
+                if self.path is None:
+                    self._deflated = _deflate(self.body, level)
+                else:
+                    self._deflated = self._deflate_file(level)
+            return self._deflated
+
+    def _deflate_file(self, level: int):
+        # compressed into a file of its own, so all workers share it; older segments are only compressed once
+        path = self.path + '.deflate'
+        try:
+            return _map(path)
+        except FileNotFoundError:
+            pass
+        temporary = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(temporary, 'wb') as f:
+            f.write(_deflate(self.body, level))
+        os.replace(temporary, path)
+        return _map(path)
+
+
+class SerializedHistory(object):
+    """
+    The serialized message list of one history revision of the store: '[' welcome message, the messages of all
+    segments, ']'. Its gzip version is put together from the compressed segments, so a new revision only compresses
+    the segments that are new.
+    """
+
+    def __init__(self, revision: int, head: bytes, segments: list, last_modified: datetime, gzip_level: int,
+                 key: str = ''):
+        """
+        :param revision: history revision of the store the list belongs to
+        :param head: '[' and the welcome message
+        :param segments: the segments with the messages, in the order of their ids
+        :param last_modified: time of the revision
+        :param gzip_level: compression level of the gzip version
+        :param key: identity of the store and the welcome message (part of the ETag, revisions of another store or
+        welcome message are other lists)
+        """
+        self.revision = revision
+        self.head = head
+        self.segments = segments
+        self.last_modified = last_modified
+        # the position of the first message of every segment in the list, and its id
+        self._starts = [0]
+        for segment in segments:
+            self._starts.append(self._starts[-1] + len(segment.ids))
+        self._first_ids = [segment.ids[0] for segment in segments]
+        self._length = len(head) + sum(len(segment.body) for segment in segments) + 1
+        self._crc = zlib.crc32(b']', segments[-1].crc if segments else zlib.crc32(head))
+        self.etag = 'history-%s-%d-%d' % (key, revision, self._length)
+        self._gzip_level = gzip_level
+        self._gzip_parts = None
+        self._lock = threading.Lock()
+
+    def _compressed(self) -> list:
+        # the deflated parts of the gzip version, between header and trailer
+        with self._lock:
+            if self._gzip_parts is None:
+                self._gzip_parts = ([_deflate(self.head, self._gzip_level)]
+                                    + [segment.deflated(self._gzip_level) for segment in self.segments]
+                                    + [_deflate(b']', self._gzip_level, final=True)])
+            return self._gzip_parts
+
+    def chunks(self, compressed: bool = False):
+        """
+        :param compressed: iterate over the gzip version
+        :return: iterator over the body in chunks of at most CHUNK_SIZE bytes (for streaming responses)
+        """
+        if compressed:
+            parts = [GZIP_HEADER] + self._compressed() + [struct.pack('<II', self._crc, self._length & 0xffffffff)]
+        else:
+            parts = [self.head] + [segment.body for segment in self.segments] + [b']']
+        for part in parts:
+            for start in range(0, len(part), CHUNK_SIZE):
+                yield part[start:start + CHUNK_SIZE]
+
+    def length(self, compressed: bool = False) -> int:
+        if compressed:
+            return len(GZIP_HEADER) + sum(len(part) for part in self._compressed()) + 8
+        return self._length
+
+    def _position(self, message_id: int, after: bool) -> int:
+        # number of messages in the list with a smaller id (after=False) or a smaller or equal id (after=True)
+        index = bisect.bisect_right(self._first_ids, message_id) - 1
+        if index < 0:
+            return 0
+        ids = self.segments[index].ids
+        return self._starts[index] + (bisect.bisect_right(ids, message_id) if after
+                                      else bisect.bisect_left(ids, message_id))
+
+    def page(self, since: int = None, before: int = None, limit: int = 100) -> tuple:
+        """
+        Cuts a page out of the segments, with the same semantics as MessageStore.read_page.
+        :param since: only messages with a bigger id (the oldest of them first)
+        :param before: only messages with a smaller id (the newest of them)
+        :param limit: maximum number of messages
+        :return: (the messages as json array, their ids)
+        """
+        first = 0 if since is None else self._position(since, after=True)
+        end = self._starts[-1] if before is None else self._position(before, after=False)
+        if since is not None:
+            end = min(end, first + limit)
+        else:
+            first = max(first, end - limit)
+        if first >= end:
+            return b'[]', []
+        pieces, ids = [], []
+        for index in range(bisect.bisect_right(self._starts, first) - 1, len(self.segments)):
+            start = self._starts[index]
+            if start >= end:
+                break
+            segment = self.segments[index]
+            low, high = max(first - start, 0), min(end - start, len(segment.ids))
+            stop = segment.offsets[high] if high < len(segment.ids) else len(segment.body)
+            # every message is preceded by a comma
+            pieces.append(segment.body[segment.offsets[low]:stop])
+            ids.extend(segment.ids[low:high])
+        return b'[' + b''.join(pieces)[1:] + b']', ids
+
+
+class HistoryCache(object):
+    """
+    Most requests for the full message list come from pollers that get the same bytes every time, so the list is only
+    built again after the history revision of the store changed (new, finished or deleted messages; answers that are
+    still being generated are followed through /messages/<id>). Checking the revision is a single query, and clients
+    that send the ETag of the current revision get a 304.
+
+    The list consists of segments that never change: a new revision only writes the messages that are new (together
+    with the newest segments if they are small or contain unfinished answers), so the segments double in size towards
+    the beginning and there are only a few of them. Everything is written again only after the store changed messages
+    that were already serialized (the compaction). The messages are serialized by the store and written straight into
+    the segments, they never exist as python objects. With a segment directory the segments are files that are
+    memory-mapped: the pages are shared by all workers (the first one to see a revision writes the new segment and the
+    list of segments of the revision, the others map them) and are not on the python heap.
+    """
+
+    def __init__(self, store: MessageStore, header: bytes, gzip_level: int = 6, segment_dir: str = None):
+        """
+        :param store: the message store
+        :param header: serialized first entry of the list (the welcome message)
+        :param gzip_level: compression level of the gzip version
+        :param segment_dir: directory for the segment files, None to keep the segments in memory
+        """
+        self.store = store
+        self.head = b'[' + header
+        self.gzip_level = gzip_level
+        self.segment_dir = segment_dir
+        # the segment files of another store (e.g. a recreated database that counts its revisions from 0 again) or
+        # another welcome message don't fit, so both are part of their names and of the ETags
+        self._segment_key = '%s-%08x' % (store.identity(), zlib.crc32(header))
+        self._current = None
+        self._lock = threading.Lock()
+        if segment_dir:
+            os.makedirs(segment_dir, exist_ok=True)
+
+    def get(self) -> SerializedHistory:
+        """
+        :return: the serialized message list of the current history revision (built once per revision, concurrent
+        requests wait for the same build)
+        """
+        revision = self.store.history_revision()
+        current = self._current
+        if current is not None and current.revision == revision:
+            HISTORY_REQUESTS.inc(cache='hit')
+            return current
+        with self._lock:
+            current = self._current
+            if current is None or current.revision != revision:
+                # another worker may have written the segments of the current revision already
+                revision = self.store.history_revision()
+                history = self._open(revision, current) if self.segment_dir else None
+                HISTORY_REQUESTS.inc(cache='miss' if history is None else 'shared')
+                current = self._current = history or self._build(current)
+            else:
+                HISTORY_REQUESTS.inc(cache='hit')
+            return current
+
+    def fresh(self):
+        """
+        :return: the cached message list if it belongs to the current history revision, else None (doesn't build it)
+        """
+        current = self._current
+        if current is not None and current.revision == self.store.history_revision():
+            return current
+        return None
+
+    def _last_modified(self, previous: SerializedHistory) -> int:
+        # every revision gets a later Last-Modified (whole seconds, as in the header) than the one before
+        modified = math.ceil(time.time())
+        if previous is not None:
+            modified = max(modified, int(previous.last_modified.timestamp()) + 1)
+        return modified
+
+    def _reusable(self, previous: SerializedHistory) -> list:
+        """
+        :return: the segments of previous that the next revision keeps: all but the newest ones that contain unfinished
+        answers or are not bigger than the messages written after them
+        """
+        segments = list(previous.segments) if previous is not None else []
+        written = self.store.last_id() - (segments[-1].ids[-1] if segments else 0)
+        while segments:
+            segment = segments[-1]
+            size = segment.ids[-1] - segment.ids[0] + 1
+            if not segment.streaming and size > written:
+                break
+            written += size
+            segments.pop()
+        return segments
+
+    def _write(self, out, batches, crc: int) -> tuple:
+        """
+        Writes ',' message for every message to out.
+        :param batches: the serialized messages (see MessageStore.serialized_snapshot)
+        :param crc: CRC-32 of the list before these messages
+        :return: (ids, offsets, CRC-32 of the list up to the end of these messages, True if some of them are still
+        being generated)
+        """
+        ids, offsets = array('q'), array('Q')
+        position, streaming = 0, 0
+        for batch_ids, sizes, messages, batch_streaming in batches:
+            for size in sizes:
+                offsets.append(position)
+                position += size + 1
+            ids.extend(batch_ids)
+            crc = zlib.crc32(messages, zlib.crc32(b',', crc))
+            out.write(b',')
+            out.write(messages)
+            streaming += batch_streaming or 0
+        return ids, offsets, crc, streaming > 0
+
+    def _build(self, previous: SerializedHistory) -> SerializedHistory:
+        modified = self._last_modified(previous)
+        if self.segment_dir:
+            # continue with the newest segments any worker wrote (a new worker starts with them as well)
+            latest = self._open_latest(previous)
+            if latest is not None and (previous is None or latest.revision > previous.revision):
+                previous = latest
+        segments = self._reusable(previous)
+        after = segments[-1].ids[-1] if segments else 0
+        # the revision comes from the snapshot the messages are read from, so a segment of a revision always has the
+        # same content, no matter which worker wrote it
+        revision, rewrite, batches = self.store.serialized_snapshot(after=after)
+        if segments and rewrite > previous.revision:
+            # messages that are serialized in the kept segments changed (e.g. the compaction deleted some of them)
+            batches.close()
+            segments, after = [], 0
+            revision, rewrite, batches = self.store.serialized_snapshot()
+        crc = segments[-1].crc if segments else zlib.crc32(self.head)
+        try:
+            if not self.segment_dir:
+                HISTORY_BUILDS.inc(kind='append' if segments else 'full')
+                out = io.BytesIO()
+                ids, offsets, crc, streaming = self._write(out, batches, crc)
+                if ids:
+                    segments.append(Segment('', out.getvalue(), ids, offsets, crc, streaming))
+                return SerializedHistory(revision, self.head, segments,
+                                         datetime.fromtimestamp(modified, timezone.utc), self.gzip_level,
+                                         key=self._segment_key)
+            history = self._open(revision, previous)
+            if history is not None:
+                return history
+            HISTORY_BUILDS.inc(kind='append' if segments else 'full')
+            name = 'history-%d-%s-%d' % (revision, self._segment_key, after)
+            path = os.path.join(self.segment_dir, name)
+            temporary = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+            with open(temporary + '.messages', 'wb', buffering=CHUNK_SIZE) as f:
+                ids, offsets, crc, streaming = self._write(f, batches, crc)
+        finally:
+            # ends the read transaction of the snapshot
+            batches.close()
+        if ids:
+            # the index is renamed first: whoever finds the body finds its index too
+            with open(temporary + '.idx', 'wb') as f:
+                ids.tofile(f)
+                offsets.tofile(f)
+            os.replace(temporary + '.idx', path + '.idx')
+            os.replace(temporary + '.messages', path + '.messages')
+            segments.append(Segment(name, _map(path + '.messages'), ids, offsets, crc, streaming, path=path))
+        else:
+            os.remove(temporary + '.messages')
+        # the list of segments is written last: whoever finds it finds all of its segments
+        manifest = self._manifest_path(revision)
+        with open(temporary + '.list', 'w') as f:
+            json.dump([{'name': segment.name, 'crc': segment.crc, 'streaming': segment.streaming}
+                       for segment in segments], f)
+        os.utime(temporary + '.list', (modified, modified))
+        os.replace(temporary + '.list', manifest)
+        history = SerializedHistory(revision, self.head, segments, datetime.fromtimestamp(modified, timezone.utc),
+                                    self.gzip_level, key=self._segment_key)
+        self._remove_segments(history)
+        return history
+
+    def _manifest_path(self, revision: int) -> str:
+        return os.path.join(self.segment_dir, 'history-%d-%s.list' % (revision, self._segment_key))
+
+    def _open(self, revision: int, previous: SerializedHistory):
+        """
+        Maps the segments of a revision written by this or another worker.
+        :return: the message list or None if there is no (complete) list of segments for the revision
+        """
+        path = self._manifest_path(revision)
+        known = {segment.name: segment for segment in previous.segments} if previous is not None else {}
+        try:
+            modified = math.ceil(os.stat(path).st_mtime)
+            with open(path) as f:
+                entries = json.load(f)
+            segments = [known.get(entry['name']) or self._open_segment(entry) for entry in entries]
+        except (FileNotFoundError, ValueError):
+            # not written yet, or a segment was removed in the meantime
+            return None
+        if previous is not None and modified <= previous.last_modified.timestamp():
+            # written by a worker with another clock or a revision this worker never saw
+            modified = int(previous.last_modified.timestamp()) + 1
+        return SerializedHistory(revision, self.head, segments, datetime.fromtimestamp(modified, timezone.utc),
+                                 self.gzip_level, key=self._segment_key)
+
+    def _open_segment(self, entry: dict) -> Segment:
+        path = os.path.join(self.segment_dir, entry['name'])
+        body = _map(path + '.messages')
+        index = _map(path + '.idx')
+        # ids and offsets are read straight from the mapped index (the first half are the ids)
+        count = len(index) // 16
+        index = memoryview(index)
+        return Segment(entry['name'], body, index[:count * 8].cast('q'), index[count * 8:].cast('Q'), entry['crc'],
+                       entry['streaming'], path=path)
+
+    def _open_latest(self, previous: SerializedHistory):
+        """
+        :param previous: the message list this worker has (its segments don't have to be mapped again)
+        :return: the newest message list in the segment directory or None
+        """
+        revisions = []
+        for path in glob.glob(os.path.join(self.segment_dir, 'history-*-%s.list' % self._segment_key)):
+            match = SEGMENT_NAME.match(os.path.basename(path))
+            if match:
+                revisions.append(int(match.group(1)))
+        for revision in sorted(revisions, reverse=True):
+            if previous is not None and revision <= previous.revision:
+                break
+            history = self._open(revision, previous)
+            if history is not None:
+                return history
+        return None
+
+    def _remove_segments(self, history: SerializedHistory) -> None:
+        # the lists of older revisions and the segments none of them uses anymore are not needed (workers still
+        # streaming them keep their mapping); segments of newer revisions may be written by another worker right now
+        used = {segment.name for segment in history.segments}
+        for path in glob.glob(os.path.join(self.segment_dir, 'history-*')):
+            name = os.path.basename(path)
+            match = SEGMENT_NAME.match(name)
+            if not match or '.tmp' in name or name.split('.')[0] in used:
+                continue
+            if int(match.group(1)) < history.revision or match.group(2) != self._segment_key:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
@@ -1,8 +1,15 @@
-from flask import Flask, request, render_template, jsonify
+from flask import Flask, request, render_template, jsonify, url_for
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect, or_
 import json
 import datetime
-import requests
+import os
+import hashlib
+import threading
+import time
+from project_three.feed import ChannelFeed
+from project_three.health import BackgroundVerifier, HealthChecker
+from project_three.metrics import instrument_app, registry
 
 db = SQLAlchemy()
 
@@ -14,12 +21,65 @@ class Channel(db.Model):
     """
     __tablename__ = 'channels'
     id = db.Column(db.Integer, primary_key=True)
-    active = db.Column('is_active', db.Boolean(), nullable=False, server_default='1')
+    active = db.Column('is_active', db.Boolean(), nullable=False, server_default='1', index=True)
     name = db.Column(db.String(100, collation='NOCASE'), nullable=False)
     endpoint = db.Column(db.String(100, collation='NOCASE'), nullable=False, unique=True)
     authkey = db.Column(db.String(100, collation='NOCASE'), nullable=False)
-    type_of_service = db.Column(db.String(100, collation='NOCASE'), nullable=False)
+    type_of_service = db.Column(db.String(100, collation='NOCASE'), nullable=False, index=True)
     last_heartbeat = db.Column(db.DateTime(), nullable=True, server_default=None)
+    failures = db.Column(db.Integer(), nullable=False, server_default='0')  # failed health checks in a row
+    next_check = db.Column(db.DateTime(), nullable=True, server_default=None)  # backoff for failing channels
+    # state of the registration: pending (health check not done yet), verified or failed
+    registration = db.Column(db.String(20), nullable=False, server_default='verified')
+
+
+class Setting(db.Model):
+    """
+    Counters shared by all hub processes (e.g. the version of the channel list).
+    """
+    __tablename__ = 'settings'
+    key = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer(), nullable=False, server_default='0')
+
+
+def upgrade_database() -> None:
+    """
+    db.create_all() doesn't add new columns to an existing table, so this adds the ones that are missing.
+    """
+    columns = {column['name'] for column in inspect(db.engine).get_columns('channels')}
+    with db.engine.begin() as connection:
+        if 'failures' not in columns:
+            connection.execute(db.text("ALTER TABLE channels ADD COLUMN failures INTEGER NOT NULL DEFAULT '0'"))
+        if 'next_check' not in columns:
+            connection.execute(db.text("ALTER TABLE channels ADD COLUMN next_check DATETIME"))
+        if 'registration' not in columns:
+            connection.execute(db.text("ALTER TABLE channels ADD COLUMN registration VARCHAR(20) NOT NULL DEFAULT 'verified'"))
+        # indexes for the filters of GET /channels
+        connection.execute(db.text("CREATE INDEX IF NOT EXISTS ix_channels_is_active ON channels (is_active)"))
+        connection.execute(db.text("CREATE INDEX IF NOT EXISTS ix_channels_type_of_service ON channels (type_of_service)"))
+        # the version counter has to exist, bump_channels_version only increments it
+        connection.execute(db.text("INSERT INTO settings (key, value) SELECT 'channels_version', 0 "
+                                   "WHERE NOT EXISTS (SELECT 1 FROM settings WHERE key = 'channels_version')"))
+
+
+def bump_channels_version() -> None:
+    """
+    Marks the channel list as changed (in the current transaction), so all hub processes drop their cached lists.
+    Has to be called whenever a change affects the output of GET /channels.
+    """
+    # incremented by the database: a read-modify-write of two processes at the same time could write the same value
+    # and the others would keep serving their cached list
+    result = db.session.execute(db.text("UPDATE settings SET value = value + 1 WHERE key = 'channels_version'"))
+    if result.rowcount == 0:
+        db.session.add(Setting(key='channels_version', value=1))
+
+
+def channels_version() -> int:
+    """
+    :return: the current version of the channel list
+    """
+    setting = db.session.get(Setting, 'channels_version')
+    return setting.value if setting else 0
 
 # Class-based application configuration
 class ConfigClass(object):
@@ -31,7 +91,7 @@ class ConfigClass(object):
     SECRET_KEY = 'This is an INSECURE secret!! DO NOT use this in production!!'
 
     # Flask-SQLAlchemy settings
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///chat_server.sqlite'  # File-based SQL database
+    SQLALCHEMY_DATABASE_URI = os.environ.get('hub_database', 'sqlite:///chat_server.sqlite')  # File-based SQL database
     SQLALCHEMY_TRACK_MODIFICATIONS = False  # Avoids SQLAlchemy warning
 
 # Create Flask app
@@ -39,62 +99,86 @@ app = Flask(__name__)
 app.config.from_object(__name__ + '.ConfigClass')  # configuration
 app.app_context().push()  # create an app context before initializing db
 db.init_app(app)  # initialize database
-db.create_all()  # create database if necessary
+# the tables are created/upgraded with the first request (or command) of a process, not when it is imported
+database_ready = threading.Event()
+database_lock = threading.Lock()
 
-SERVER_AUTHKEY = '1234567890'
 
-def health_check(endpoint, authkey) -> bool:
+def ensure_database() -> None:
     """
-    TODO: function desctiption
-    :param endpoint:
-    :param authkey:
-    :return: result of the health check as boolean value
+    Creates the database if necessary and adds missing columns, once per process.
     """
-    # make GET request to URL
-    # add authkey to request header
-    try:
-        response = requests.get(endpoint+'/health',
-                                headers={'Authorization': 'authkey '+authkey})
-    except requests.exceptions.RequestException as e:
-        print(f"Error: {e}")
-        return False
-    if response.status_code != 200:
-        return False
-    # check if response is JSON with {"name": <channel_name>}
-    if 'name' not in response.json():
-        return False
-    # check if channel name is as expected
-    # (channels can't change their name, must be re-registered)
-    channel = Channel.query.filter_by(endpoint=endpoint).first()
-    if not channel:
-        print(f"Channel {endpoint} not found in database")
-        return False
-    expected_name = channel.name
-    if response.json()['name'] != expected_name:
-        return False
-
-    # everything is OK, set last_heartbeat to now
-    channel.last_heartbeat = datetime.datetime.now()
-    db.session.commit()  # save to database
-    return True
+    if database_ready.is_set():
+        return
+    with database_lock:
+        if not database_ready.is_set():
+            db.create_all()
+            upgrade_database()
+            database_ready.set()
+
+
+@app.before_request
+def prepare_database() -> None:
+    ensure_database()
+
+
+SERVER_AUTHKEY = '1234567890'
+
+# request timings on /metrics (same authorization header as the other hub endpoints)
+instrument_app(app, lambda request: request.headers.get('Authorization') == 'authkey ' + SERVER_AUTHKEY)
+CHECK_SECONDS = registry.histogram('check_channels_seconds', "Duration of a health check of all channels")
+CHANNEL_LIST_REQUESTS = registry.counter('channel_list_requests_total',
+                                         "GET /channels requests by cache result (hit, miss, not_modified)")
+
+# serialized GET /channels answers of the current channel list version, per filter/page
+CHANNEL_LIST_CACHE = {'version': None, 'lists': {}}
+
+# health checks run concurrently over a shared connection pool, every check has a timeout
+health_checker = HealthChecker(workers=16, timeout=5)
+
+# health checks of newly registered channels run in the background, waiting status requests are woken up after each
+verifier = BackgroundVerifier(health_checker, lambda channel_id, name: verification_done(channel_id, name))
+registration_changed = threading.Condition()
+
+# GET /feed asks at most 16 channels at once (3s timeout each) and caches their newest messages for 10s
+channel_feed = ChannelFeed(workers=16, timeout=3, ttl=10, fetch_limit=100)
+FEED_MAX_LIMIT = 500
+
 
 # cli command to check health of all channels
 @app.cli.command('check_channels')
 def check_channels() -> None:
     """
-    Function that checks all channels on health (by calling health_check on all of them)
+    Function that checks all channels on health. The checks run concurrently, channels that failed before are only
+    checked again after their backoff, and all results are saved in one transaction.
     """
-    channels = Channel.query.all()
+    ensure_database()
+    start = time.perf_counter()
+    now = datetime.datetime.now()
+    channels = Channel.query.filter(or_(Channel.next_check.is_(None), Channel.next_check <= now)).all()
+    names = health_checker.check_all([(channel.id, channel.endpoint, channel.authkey) for channel in channels])
+    changed = False
     for channel in channels:
-        if not health_check(channel.endpoint, channel.authkey):
+        was_active = channel.active
+        # channels can't change their name, must be re-registered
+        if names[channel.id] != channel.name:
             print(f"Channel {channel.endpoint} is not healthy")
             #deactivate channel if not healthy
             channel.active = False
-            db.session.commit()
+            channel.failures += 1
+            channel.next_check = now + health_checker.backoff(channel.failures)
         else:
             print(f"Channel {channel.endpoint} is healthy")
             channel.active = True
-            db.session.commit()
+            channel.registration = 'verified'
+            channel.last_heartbeat = now
+            channel.failures = 0
+            channel.next_check = None
+        changed = changed or channel.active != was_active
+    if changed:
+        bump_channels_version()
+    db.session.commit()
+    CHECK_SECONDS.observe(time.perf_counter() - start)
 
 # The Home page is accessible to anyone
 @app.route('/')
@@ -114,11 +198,12 @@ def home_page():
 def create_channel():
     """
     Function to create a new channel if not existing or update it if it already exists.
-    :return: error message or channel as a json object.
+    A list of records registers many channels at once (e.g. all channels hosted by one process).
+    :return: error message or channel as a json object ({'channels': [...]} for a list of records).
     """
     global SERVER_AUTHKEY
 
-    record = json.loads(request.data)
+    records = json.loads(request.data)
 
     # check if authorization header is present
     if 'Authorization' not in request.headers:
@@ -126,57 +211,193 @@ def create_channel():
     # check if authorization header is valid
     if request.headers['Authorization'] != 'authkey ' + SERVER_AUTHKEY:
         return "Invalid authorization header ({})".format(request.headers['Authorization']), 400
+    batch = isinstance(records, list)
+    if not batch:
+        records = [records]
+    # all records are checked before anything is saved
+    for index, record in enumerate(records):
+        error = record_error(record)
+        if error:
+            return (error + " (record %d)" % index) if batch else error, 400
+
+    # the channels are saved as pending right away, the health checks run in the background (see verification_done)
+    results = [save_channel(record) for record in records]
+    bump_channels_version()
+    db.session.commit()
+    registrations = []
+    for channel, created in results:
+        verifier.submit(channel.id, channel.endpoint, channel.authkey)
+        registrations.append({'created': created, 'id': channel.id, 'status': 'pending',
+                              'status_url': url_for('registration_status', channel_id=channel.id)})
+    if batch:
+        return jsonify(channels=registrations), 202
+    return jsonify(registrations[0]), 202
+
+
+def record_error(record):
+    """
+    :param record: a channel record of a registration
+    :return: error message if an attribute is missing, else None
+    """
     #check if record contains all required attributes
+    if not isinstance(record, dict):
+        return "Record is no object"
     if 'name' not in record:
-        return "Record has no name", 400
+        return "Record has no name"
     if 'endpoint' not in record:
-        return "Record has no endpoint", 400
+        return "Record has no endpoint"
     if 'authkey' not in record:
-        return "Record has no authkey", 400
+        return "Record has no authkey"
     if 'type_of_service' not in record:
-        return "Record has no type of service representation", 400
-
-    update_channel = Channel.query.filter_by(endpoint=record['endpoint']).first()
-    print("update_channel: ", update_channel)
-    if update_channel:  # if the channel already exists, update it
-        update_channel.name = record['name']
-        update_channel.authkey = record['authkey']
-        update_channel.type_of_service = record['type_of_service']
-        update_channel.active = False
-        db.session.commit()
-        if not health_check(record['endpoint'], record['authkey']):
-            return "Channel is not healthy", 400
-        return jsonify(created=False,
-                       id=update_channel.id), 200
-    else:  # new channel, create it
-        channel = Channel(name=record['name'],
-                          endpoint=record['endpoint'],
-                          authkey=record['authkey'],
-                          type_of_service=record['type_of_service'],
-                          last_heartbeat=datetime.datetime.now(),
-                          active=True)
+        return "Record has no type of service representation"
+    return None
+
+
+def save_channel(record) -> tuple:
+    """
+    Creates or updates the channel of a record as pending (without committing).
+    :param record: a valid channel record
+    :return: the channel and whether it was created
+    """
+    channel = Channel.query.filter_by(endpoint=record['endpoint']).first()
+    created = channel is None
+    if created:  # new channel, create it
+        channel = Channel(endpoint=record['endpoint'])
         db.session.add(channel)
+    channel.name = record['name']
+    channel.authkey = record['authkey']
+    channel.type_of_service = record['type_of_service']
+    channel.active = False
+    channel.registration = 'pending'
+    channel.failures = 0
+    channel.next_check = None
+    # the id is needed for the status url
+    db.session.flush()
+    return channel, created
+
+
+def verification_done(channel_id, name) -> None:
+    """
+    Saves the result of the health check of a newly registered channel (called by the verifier threads).
+    :param channel_id: id of the channel
+    :param name: the name the channel reported, None if it is not healthy
+    """
+    with app.app_context():
+        channel = db.session.get(Channel, channel_id)
+        if channel is None:
+            return
+        # channels have to report the name they registered with
+        if name is not None and name == channel.name:
+            channel.active = True
+            channel.registration = 'verified'
+            channel.last_heartbeat = datetime.datetime.now()
+        else:
+            channel.registration = 'failed'
+        bump_channels_version()
         db.session.commit()
-        if not health_check(record['endpoint'], record['authkey']):
-            # delete channel from database
-            db.session.delete(channel)
-            db.session.commit()
-            return "Channel is not healthy", 400
+    with registration_changed:
+        registration_changed.notify_all()
+
 
-        return jsonify(created=True, id=channel.id), 200
+@app.route('/channels/<int:channel_id>/status', methods=['GET'])
+def registration_status(channel_id):
+    """
+    Status of a registration. With ?wait=<seconds> the request waits (at most 30s) until the status is no longer pending.
+    :param channel_id: the id returned when registering the channel
+    :return: error message or id, status (pending, verified or failed) and active as json object
+    """
+    try:
+        wait = min(float(request.args.get('wait', 0)), 30)
+    except ValueError:
+        return "Invalid wait", 400
+    channel = db.session.get(Channel, channel_id)
+    if channel is None:
+        return "Channel not found", 404
+    deadline = time.monotonic() + wait
+    while channel.registration == 'pending' and time.monotonic() < deadline:
+        # woken up by verification_done; checking at least every second also covers other hub processes
+        with registration_changed:
+            registration_changed.wait(min(1.0, deadline - time.monotonic()))
+        db.session.expire(channel)
+    return jsonify(id=channel.id, status=channel.registration, active=channel.active), 200
 
 
 @app.route('/channels', methods=['GET'])
 def get_channels():
     """
-    Function that gets all currently existing channels and returns them as a .json object
+    Function that gets the registered channels and returns them as a .json object.
+    Optional filters: ?active=true|false, ?type_of_service=..., pagination with ?limit= and ?offset=.
+    Lists are cached until a channel changes and are sent with an ETag, so unchanged lists are answered with 304.
     :return: channels as a .json object
     """
-    channels = Channel.query.all()
-    return jsonify(channels=[{'name': c.name,
-                              'endpoint': c.endpoint,
-                              'authkey': c.authkey,
-                              'type_of_service': c.type_of_service} for c in channels]), 200
+    global CHANNEL_LIST_CACHE
+    try:
+        active = request.args.get('active')
+        if active is not None:
+            active = active.lower() in ('1', 'true', 'yes')
+        type_of_service = request.args.get('type_of_service')
+        limit = int(request.args['limit']) if 'limit' in request.args else None
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return "Invalid limit or offset", 400
+
+    version = channels_version()
+    if CHANNEL_LIST_CACHE['version'] != version:
+        CHANNEL_LIST_CACHE = {'version': version, 'lists': {}}
+    key = (active, type_of_service, limit, offset)
+    etag = '%d-%s' % (version, hashlib.md5(repr(key).encode()).hexdigest()[:12])
+    if request.if_none_match.contains(etag):
+        CHANNEL_LIST_REQUESTS.inc(cache='not_modified')
+        return '', 304, {'ETag': '"%s"' % etag}
+
+    body = CHANNEL_LIST_CACHE['lists'].get(key)
+    CHANNEL_LIST_REQUESTS.inc(cache='hit' if body is not None else 'miss')
+    if body is None:
+        query = Channel.query
+        if active is not None:
+            query = query.filter(Channel.active == active)
+        if type_of_service is not None:
+            query = query.filter(Channel.type_of_service == type_of_service)
+        query = query.order_by(Channel.id).offset(offset)
+        if limit is not None:
+            query = query.limit(limit)
+        channels = query.all()
+        result = {'channels': [{'id': c.id,
+                                'name': c.name,
+                                'endpoint': c.endpoint,
+                                'authkey': c.authkey,
+                                'type_of_service': c.type_of_service,
+                                'active': c.active} for c in channels]}
+        if limit is not None and len(channels) == limit:
+            result['next_offset'] = offset + limit
+        body = json.dumps(result)
+        if len(CHANNEL_LIST_CACHE['lists']) < 100:
+            CHANNEL_LIST_CACHE['lists'][key] = body
+    return body, 200, {'Content-Type': 'application/json', 'ETag': '"%s"' % etag}
+
+@app.route('/feed', methods=['GET'])
+def get_feed():
+    """
+    The newest messages of all active channels merged by timestamp (newest first).
+    Optional: ?limit= (default 50), ?q= (text the content contains), ?sender=, ?type_of_service=.
+    Filters apply to the newest messages of every channel, the channels are asked in parallel.
+    :return: error message or the messages (each with its channel), the number of channels and the channels that
+    could not be reached as a .json object
+    """
+    if request.headers.get('Authorization') != 'authkey ' + SERVER_AUTHKEY:
+        return "Invalid authorization", 400
+    try:
+        limit = min(int(request.args.get('limit', 50)), FEED_MAX_LIMIT)
+    except ValueError:
+        return "Invalid limit", 400
+    if limit < 1:
+        return "Invalid limit", 400
+    query = Channel.query.filter_by(active=True)
+    if 'type_of_service' in request.args:
+        query = query.filter(Channel.type_of_service == request.args['type_of_service'])
+    channels = [{'id': c.id, 'name': c.name, 'endpoint': c.endpoint, 'authkey': c.authkey} for c in query.all()]
+    return jsonify(channel_feed.latest(channels, limit=limit, q=request.args.get('q') or None,
+                                       sender=request.args.get('sender') or None)), 200
 
 import traceback
 @app.errorhandler(500)
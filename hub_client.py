@@ -0,0 +1,156 @@
+## hub_client.py - HTTP client for the hub and its channels (used by client.py)
+
+import datetime
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from project_three.metrics import registry
+
+REQUEST_SECONDS = registry.histogram('hub_client_request_seconds', "Duration of requests to the hub and the channels")
+CHANNEL_LIST_LOOKUPS = registry.counter('hub_client_channel_list_total',
+                                        "Channel list lookups by result (cached, fetched, not_modified, stale)")
+
+
+class HubError(Exception):
+    """
+    Raised if the channel list can't be fetched from the hub and there is no cached list either.
+    """
+    pass
+
+
+class HubClient(object):
+    """
+    Talks to the hub and the channels over one pooled keep-alive session with timeouts and retries.
+    The channel list is cached (thread-safe) and indexed by endpoint; if the hub is not reachable, the last known list
+    is used even if it is older than the cache ttl. While one thread fetches a new list, the others get the old one.
+    """
+
+    def __init__(self, hub_url: str, authkey: str, timeout: float = 5, retries: int = 3, backoff: float = 0.3,
+                 cache_ttl: float = 60, pool_size: int = 10):
+        """
+        :param hub_url: url of the hub
+        :param authkey: authkey for the hub
+        :param timeout: seconds to wait for the hub or a channel
+        :param retries: retries of failed requests (POSTs are only retried if the connection could not be established)
+        :param backoff: backoff factor between retries (0.3 -> 0.3s, 0.6s, 1.2s, ...)
+        :param cache_ttl: seconds the channel list is used before it is fetched again
+        :param pool_size: maximum number of connections kept open per host
+        """
+        self.hub_url = hub_url
+        self.authkey = authkey
+        self.timeout = timeout
+        self.cache_ttl = datetime.timedelta(seconds=cache_ttl)
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(502, 503, 504),
+                      allowed_methods=frozenset(['GET']), raise_on_status=False)
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._lock = threading.Lock()
+        # only one thread asks the hub at a time, the others use the old list meanwhile
+        self._refreshed = threading.Condition(self._lock)
+        self._refreshing = False
+        self._channels = None
+        self._by_endpoint = {}
+        self._etag = None
+        self._updated = None
+
+    def channels(self) -> list:
+        """
+        :return: all active channels (from the cache if it is fresh)
+        """
+        with self._lock:
+            while True:
+                if self._channels is not None and datetime.datetime.now() - self._updated < self.cache_ttl:
+                    CHANNEL_LIST_LOOKUPS.inc(result='cached')
+                    return self._channels
+                if not self._refreshing:
+                    break
+                if self._channels is not None:
+                    # another thread is asking the hub, use the old list until it has the new one
+                    CHANNEL_LIST_LOOKUPS.inc(result='stale')
+                    return self._channels
+                # there is no list yet: wait for the first fetch (and try ourselves if it failed)
+                self._refreshed.wait()
+            self._refreshing = True
+            etag = self._etag if self._channels is not None else None
+        # the request to the hub is made without holding the lock (it may take up to timeout * retries)
+        try:
+            try:
+                channels, etag = self._fetch(etag)
+            except HubError as e:
+                with self._lock:
+                    if self._channels is None:
+                        raise
+                    # serve the old list and ask the hub again in 10 seconds (not with every request)
+                    print(f"Using cached channels: {e}")
+                    CHANNEL_LIST_LOOKUPS.inc(result='stale')
+                    self._updated = datetime.datetime.now() - self.cache_ttl + datetime.timedelta(seconds=10)
+                    return self._channels
+            with self._lock:
+                if channels is not None:
+                    self._channels = channels
+                    self._by_endpoint = {channel['endpoint']: channel for channel in channels}
+                    self._etag = etag
+                self._updated = datetime.datetime.now()
+                return self._channels
+        finally:
+            with self._lock:
+                self._refreshing = False
+                self._refreshed.notify_all()
+
+    def find_channel(self, endpoint: str):
+        """
+        :param endpoint: the endpoint of a channel
+        :return: the channel as dict or None if the hub doesn't know it
+        """
+        self.channels()
+        return self._by_endpoint.get(endpoint)
+
+    def _fetch(self, etag):
+        """
+        Fetches the channel list from the hub.
+        :param etag: ETag of the cached list (None if there is none)
+        :return: the channels and their ETag, (None, etag) if the cached list is still current
+        """
+        headers = {'Authorization': 'authkey ' + self.authkey}
+        if etag:
+            headers['If-None-Match'] = etag
+        try:
+            with REQUEST_SECONDS.time(target='hub', method='GET'):
+                response = self.session.get(self.hub_url + '/channels?active=true', headers=headers,
+                                            timeout=self.timeout)
+            if response.status_code == 304:
+                CHANNEL_LIST_LOOKUPS.inc(result='not_modified')
+                return None, etag
+            if response.status_code != 200:
+                raise HubError("Error fetching channels: " + str(response.text))
+            channels_response = response.json()
+            if 'channels' not in channels_response:
+                raise HubError("No channels in response")
+        except (requests.exceptions.RequestException, ValueError) as e:
+            raise HubError(str(e))
+        CHANNEL_LIST_LOOKUPS.inc(result='fetched')
+        return channels_response['channels'], response.headers.get('ETag')
+
+    def get_messages(self, channel: dict) -> requests.Response:
+        """
+        :param channel: the channel as dict (endpoint and authkey)
+        :return: the response of the channel
+        """
+        with REQUEST_SECONDS.time(target='channel', method='GET'):
+            return self.session.get(channel['endpoint'], headers={'Authorization': 'authkey ' + channel['authkey']},
+                                    timeout=self.timeout)
+
+    def post_message(self, channel: dict, message: dict) -> requests.Response:
+        """
+        :param channel: the channel as dict (endpoint and authkey)
+        :param message: the message (content, sender, timestamp)
+        :return: the response of the channel
+        """
+        with REQUEST_SECONDS.time(target='channel', method='POST'):
+            return self.session.post(channel['endpoint'], headers={'Authorization': 'authkey ' + channel['authkey']},
+                                     json=message, timeout=self.timeout)
@@ -0,0 +1,718 @@
+## message_store.py - persistent, append-only storage for channel messages
+
+import json
+import os
+import re
+import sqlite3
+import time
+from array import array
+
+from project_three.metrics import registry
+from project_three.sqlite_connections import ThreadConnections
+from project_three.timestamps import format_timestamp, parse_timestamp
+
+STORE_SECONDS = registry.histogram('message_store_seconds', "Duration of message store operations")
+
+
+class MessageStore(object):
+    """
+    Interface of a message store. Every backend has to implement these methods, channel.py only talks to this interface.
+    """
+
+    def append(self, message: dict) -> int:
+        """
+        Atomically appends a single message to the store.
+        :param message: the message as dict with content, sender, timestamp (microseconds since the epoch or an ISO 8601
+        string) and extra
+        :return: the id of the stored message
+        """
+        raise NotImplementedError
+
+    def append_many(self, messages: list) -> list:
+        """
+        Atomically appends several messages at once (either all of them are stored or none).
+        :param messages: list of messages as dicts
+        :return: the ids of the stored messages
+        """
+        raise NotImplementedError
+
+    def read_messages(self) -> list:
+        """
+        :return: all stored messages as dicts, in the order they were appended
+        """
+        raise NotImplementedError
+
+    def iter_serialized(self, batch_size: int = 10000):
+        """
+        Streams all messages already serialized, so the full history never has to exist as python objects.
+        :param batch_size: number of messages per yielded batch
+        :return: iterator over batches (ids, sizes, messages, streaming) in the order the messages were appended: ids
+        and sizes in bytes as arrays, the messages as compact json objects with sorted keys separated by commas and the
+        number of messages in the batch that are still being generated (they are serialized without their content)
+        """
+        return self.serialized_snapshot(batch_size)[2]
+
+    def serialized_snapshot(self, batch_size: int = 10000, after: int = 0) -> tuple:
+        """
+        Like iter_serialized, together with the history revision the streamed messages belong to and the history
+        revision of the last change that wasn't an append (all read from the same snapshot). The messages up to after
+        are the same as at any history revision since that change.
+        :param batch_size: number of messages per yielded batch
+        :param after: only stream the messages with a bigger id
+        :return: (history revision, history revision of the last rewrite, iterator over the batches)
+        """
+        raise NotImplementedError
+
+    def read_page(self, since: int = None, since_timestamp: int = None, before: int = None, limit: int = 100) -> list:
+        """
+        Reads a page of messages. Ids are assigned in the order messages are appended, so they can be used as cursor.
+        :param since: only return messages with a bigger id (the oldest of them first)
+        :param since_timestamp: only return messages newer than this timestamp (microseconds since the epoch)
+        :param before: only return messages with a smaller id (the newest of them, still sorted oldest first)
+        :param limit: maximum number of returned messages
+        :return: the messages as dicts, sorted by id
+        """
+        raise NotImplementedError
+
+    def search(self, query: str = None, sender: str = None, from_timestamp: int = None, to_timestamp: int = None,
+               before: int = None, limit: int = 100) -> list:
+        """
+        Finds the newest messages matching all given filters.
+        :param query: words that have to be in the content (all of them, in any order)
+        :param sender: only messages of this sender
+        :param from_timestamp: only messages from this timestamp on (microseconds since the epoch)
+        :param to_timestamp: only messages up to this timestamp (microseconds since the epoch)
+        :param before: only messages with a smaller id (cursor of the next page)
+        :param limit: maximum number of returned messages
+        :return: the messages as dicts, sorted by id
+        """
+        raise NotImplementedError
+
+    def last_id(self) -> int:
+        """
+        :return: id of the newest message, 0 if there is none
+        """
+        raise NotImplementedError
+
+    def revision(self) -> int:
+        """
+        :return: number that changes whenever messages are appended, updated or deleted
+        """
+        raise NotImplementedError
+
+    def history_revision(self) -> int:
+        """
+        :return: number that changes whenever the serialized messages change: appends, finished messages and deletions
+        (not the updates of messages that are still being generated, those are serialized without their content)
+        """
+        raise NotImplementedError
+
+    def identity(self) -> str:
+        """
+        :return: random id of the store, a store that was recreated (and counts its revisions from 0 again) gets a new
+        one
+        """
+        raise NotImplementedError
+
+    def get_message(self, message_id: int):
+        """
+        :param message_id: id of a message
+        :return: the message as dict or None
+        """
+        raise NotImplementedError
+
+    def streaming_messages(self, until: int = None) -> list:
+        """
+        :param until: optional id of the newest message to consider
+        :return: the messages that are still being generated (streaming), oldest first
+        """
+        raise NotImplementedError
+
+    def update_message(self, message_id: int, content: str, streaming: bool) -> None:
+        """
+        Replaces the content of a message (used for assistant answers that are stored while they are generated).
+        :param message_id: id of the message
+        :param content: the new content
+        :param streaming: True while more content will follow
+        """
+        raise NotImplementedError
+
+    def compact(self, before_timestamp: int = None, max_messages: int = None, max_bytes: int = None) -> tuple:
+        """
+        Drops the oldest messages until all retention limits are met.
+        :param before_timestamp: delete messages older than this timestamp (microseconds since the epoch)
+        :param max_messages: keep at most this many messages
+        :param max_bytes: keep at most this many bytes of messages
+        :return: (number of deleted messages, number of deleted bytes)
+        """
+        raise NotImplementedError
+
+    def count(self) -> int:
+        """
+        :return: number of stored messages
+        """
+        raise NotImplementedError
+
+    def add_pending(self, message: dict) -> int:
+        """
+        Stores a post that still has to be moderated. It is not visible until finish_pending is called.
+        :param message: the message as dict
+        :return: the id of the pending post
+        """
+        raise NotImplementedError
+
+    def add_pending_many(self, messages: list) -> list:
+        """
+        Stores several posts that still have to be moderated in one write.
+        :param messages: list of messages as dicts
+        :return: the ids of the pending posts
+        """
+        raise NotImplementedError
+
+    def claim_pending(self, pending_id: int, stale_after: float):
+        """
+        Marks a pending post as being moderated, so no other worker takes it as well.
+        :param pending_id: id of the pending post
+        :param stale_after: seconds after which a post claimed by another (probably crashed) worker can be claimed again
+        :return: (message, attempts) or None if the post is already taken or done
+        """
+        raise NotImplementedError
+
+    def finish_pending(self, pending_id: int, messages: list) -> list:
+        """
+        Atomically appends the moderated messages and marks the pending post as done.
+        :param pending_id: id of the pending post
+        :param messages: the messages to store
+        :return: the ids of the stored messages
+        """
+        raise NotImplementedError
+
+    def fail_pending(self, pending_id: int, error: str, dead: bool) -> None:
+        """
+        Records a failed moderation attempt.
+        :param pending_id: id of the pending post
+        :param error: description of the error
+        :param dead: True moves the post to the dead letters, False leaves it pending for another attempt
+        """
+        raise NotImplementedError
+
+    def get_pending(self, pending_id: int):
+        """
+        :param pending_id: id of the pending post
+        :return: dict with state, attempts, error and ids of the stored messages, or None
+        """
+        raise NotImplementedError
+
+    def list_pending(self, stale_after: float) -> list:
+        """
+        :param stale_after: seconds after which a claimed post counts as abandoned
+        :return: ids of posts that wait for moderation and are not being worked on
+        """
+        raise NotImplementedError
+
+    def import_legacy_file(self, path: str) -> int:
+        """
+        One-time migration of the old messages.json file into the store.
+        :param path: path of the json file
+        :return: number of imported messages (0 if the file was already imported or does not exist)
+        """
+        raise NotImplementedError
+
+
+class SQLiteMessageStore(MessageStore):
+    """
+    Message store backed by a SQLite database in WAL mode. Appends are single INSERTs, so posting a message does not
+    depend on the size of the history and concurrent workers can't overwrite each other's messages.
+    """
+
+    # every entry is a list of statements that upgrades the schema by one version (stored in PRAGMA user_version)
+    MIGRATIONS = [
+        ["""CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ts INTEGER NOT NULL,
+                timestamp TEXT NOT NULL,
+                content TEXT NOT NULL,
+                sender TEXT NOT NULL,
+                extra TEXT)""",
+         "CREATE INDEX IF NOT EXISTS messages_ts ON messages (ts)",
+         "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"],
+        # size of every message in bytes, needed for the max_bytes retention limit
+        ["ALTER TABLE messages ADD COLUMN size INTEGER NOT NULL DEFAULT 0",
+         """UPDATE messages SET size = length(CAST(content AS BLOB)) + length(CAST(sender AS BLOB))
+                                     + length(CAST(timestamp AS BLOB)) + COALESCE(length(CAST(extra AS BLOB)), 0)"""],
+        # posts that were accepted but are not moderated yet (state: pending, running, done or dead)
+        ["""CREATE TABLE IF NOT EXISTS pending (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                result TEXT,
+                updated REAL NOT NULL)""",
+         "CREATE INDEX IF NOT EXISTS pending_state ON pending (state, updated)"],
+        # assistant answers are stored while they are generated (streaming = 1) and updated as text arrives;
+        # the revision in meta changes with every write, so readers can notice updates of existing messages
+        ["ALTER TABLE messages ADD COLUMN streaming INTEGER NOT NULL DEFAULT 0",
+         "INSERT OR IGNORE INTO meta (key, value) VALUES ('revision', 0)"],
+        # search by sender (the newest messages first)
+        ["CREATE INDEX IF NOT EXISTS messages_sender ON messages (sender, id)"],
+        # identity of the store (part of the names of the serialized message lists next to the database)
+        ["INSERT OR IGNORE INTO meta (key, value) VALUES ('store_id', lower(hex(randomblob(8))))"],
+        # the few answers that are still being generated, for clients that start following the channel
+        ["CREATE INDEX IF NOT EXISTS messages_streaming ON messages (id) WHERE streaming = 1"],
+        # revision of the serialized messages (not changed by updates of answers that are still being generated) and
+        # the history revision of the last change that wasn't an append (deletions, changes of finished messages)
+        ["INSERT OR IGNORE INTO meta (key, value) SELECT 'history', value FROM meta WHERE key = 'revision'",
+         "INSERT OR IGNORE INTO meta (key, value) SELECT 'rewrite', value FROM meta WHERE key = 'revision'"],
+    ]
+
+    # full-text index of contents and senders (FTS5 with the messages table as external content, so the text isn't
+    # stored twice), kept up to date by triggers: appends, updates of streamed answers and deletions of the compaction
+    SEARCH_INDEX = [
+        """CREATE VIRTUAL TABLE messages_fts USING fts5(content, sender, content='messages', content_rowid='id',
+                                                        tokenize='unicode61 remove_diacritics 2')""",
+        """CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+               INSERT INTO messages_fts (rowid, content, sender) VALUES (new.id, new.content, new.sender);
+           END""",
+        """CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+               INSERT INTO messages_fts (messages_fts, rowid, content, sender)
+               VALUES ('delete', old.id, old.content, old.sender);
+           END""",
+        """CREATE TRIGGER messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+               INSERT INTO messages_fts (messages_fts, rowid, content, sender)
+               VALUES ('delete', old.id, old.content, old.sender);
+               INSERT INTO messages_fts (rowid, content, sender) VALUES (new.id, new.content, new.sender);
+           END""",
+        # index the messages stored before the index existed
+        "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')",
+    ]
+
+    # a batch of messages as json objects with sorted keys (like jsonify serializes the dicts of _message), built by
+    # SQLite in one row, so reading it doesn't create python objects per message; messages that are still being
+    # generated are serialized without their content, so the bytes only change with the history revision
+    SERIALIZED_QUERY = """SELECT group_concat(id), group_concat(length(message)), CAST(group_concat(message, ',') AS BLOB),
+               SUM(streaming)
+        FROM (SELECT id, streaming, CAST(CASE WHEN streaming
+                  THEN json_object('content', '', 'extra', json(extra), 'id', id, 'sender', sender,
+                                   'streaming', json('true'), 'timestamp', timestamp)
+                  ELSE json_object('content', content, 'extra', json(extra), 'id', id, 'sender', sender,
+                                   'timestamp', timestamp)
+                  END AS BLOB) AS message
+              FROM messages WHERE id > ? ORDER BY id LIMIT ?)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._identity = None
+        self._connections = ThreadConnections(path, row_factory=sqlite3.Row)
+        self._migrate()
+        self.full_text = self._create_search_index()
+
+    def _migrate(self) -> None:
+        """
+        Brings the database schema up to date.
+        """
+        connection = self._connections.get()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            version = connection.execute('PRAGMA user_version').fetchone()[0]
+            for number, statements in enumerate(self.MIGRATIONS[version:], start=version + 1):
+                for statement in statements:
+                    connection.execute(statement)
+                connection.execute('PRAGMA user_version = %d' % number)
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+    def _create_search_index(self) -> bool:
+        """
+        Creates the full-text index if it doesn't exist yet.
+        :return: False if SQLite was built without FTS5 (search falls back to LIKE)
+        """
+        connection = self._connections.get()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            if not connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone():
+                for statement in self.SEARCH_INDEX:
+                    connection.execute(statement)
+            connection.execute('COMMIT')
+        except sqlite3.OperationalError:
+            connection.execute('ROLLBACK')
+            return False
+        return True
+
+    @staticmethod
+    def _row(message: dict) -> tuple:
+        extra = json.dumps(message.get('extra'))
+        # the timestamps of the channel are microseconds since the epoch and only formatted here, strings (imported
+        # messages) are stored as they are
+        if isinstance(message['timestamp'], int):
+            ts, timestamp = message['timestamp'], format_timestamp(message['timestamp'])
+        else:
+            ts, timestamp = parse_timestamp(message['timestamp']) or 0, message['timestamp']
+        size = sum(len(value.encode('utf-8')) for value in (message['content'], message['sender'], timestamp, extra))
+        return (ts,
+                timestamp,
+                message['content'],
+                message['sender'],
+                extra,
+                size,
+                int(bool(message.get('streaming'))))
+
+    @staticmethod
+    def _message(row: sqlite3.Row) -> dict:
+        message = {'id': row['id'],
+                   'content': row['content'],
+                   'sender': row['sender'],
+                   'timestamp': row['timestamp'],
+                   'extra': json.loads(row['extra']) if row['extra'] is not None else None,
+                   }
+        if row['streaming']:
+            message['streaming'] = True
+        return message
+
+    @staticmethod
+    def _bump_revision(connection: sqlite3.Connection, history: bool = True, rewrite: bool = False) -> None:
+        """
+        :param history: the serialized messages change as well
+        :param rewrite: the change isn't an append, the serialized messages have to be written again from the start
+        """
+        connection.execute("UPDATE meta SET value = value + 1 WHERE key IN ('revision', 'history')" if history
+                           else "UPDATE meta SET value = value + 1 WHERE key = 'revision'")
+        if rewrite:
+            connection.execute("UPDATE meta SET value = (SELECT value FROM meta WHERE key = 'history') "
+                               "WHERE key = 'rewrite'")
+
+    def _insert(self, connection: sqlite3.Connection, messages: list) -> list:
+        ids = []
+        for message in messages:
+            cursor = connection.execute('INSERT INTO messages (ts, timestamp, content, sender, extra, size, streaming) '
+                                        'VALUES (?, ?, ?, ?, ?, ?, ?)', self._row(message))
+            ids.append(cursor.lastrowid)
+        self._bump_revision(connection)
+        return ids
+
+    def append(self, message: dict) -> int:
+        return self.append_many([message])[0]
+
+    @STORE_SECONDS.timed(operation='append')
+    def append_many(self, messages: list) -> list:
+        connection = self._connections.get()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            ids = self._insert(connection, messages)
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return ids
+
+    @STORE_SECONDS.timed(operation='read_messages')
+    def read_messages(self) -> list:
+        rows = self._connections.get().execute('SELECT * FROM messages ORDER BY id')
+        return [self._message(row) for row in rows]
+
+    def serialized_snapshot(self, batch_size: int = 10000, after: int = 0) -> tuple:
+        batches = self._iter_snapshot(batch_size, after)
+        # the generator has read the revisions inside its transaction, the batches follow
+        revision, rewrite = next(batches)
+        return revision, rewrite, batches
+
+    def _iter_snapshot(self, batch_size: int, after: int):
+        connection = self._connections.get()
+        start = time.perf_counter()
+        # one read transaction, so the revisions and all batches come from the same snapshot of the messages
+        connection.execute('BEGIN')
+        try:
+            revisions = dict(connection.execute("SELECT key, value FROM meta WHERE key IN ('history', 'rewrite')"))
+            yield int(revisions['history']), int(revisions['rewrite'])
+            last_id = after
+            while True:
+                batch = self._serialized_batch(connection, last_id, batch_size)
+                if batch is None:
+                    break
+                yield batch
+                last_id = batch[0][-1]
+        finally:
+            connection.execute('COMMIT')
+            STORE_SECONDS.observe(time.perf_counter() - start, operation='iter_serialized')
+
+    def _serialized_batch(self, connection: sqlite3.Connection, last_id: int, batch_size: int):
+        try:
+            ids, sizes, messages, streaming = connection.execute(self.SERIALIZED_QUERY,
+                                                                 (last_id, batch_size)).fetchone()
+        except sqlite3.OperationalError:
+            # SQLite without json1: the messages are serialized one by one
+            rows = connection.execute('SELECT * FROM messages WHERE id > ? ORDER BY id LIMIT ?',
+                                      (last_id, batch_size)).fetchall()
+            if not rows:
+                return None
+            # the same bytes as json1 writes: sorted keys, no spaces, utf-8
+            serialized = [json.dumps(dict(self._message(row), content='') if row['streaming'] else self._message(row),
+                                     sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode()
+                          for row in rows]
+            return (array('q', [row['id'] for row in rows]), array('q', map(len, serialized)), b','.join(serialized),
+                    sum(row['streaming'] for row in rows))
+        if ids is None:
+            return None
+        return array('q', map(int, ids.split(','))), array('q', map(int, sizes.split(','))), messages, streaming
+
+    @STORE_SECONDS.timed(operation='read_page')
+    def read_page(self, since: int = None, since_timestamp: int = None, before: int = None, limit: int = 100) -> list:
+        conditions, parameters = [], []
+        if since is not None:
+            conditions.append('id > ?')
+            parameters.append(since)
+        if since_timestamp is not None:
+            conditions.append('ts > ?')
+            parameters.append(since_timestamp)
+        if before is not None:
+            conditions.append('id < ?')
+            parameters.append(before)
+        where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+        # reading forward from a cursor returns the oldest messages first, everything else the newest ones
+        order = 'ASC' if since is not None or since_timestamp is not None else 'DESC'
+        rows = self._connections.get().execute('SELECT * FROM messages %s ORDER BY id %s LIMIT ?' % (where, order),
+                                               parameters + [limit]).fetchall()
+        if order == 'DESC':
+            rows.reverse()
+        return [self._message(row) for row in rows]
+
+    @STORE_SECONDS.timed(operation='search')
+    def search(self, query: str = None, sender: str = None, from_timestamp: int = None, to_timestamp: int = None,
+               before: int = None, limit: int = 100) -> list:
+        words = re.findall(r'\w+', query or '')
+        source, cursor = 'messages', 'messages.id'
+        conditions, parameters = [], []
+        if words and self.full_text:
+            # the index is read backwards from the newest match until the page is full; the sender is matched in the
+            # index too, so rare combinations don't scan all matches of the words
+            source, cursor = 'messages_fts JOIN messages ON messages.id = messages_fts.rowid', 'messages_fts.rowid'
+            # every word as a quoted string, so nothing in the query is taken as FTS5 syntax
+            match = 'content : (%s)' % ' '.join('"%s"' % word for word in words)
+            sender_words = re.findall(r'\w+', sender or '')
+            if sender_words:
+                match += ' AND sender : (%s)' % ' '.join('"%s"' % word for word in sender_words)
+            conditions.append('messages_fts MATCH ?')
+            parameters.append(match)
+        elif words:
+            for word in words:
+                conditions.append("messages.content LIKE ? ESCAPE '\\'")
+                parameters.append('%' + re.sub(r'([%_\\])', r'\\\1', word) + '%')
+        if sender is not None:
+            conditions.append('messages.sender = ?')
+            parameters.append(sender)
+        if from_timestamp is not None:
+            conditions.append('messages.ts >= ?')
+            parameters.append(from_timestamp)
+        if to_timestamp is not None:
+            conditions.append('messages.ts <= ?')
+            parameters.append(to_timestamp)
+        if before is not None:
+            conditions.append(cursor + ' < ?')
+            parameters.append(before)
+        where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+        rows = self._connections.get().execute('SELECT messages.* FROM %s %s ORDER BY %s DESC LIMIT ?'
+                                               % (source, where, cursor), parameters + [limit]).fetchall()
+        rows.reverse()
+        return [self._message(row) for row in rows]
+
+    def last_id(self) -> int:
+        return self._connections.get().execute('SELECT COALESCE(MAX(id), 0) FROM messages').fetchone()[0]
+
+    def revision(self) -> int:
+        return int(self._connections.get().execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()[0])
+
+    def history_revision(self) -> int:
+        return int(self._connections.get().execute("SELECT value FROM meta WHERE key = 'history'").fetchone()[0])
+
+    def identity(self) -> str:
+        if self._identity is None:
+            self._identity = self._connections.get().execute("SELECT value FROM meta WHERE key = 'store_id'") \
+                .fetchone()[0]
+        return self._identity
+
+    @STORE_SECONDS.timed(operation='get_message')
+    def get_message(self, message_id: int):
+        row = self._connections.get().execute('SELECT * FROM messages WHERE id = ?', (message_id,)).fetchone()
+        return self._message(row) if row else None
+
+    def streaming_messages(self, until: int = None) -> list:
+        rows = self._connections.get().execute('SELECT * FROM messages WHERE streaming = 1 AND id <= ? ORDER BY id',
+                                               (until if until is not None else self.last_id(),))
+        return [self._message(row) for row in rows]
+
+    @STORE_SECONDS.timed(operation='update_message')
+    def update_message(self, message_id: int, content: str, streaming: bool) -> None:
+        connection = self._connections.get()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT streaming FROM messages WHERE id = ?', (message_id,)).fetchone()
+            connection.execute('UPDATE messages SET content = ?, streaming = ?, '
+                               'size = size - length(CAST(content AS BLOB)) + length(CAST(? AS BLOB)) WHERE id = ?',
+                               (content, int(streaming), content, message_id))
+            # the text of an answer that is still being generated isn't part of the serialized messages, only the
+            # finished one is; a change of a finished message changes messages that were serialized already
+            finished_before = row is not None and not row['streaming']
+            self._bump_revision(connection, history=not streaming or finished_before, rewrite=finished_before)
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+    @STORE_SECONDS.timed(operation='compact')
+    def compact(self, before_timestamp: int = None, max_messages: int = None, max_bytes: int = None) -> tuple:
+        connection = self._connections.get()
+        # every limit cuts off a prefix (by timestamp or by id), so we only need the id/ts indexes to find it
+        cuts = []
+        if before_timestamp is not None:
+            cuts.append(('ts < ?', before_timestamp))
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            if max_messages is not None:
+                row = connection.execute('SELECT id FROM messages ORDER BY id DESC LIMIT 1 OFFSET ?',
+                                         (max_messages,)).fetchone()
+                if row:
+                    cuts.append(('id <= ?', row[0]))
+            if max_bytes is not None:
+                row = connection.execute('SELECT id FROM (SELECT id, SUM(size) OVER (ORDER BY id DESC) AS total '
+                                         'FROM messages) WHERE total > ? ORDER BY id DESC LIMIT 1',
+                                         (max_bytes,)).fetchone()
+                if row:
+                    cuts.append(('id <= ?', row[0]))
+            deleted_messages, deleted_bytes = 0, 0
+            for condition, value in cuts:
+                count, size = connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM messages WHERE '
+                                                 + condition, (value,)).fetchone()
+                if count:
+                    connection.execute('DELETE FROM messages WHERE ' + condition, (value,))
+                    deleted_messages += count
+                    deleted_bytes += size
+            if deleted_messages:
+                self._bump_revision(connection, rewrite=True)
+            # finished posts only have to be kept for a while so clients can look up their status
+            connection.execute("DELETE FROM pending WHERE state = 'done' AND updated < ?", (time.time() - 3600,))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return deleted_messages, deleted_bytes
+
+    def count(self) -> int:
+        return self._connections.get().execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+
+    @STORE_SECONDS.timed(operation='add_pending')
+    def add_pending(self, message: dict) -> int:
+        return self._connections.get().execute('INSERT INTO pending (message, updated) VALUES (?, ?)',
+                                               (json.dumps(message), time.time())).lastrowid
+
+    def add_pending_many(self, messages: list) -> list:
+        connection = self._connections.get()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            ids = [connection.execute('INSERT INTO pending (message, updated) VALUES (?, ?)',
+                                      (json.dumps(message), now)).lastrowid for message in messages]
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return ids
+
+    def claim_pending(self, pending_id: int, stale_after: float):
+        now = time.time()
+        connection = self._connections.get()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            claimed = connection.execute("UPDATE pending SET state = 'running', attempts = attempts + 1, updated = ? "
+                                         "WHERE id = ? AND (state = 'pending' OR (state = 'running' AND updated < ?))",
+                                         (now, pending_id, now - stale_after)).rowcount
+            row = connection.execute('SELECT message, attempts FROM pending WHERE id = ?', (pending_id,)).fetchone()
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        if not claimed:
+            return None
+        return json.loads(row['message']), row['attempts']
+
+    @STORE_SECONDS.timed(operation='finish_pending')
+    def finish_pending(self, pending_id: int, messages: list) -> list:
+        connection = self._connections.get()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            ids = self._insert(connection, messages)
+            connection.execute("UPDATE pending SET state = 'done', result = ?, error = NULL, updated = ? WHERE id = ?",
+                               (json.dumps(ids), time.time(), pending_id))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return ids
+
+    def fail_pending(self, pending_id: int, error: str, dead: bool) -> None:
+        self._connections.get().execute('UPDATE pending SET state = ?, error = ?, updated = ? WHERE id = ?',
+                                        ('dead' if dead else 'pending', error, time.time(), pending_id))
+
+    def get_pending(self, pending_id: int):
+        row = self._connections.get().execute('SELECT state, attempts, error, result FROM pending WHERE id = ?',
+                                              (pending_id,)).fetchone()
+        if not row:
+            return None
+        return {'id': pending_id,
+                'state': row['state'],
+                'attempts': row['attempts'],
+                'error': row['error'],
+                'ids': json.loads(row['result']) if row['result'] else [],
+                }
+
+    def list_pending(self, stale_after: float) -> list:
+        rows = self._connections.get().execute("SELECT id FROM pending WHERE state = 'pending' "
+                                               "OR (state = 'running' AND updated < ?) ORDER BY id",
+                                               (time.time() - stale_after,))
+        return [row['id'] for row in rows]
+
+    def import_legacy_file(self, path: str) -> int:
+        if not os.path.exists(path):
+            return 0
+        connection = self._connections.get()
+        # BEGIN IMMEDIATE locks the database, so only one worker can do the migration
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            if connection.execute("SELECT 1 FROM meta WHERE key = 'legacy_import'").fetchone():
+                connection.execute('COMMIT')
+                return 0
+            try:
+                with open(path, 'r') as f:
+                    messages = json.load(f)
+            except json.decoder.JSONDecodeError:
+                messages = []
+            self._insert(connection, messages)
+            connection.execute("INSERT INTO meta (key, value) VALUES ('legacy_import', ?)", (path,))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return len(messages)
+
+
+# maps the scheme of a store url to the backend class
+BACKENDS = {
+    'sqlite': SQLiteMessageStore,
+}
+
+
+def open_store(url: str, legacy_file: str = None) -> MessageStore:
+    """
+    Opens the message store described by url (e.g. 'sqlite:///messages.sqlite').
+    :param url: <backend>:///<path> of the store
+    :param legacy_file: optional messages.json file that is migrated into the store the first time it is opened
+    :return: the opened store
+    """
+    scheme, _, path = url.partition(':///')
+    if scheme not in BACKENDS or not path:
+        raise ValueError("Unknown message store: " + url)
+    store = BACKENDS[scheme](path)
+    if legacy_file:
+        store.import_legacy_file(legacy_file)
+    return store
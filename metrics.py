@@ -0,0 +1,271 @@
+## metrics.py - request and stage timings of the apps, served in the Prometheus text format on /metrics
+
+import bisect
+import collections
+import functools
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Flask, Response, g, request
+
+# upper bounds (seconds) of the histogram buckets, from a fast store read to a slow LLM answer
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+PROFILER_ENABLED = os.environ.get('profiler', '0') == '1'  # enables /metrics/profile (sampling profiler)
+PROFILER_MAX_SECONDS = 60
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _label_value(value)) for name, value in labels)
+
+
+def _label_value(value) -> str:
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram(object):
+    """
+    Distribution of durations, one series per combination of labels (e.g. route and status).
+    """
+
+    def __init__(self, name: str, help: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._series = {}  # sorted label items -> [count per bucket (last one is +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += seconds
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Measures the duration of a with block.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def timed(self, **labels):
+        """
+        Decorator measuring every call of a function.
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.time(**labels):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def render(self) -> list:
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            series = [(key, list(counts), total) for key, (counts, total) in self._series.items()]
+        for key, counts, total in sorted(series):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (self.name, _labels(key + (('le', bound),)), cumulative))
+            lines.append('%s_sum%s %f' % (self.name, _labels(key), total))
+            lines.append('%s_count%s %d' % (self.name, _labels(key), cumulative))
+        return lines
+
+
+class Counter(object):
+    """
+    Number of events, one series per combination of labels (e.g. cache hits and misses).
+    """
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._series = collections.Counter()
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        with self._lock:
+            self._series[tuple(sorted(labels.items()))] += amount
+
+    def render(self) -> list:
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+        with self._lock:
+            series = sorted(self._series.items())
+        lines += ['%s%s %s' % (self.name, _labels(key), value) for key, value in series]
+        return lines
+
+
+class StatsGauges(object):
+    """
+    Exports the numbers of an existing stats() dict (e.g. of the classification cache) as gauges <prefix>_<key>.
+    Nested dicts become <prefix>_<key>_<nested key>, values that are not numbers are skipped.
+    """
+
+    def __init__(self, prefix: str, help: str, stats):
+        self.name = prefix
+        self.help = help
+        self.stats = stats
+
+    def render(self) -> list:
+        lines = []
+        for name, value in self._flatten(self.name, self.stats()):
+            lines += ['# HELP %s %s' % (name, self.help), '# TYPE %s gauge' % name, '%s %s' % (name, value)]
+        return lines
+
+    def _flatten(self, prefix: str, stats: dict):
+        for key, value in stats.items():
+            name = prefix + '_' + str(key)
+            if isinstance(value, dict):
+                yield from self._flatten(name, value)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                yield name, value
+
+
+class Registry(object):
+    """
+    All metrics of a process. Metrics are created at import time of the modules that record them, asking for a
+    metric that exists already returns the existing one. With several worker processes every process has its own
+    numbers (Prometheus adds them up).
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name: str, *args):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, *args)
+            return self._metrics[name]
+
+    def histogram(self, name: str, help: str, buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, buckets)
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._get(Counter, name, help)
+
+    def stats(self, prefix: str, help: str, stats) -> None:
+        """
+        Exports the numbers returned by stats() (called on every scrape), replaces an older export with the same prefix.
+        """
+        with self._lock:
+            self._metrics[prefix] = StatsGauges(prefix, help, stats)
+
+    def render(self) -> str:
+        """
+        :return: all metrics in the Prometheus text format
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                lines += metric.render()
+            except Exception as e:
+                lines.append('# %s failed: %s' % (metric.name, e))
+        return '\n'.join(lines) + '\n'
+
+
+# the metrics of this process
+registry = Registry()
+
+REQUEST_SECONDS = registry.histogram('http_request_duration_seconds',
+                                     "Time until the response (or the first byte of a stream) was returned")
+
+
+def sample_stacks(seconds: float, interval: float = 0.01) -> collections.Counter:
+    """
+    Sampling profiler: looks at the stacks of all other threads every interval seconds.
+    :param seconds: how long to sample
+    :param interval: seconds between two samples
+    :return: number of samples per stack (collapsed format 'outer;...;inner', as used by flame graph tools)
+    """
+    own = threading.get_ident()
+    stacks = collections.Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s:%s:%d' % (os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+                frame = frame.f_back
+            stacks[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+_profiling = threading.Lock()
+
+
+def instrument_app(app: Flask, authorize=None) -> None:
+    """
+    Records the duration of every request per route and adds /metrics (and /metrics/profile if the profiler is
+    enabled with profiler=1) to the app.
+    :param app: the Flask app
+    :param authorize: optional function(request) -> bool guarding the endpoints (e.g. check_authorization)
+    """
+    @app.before_request
+    def start_request_timer() -> None:
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request_duration(response):
+        started = g.pop('request_started', None)
+        if started is not None:
+            REQUEST_SECONDS.observe(time.perf_counter() - started, method=request.method,
+                                    route=request.url_rule.rule if request.url_rule else 'unmatched',
+                                    status=response.status_code)
+        return response
+
+    def metrics_endpoint():
+        """
+        :return: error message or all metrics of this process in the Prometheus text format
+        """
+        if authorize is not None and not authorize(request):
+            return "Invalid authorization", 400
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+    def profile_endpoint():
+        """
+        Samples the stacks of all threads for ?seconds= (default 10) and returns the most frequent ones.
+        :return: error message or the stacks in collapsed format with their number of samples
+        """
+        if authorize is not None and not authorize(request):
+            return "Invalid authorization", 400
+        if not PROFILER_ENABLED:
+            return "Profiler is disabled (start with profiler=1)", 404
+        try:
+            seconds = min(float(request.args.get('seconds', 10)), PROFILER_MAX_SECONDS)
+            interval = max(float(request.args.get('interval', 0.01)), 0.001)
+        except ValueError:
+            return "Invalid seconds or interval", 400
+        if not _profiling.acquire(blocking=False):
+            return "A profile is being recorded already", 409
+        try:
+            stacks = sample_stacks(seconds, interval)
+        finally:
+            _profiling.release()
+        return Response(''.join('%s %d\n' % (stack, count) for stack, count in stacks.most_common()),
+                        mimetype='text/plain')
+
+    app.add_url_rule('/metrics', 'metrics', metrics_endpoint, methods=['GET'])
+    app.add_url_rule('/metrics/profile', 'metrics_profile', profile_endpoint, methods=['GET'])
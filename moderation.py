@@ -0,0 +1,180 @@
+## moderation.py - moderates accepted posts in a pool of worker threads
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from project_three.message_store import MessageStore
+from project_three.metrics import registry
+
+STAGE_SECONDS = registry.histogram('moderation_stage_seconds', "Duration of the moderation stages")
+
+
+class QueueFull(Exception):
+    """
+    Raised by ModerationPipeline.submit if too many posts are waiting for moderation.
+    """
+    pass
+
+
+class ModerationPipeline(object):
+    """
+    Posts are stored as pending and acknowledged right away. Worker threads then run them through the moderation stages
+    (e.g. topic check, profanity filter, assistant answer) and append the results to the store, which makes them
+    visible. Posts that fail max_attempts times end up as dead letters in the store.
+    """
+
+    def __init__(self, store: MessageStore, stages: list, workers: int = 4, max_queue: int = 100,
+                 max_attempts: int = 2, stale_after: float = 600, on_stored=None):
+        """
+        :param store: the message store
+        :param stages: list of (name, function, timeout in seconds); every function gets the list of messages to
+        store and returns the (changed) list
+        :param workers: number of worker threads
+        :param max_queue: maximum number of posts waiting for or in moderation (more are rejected with QueueFull)
+        :param max_attempts: attempts per post before it becomes a dead letter
+        :param stale_after: seconds after which a post claimed by a crashed worker is moderated again
+        :param on_stored: function called with the ids and the stored messages after every moderated post
+        """
+        self.store = store
+        self.stages = stages
+        self.max_attempts = max_attempts
+        self.stale_after = stale_after
+        self.on_stored = on_stored
+        self.metrics = {'accepted': 0, 'rejected': 0, 'stored': 0, 'retried': 0, 'dead': 0, 'timeouts': 0}
+        self._slots = threading.BoundedSemaphore(max_queue)
+        self._workers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='moderation')
+        # stages run in their own threads, so a worker can give up on a stage that takes too long
+        self._stage_runner = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='moderation-stage')
+        self._lock = threading.Lock()
+        self._recovered = False
+
+    def submit(self, message: dict) -> int:
+        """
+        Stores a post as pending and queues it for moderation.
+        :param message: the validated message
+        :return: id of the pending post (see status)
+        """
+        self.recover()
+        if not self._slots.acquire(blocking=False):
+            self._count('rejected')
+            raise QueueFull()
+        try:
+            pending_id = self.store.add_pending(message)
+        except Exception:
+            self._slots.release()
+            raise
+        self._count('accepted')
+        self._workers.submit(self._process, pending_id)
+        return pending_id
+
+    def submit_many(self, messages: list) -> list:
+        """
+        Stores many posts as pending in one write and queues them for moderation, as many as fit into the queue.
+        :param messages: the validated messages
+        :return: for every message the id of the pending post, or None if the queue was full
+        """
+        self.recover()
+        accepted = 0
+        while accepted < len(messages) and self._slots.acquire(blocking=False):
+            accepted += 1
+        self._count('rejected', len(messages) - accepted)
+        if not accepted:
+            return [None] * len(messages)
+        try:
+            pending_ids = self.store.add_pending_many(messages[:accepted])
+        except Exception:
+            for _ in range(accepted):
+                self._slots.release()
+            raise
+        self._count('accepted', accepted)
+        for pending_id in pending_ids:
+            self._workers.submit(self._process, pending_id)
+        return pending_ids + [None] * (len(messages) - accepted)
+
+    def status(self, pending_id: int):
+        """
+        :param pending_id: id returned by submit
+        :return: state of the post (pending, running, done or dead) and the ids of the stored messages, or None
+        """
+        return self.store.get_pending(pending_id)
+
+    def recover(self) -> None:
+        """
+        Queues posts that were accepted but never finished (e.g. because the worker process was restarted).
+        Only runs once per process.
+        """
+        if self._recovered:
+            return
+        with self._lock:
+            if self._recovered:
+                return
+            self._recovered = True
+        for pending_id in self.store.list_pending(self.stale_after):
+            if self._slots.acquire(blocking=False):
+                self._workers.submit(self._process, pending_id)
+
+    def _process(self, pending_id: int) -> None:
+        retry = False
+        try:
+            claimed = self.store.claim_pending(pending_id, self.stale_after)
+            if claimed is None:
+                return
+            message, attempts = claimed
+            try:
+                messages = self._moderate(message)
+                # storing is atomic: if it fails, nothing was stored and the post is retried like a failed stage
+                ids = self.store.finish_pending(pending_id, messages)
+            except Exception as e:
+                retry = attempts < self.max_attempts
+                self.store.fail_pending(pending_id, "%s: %s" % (type(e).__name__, e), dead=not retry)
+                self._count('retried' if retry else 'dead')
+                return
+            self._count('stored')
+            if self.on_stored:
+                try:
+                    self.on_stored(ids, messages)
+                except Exception as e:
+                    # the post is stored already, only the notification failed
+                    print(f"Notification about post {pending_id} failed: {e}")
+        except Exception as e:
+            print(f"Moderation of post {pending_id} failed: {e}")
+        finally:
+            # a retried post keeps its slot, otherwise the post is finished
+            if retry:
+                self._workers.submit(self._process, pending_id)
+            else:
+                self._slots.release()
+
+    def _moderate(self, message: dict) -> list:
+        messages = [message]
+        for name, function, timeout in self.stages:
+            started = []
+
+            def run(messages, function=function, name=name):
+                started.append(time.monotonic())
+                return STAGE_SECONDS.timed(stage=name)(function)(messages)
+
+            future = self._stage_runner.submit(run, messages)
+            # the timeout starts when the stage starts, not while it waits for a free stage thread
+            while True:
+                try:
+                    messages = future.result(timeout=max(started[0] + timeout - time.monotonic(), 0) if started
+                                             else 0.1)
+                    break
+                except TimeoutError:
+                    if started and time.monotonic() - started[0] >= timeout:
+                        self._count('timeouts')
+                        raise TimeoutError("stage %s took longer than %ss" % (name, timeout))
+        return messages
+
+    def _count(self, metric: str, count: int = 1) -> None:
+        with self._lock:
+            self.metrics[metric] += count
+
+    def stats(self) -> dict:
+        """
+        :return: counters of accepted, rejected, stored, retried and dead posts
+        """
+        with self._lock:
+            return dict(self.metrics)
@@ -1,48 +1,247 @@
-import requests
-from openai import OpenAI
+import os
+import re
+import threading
+import time
+from typing import TYPE_CHECKING
 
-PROFANITY_URL = "https://raw.githubusercontent.com/censor-text/profanity-list/refs/heads/main/list/en.txt"
+from project_three.metrics import registry
+
+if TYPE_CHECKING:
+    from openai import OpenAI
+
+PROFANITY_URL = os.environ.get('profanity_url',
+                               "https://raw.githubusercontent.com/censor-text/profanity-list/refs/heads/main/list/en.txt")
+PROFANITY_CACHE_FILE = 'profanity_list.txt'  # local copy of the list, so it only has to be downloaded once
+PROFANITY_TTL = 24 * 60 * 60  # seconds after which the list is refreshed in the background
+PROFANITY_RETRY = 60  # seconds after which a failed download is retried while there is no list at all
+PROFANITY_TIMEOUT = 10  # seconds to wait for the download of the list
+
+FILTER_SECONDS = registry.histogram('profanity_filter_seconds', "Duration of masking swear words")
 
 PROFANITY_PROMPT = "Is this message somehow (even in the broadest sense) related to conspiracy theories? Please only answer with one word: either 'Yes' or 'No'. If the message is smalltalk between users return 'Yes' as well."
 
 
+def compile_word_list(words) -> re.Pattern:
+    """
+    Compiles a list of bad words into a single regular expression. The words are merged into a trie first
+    (e.g. ass|asshole -> ass(?:hole)?), so matching a sentence only takes one pass no matter how long the list is.
+    :param words: the bad words
+    :return: the compiled expression matching any of the words as a whole word (case-insensitive)
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = True
+
+    def pattern(node) -> str:
+        alternatives, chars = [], []
+        for char in sorted(key for key in node if key):
+            rest = pattern(node[char])
+            if rest:
+                alternatives.append(re.escape(char) + rest)
+            else:
+                chars.append(re.escape(char))
+        if chars:
+            alternatives.append(chars[0] if len(chars) == 1 else '[' + ''.join(chars) + ']')
+        if not alternatives:
+            return ''
+        result = alternatives[0] if len(alternatives) == 1 else '(?:' + '|'.join(alternatives) + ')'
+        # a word ends here, so the rest is optional
+        if '' in node:
+            result = '(?:' + result + ')?'
+        return result
+
+    if not trie:
+        # matches nothing
+        return re.compile(r'(?!x)x')
+    return re.compile(r'(?<!\w)' + pattern(trie) + r'(?!\w)', re.IGNORECASE)
+
+
+class ProfanityFilter(object):
+    """
+    Masks swear words. The word list is downloaded once, cached on disk and refreshed in the background (using the
+    ETag of the last download), so filtering a message does not need any network request.
+    """
+
+    def __init__(self, url: str = PROFANITY_URL, cache_file: str = PROFANITY_CACHE_FILE, ttl: float = PROFANITY_TTL,
+                 retry: float = PROFANITY_RETRY):
+        """
+        :param url: where to download the word list from (one word per line)
+        :param cache_file: local copy of the word list
+        :param ttl: seconds after which the word list is refreshed
+        :param retry: seconds after which a failed download is retried if no word list could be loaded yet
+        """
+        self.url = url
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.retry = retry
+        self._matcher = None
+        self._has_list = False
+        self._next_refresh = 0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    @FILTER_SECONDS.timed(batch='false')
+    def filter(self, sentence: str) -> str:
+        """
+        Function to check whether a given user message contains swear words and  replace those by ***.
+        :param sentence: the content of the user message we want to check on swear words as string
+        :return: the filtered message
+        """
+        return self.matcher().sub(lambda match: '*' * len(match.group()), sentence)
+
+    @FILTER_SECONDS.timed(batch='true')
+    def filter_many(self, sentences: list) -> list:
+        """
+        Filters many messages at once (the matcher is only looked up once).
+        :param sentences: the contents of the user messages
+        :return: the filtered messages in the same order
+        """
+        matcher = self.matcher()
+        return [matcher.sub(lambda match: '*' * len(match.group()), sentence) for sentence in sentences]
+
+    def matcher(self) -> re.Pattern:
+        """
+        :return: the compiled matcher, loaded from the cache file (or downloaded) the first time it is needed
+        """
+        if self._matcher is None:
+            with self._lock:
+                if self._matcher is None:
+                    self._load()
+        if time.time() >= self._next_refresh:
+            self._refresh_in_background()
+        return self._matcher
+
+    def _load(self) -> None:
+        words = self._read_cache()
+        if words is None:
+            # nothing cached yet: we have to wait for the download once
+            self.refresh()
+            return
+        self._matcher = compile_word_list(words)
+        self._has_list = True
+        self._next_refresh = os.path.getmtime(self.cache_file) + self.ttl
+
+    def _read_cache(self):
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                return [line.strip() for line in f if line.strip()]
+        except OSError:
+            return None
+
+    def refresh(self) -> None:
+        """
+        Downloads the word list if it changed since the last download and swaps in the new matcher.
+        If the download fails, the old list (if any) is kept and the download is retried after the ttl; without any
+        list it is retried after a short delay, so a network problem at startup doesn't leave messages unfiltered for
+        a whole ttl.
+        """
+        # only needed once the list has to be downloaded (usually in the background)
+        import requests
+        headers = {}
+        try:
+            with open(self.cache_file + '.etag', 'r') as f:
+                headers['If-None-Match'] = f.read().strip()
+        except OSError:
+            pass
+        try:
+            response = requests.get(self.url, headers=headers, timeout=PROFANITY_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            print(f"Error downloading profanity list: {e}")
+            response = None
+        if response is not None and response.status_code == 304 and os.path.exists(self.cache_file):
+            # list did not change, just remember that it is fresh again
+            os.utime(self.cache_file)
+            if not self._has_list:
+                words = self._read_cache()
+                self._matcher = compile_word_list(words or [])
+                self._has_list = words is not None
+        elif response is not None and 200 <= response.status_code < 300:
+            words = [line.strip() for line in response.text.split('\n') if line.strip()]
+            # write to a temporary file first, so other workers never read a half-written list
+            temp_file = self.cache_file + '.%d.tmp' % os.getpid()
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(words))
+            os.replace(temp_file, self.cache_file)
+            if 'ETag' in response.headers:
+                with open(self.cache_file + '.etag', 'w') as f:
+                    f.write(response.headers['ETag'])
+            self._matcher = compile_word_list(words)
+            self._has_list = True
+        elif not self._has_list:
+            # if the status_code does not equal 2XX, an error occurred. Messages are not filtered until the
+            # list can be downloaded
+            words = self._read_cache()
+            self._matcher = compile_word_list(words or [])
+            self._has_list = words is not None
+        self._next_refresh = time.time() + (self.ttl if self._has_list else self.retry)
+
+    def _refresh_in_background(self) -> None:
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        # avoid starting another refresh while this one is running
+        self._next_refresh = time.time() + self.ttl
+
+        def run():
+            try:
+                self.refresh()
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, name='profanity-refresh', daemon=True).start()
+
+
+# the word list is shared by all messages (and all channels of this process)
+profanity_filter = ProfanityFilter()
+
+
 def filter_profanity(sentence: str) -> str:
     """
     Function to check whether a given user message contains swear words and  replace those by ***.
     :param sentence: the content of the user message we want to check on swear words as string
     :return: the filtered message
     """
-    url = PROFANITY_URL
-    response = requests.get(url)
-    prof = response.text
-    # if the status_code does not equal 2XX, an error occurred. The function just returns the original sentence without
-    # any filtering
-    if response.status_code < 200 and 300 < response.status_code:
-        return sentence
+    return profanity_filter.filter(sentence)
 
-    # we need a list of bad words instead of just all of them in a long string.
-    bad_words = set(prof.split('\n'))
-    for word in sentence.split():
-        if word in bad_words:
-            # for all words in the bad_words list, check if they occur in the word and if yes, replace them
-            sentence = sentence.replace(word, '*' * len(word))
-    return sentence
+
+def filter_profanity_many(sentences: list) -> list:
+    """
+    Batch version of filter_profanity.
+    :param sentences: the user messages we want to check on swear words
+    :return: the filtered messages in the same order
+    """
+    return profanity_filter.filter_many(sentences)
 
 
-def conspiracy_related(message: str, client: OpenAI, gpt_version: str) -> bool:
+def conspiracy_related(message: str, client: 'OpenAI', gpt_version: str, timeout: float = None) -> bool:
     """
     Function to filter both unrelated messages and messages containing swear words (by calling filter_profanity)
     :param message: the message we want to run the filter on as string
     :param client: the OpenAI client needed to generate the LLM response
     :param gpt_version: The version of ChatGPT we use to generate the response
+    :param timeout: optional seconds for all questions to ChatGPT together, every request only gets the time that is left
     :return: the completely filtered message (i.e. completely filtering unrelated messages and masking swear words using filter_profanity
     """
+    deadline = time.monotonic() + timeout if timeout is not None else None
     topic_related = ""
     # as long as ChatGPT did not come to a clear result (i.e. yes or no), ask it again
     counter = 0
     while not topic_related.lower().startswith("yes") and (not topic_related.lower().startswith("no")) and counter < 5:
+        llm = client
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                # no time left for another question, the message is treated like one ChatGPT is unsure about
+                counter = 5
+                break
+            # the retries of the client would start the timeout again, the loop is the retry
+            llm = client.with_options(timeout=remaining, max_retries=0)
         # ChatGPT is used to evaluate whether or not the message is related to the topic
-        topic_related = client.chat.completions.create(
+        topic_related = llm.chat.completions.create(
             model=gpt_version,
             messages=[{"role": "user",
                        "content": message + PROFANITY_PROMPT}]).choices[0].message.content
@@ -0,0 +1,183 @@
+## rate_limit.py - per-sender token buckets that keep single senders from flooding a channel
+
+import math
+import sqlite3
+import threading
+import time
+
+from project_three.metrics import registry
+from project_three.sqlite_connections import ThreadConnections
+
+RATE_LIMITED = registry.counter('rate_limit_rejections_total', "Posts rejected by the rate limiter, by bucket")
+
+
+def parse_limit(spec: str):
+    """
+    :param spec: '<posts>/<seconds>', e.g. '20/60' for 20 posts per minute (a burst of up to 20 posts is allowed,
+    after that the bucket fills up with 20 tokens per 60 seconds); '' or '0' for no limit
+    :return: (capacity, tokens per second) or None if there is no limit
+    """
+    if not spec or spec.strip() == '0':
+        return None
+    posts, _, seconds = spec.partition('/')
+    capacity, seconds = float(posts), float(seconds or 60)
+    if capacity <= 0 or seconds <= 0:
+        raise ValueError("Invalid rate limit: " + spec)
+    return capacity, capacity / seconds
+
+
+class RateLimiter(object):
+    """
+    Token buckets per (sender, bucket), e.g. 'post' for every post and a stricter 'assistant' bucket for questions to
+    the assistant. Every post takes one token from its buckets; tokens come back at a fixed rate up to the capacity.
+    The buckets are kept in a SQLite file (so all workers share them) or in memory. Every check reads and writes only
+    the rows of one sender, and a bucket that would be full again is the same as no row, so old rows are deleted
+    from time to time.
+    """
+
+    def __init__(self, limits: dict, path: str = None, cleanup_every: int = 1000):
+        """
+        :param limits: bucket name -> (capacity, tokens per second) or None for no limit, see parse_limit
+        :param path: optional SQLite file shared by the workers (None keeps the buckets in this process)
+        :param cleanup_every: number of checks between two deletions of buckets that are full again
+        """
+        self.limits = {name: limit for name, limit in limits.items() if limit is not None}
+        self.path = path
+        self.cleanup_every = cleanup_every
+        self._buckets = {}  # (key, bucket) -> (tokens, time of the last update), if there is no file
+        self._checks = 0
+        self._lock = threading.Lock()
+        self._connections = ThreadConnections(path) if path else None
+        if path:
+            self._connections.get().execute('CREATE TABLE IF NOT EXISTS buckets (key TEXT NOT NULL, '
+                                            'bucket TEXT NOT NULL, tokens REAL NOT NULL, updated REAL NOT NULL, '
+                                            'PRIMARY KEY (key, bucket))')
+
+    def _refill(self, name: str, tokens: float, updated: float, now: float) -> float:
+        capacity, rate = self.limits[name]
+        return min(capacity, tokens + max(now - updated, 0) * rate)
+
+    def _wait(self, name: str, tokens: float, needed: float) -> float:
+        # seconds until the bucket has the needed tokens again
+        return max(needed - tokens, 0) / self.limits[name][1]
+
+    def acquire(self, key: str, buckets: list, cost: float = 1) -> tuple:
+        """
+        Takes cost tokens from every given bucket of key, either from all of them or (if one of them doesn't have
+        enough tokens) from none.
+        :param key: the sender (and channel) the buckets belong to
+        :param buckets: names of the buckets, buckets without limit are ignored
+        :param cost: number of tokens
+        :return: (True if the post is allowed, seconds until it would be allowed, remaining tokens per bucket)
+        """
+        buckets = [name for name in buckets if name in self.limits]
+        if not buckets:
+            return True, 0, {}
+        now = time.time()
+        if self.path:
+            connection = self._connections.get()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                stored = self._read(connection, key, buckets)
+                tokens = {name: self._refill(name, *stored[name], now) if name in stored else self.limits[name][0]
+                          for name in buckets}
+                allowed = all(tokens[name] >= cost for name in buckets)
+                if allowed:
+                    connection.executemany('INSERT OR REPLACE INTO buckets (key, bucket, tokens, updated) '
+                                           'VALUES (?, ?, ?, ?)',
+                                           [(key, name, tokens[name] - cost, now) for name in buckets])
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+        else:
+            with self._lock:
+                tokens = {name: self._refill(name, *self._buckets[key, name], now) if (key, name) in self._buckets
+                          else self.limits[name][0] for name in buckets}
+                allowed = all(tokens[name] >= cost for name in buckets)
+                if allowed:
+                    for name in buckets:
+                        self._buckets[key, name] = (tokens[name] - cost, now)
+        if allowed:
+            self._cleanup(now)
+            return True, 0, {name: tokens[name] - cost for name in buckets}
+        for name in buckets:
+            if tokens[name] < cost:
+                RATE_LIMITED.inc(bucket=name)
+        return False, max(self._wait(name, tokens[name], cost) for name in buckets), tokens
+
+    def refund(self, key: str, buckets: list, cost: float = 1) -> None:
+        """
+        Gives back tokens taken by acquire, e.g. for a post that could not be accepted after all (never more than the
+        capacity of a bucket).
+        :param key: the sender (and channel) the buckets belong to
+        :param buckets: names of the buckets, buckets without limit are ignored
+        :param cost: number of tokens
+        """
+        buckets = [name for name in buckets if name in self.limits]
+        if not buckets:
+            return
+        now = time.time()
+        if self.path:
+            connection = self._connections.get()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                stored = self._read(connection, key, buckets)
+                # a bucket without row is full, there is nothing to give back
+                connection.executemany('UPDATE buckets SET tokens = ?, updated = ? WHERE key = ? AND bucket = ?',
+                                       [(min(self.limits[name][0], self._refill(name, *stored[name], now) + cost),
+                                         now, key, name) for name in buckets if name in stored])
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+        else:
+            with self._lock:
+                for name in buckets:
+                    if (key, name) in self._buckets:
+                        tokens = self._refill(name, *self._buckets[key, name], now)
+                        self._buckets[key, name] = (min(self.limits[name][0], tokens + cost), now)
+
+    @staticmethod
+    def _read(connection: sqlite3.Connection, key: str, buckets: list) -> dict:
+        rows = connection.execute('SELECT bucket, tokens, updated FROM buckets WHERE key = ? AND bucket IN (%s)'
+                                  % ','.join('?' * len(buckets)), [key] + buckets)
+        return {bucket: (tokens, updated) for bucket, tokens, updated in rows}
+
+    def quota(self, key: str) -> dict:
+        """
+        :param key: the sender (and channel) the buckets belong to
+        :return: bucket name -> {remaining, capacity, per_second, retry_after} for every limited bucket, without taking
+        tokens
+        """
+        now = time.time()
+        buckets = list(self.limits)
+        if self.path:
+            stored = self._read(self._connections.get(), key, buckets)
+        else:
+            with self._lock:
+                stored = {name: self._buckets[key, name] for name in buckets if (key, name) in self._buckets}
+        quota = {}
+        for name in buckets:
+            capacity, rate = self.limits[name]
+            tokens = self._refill(name, *stored[name], now) if name in stored else capacity
+            quota[name] = {'remaining': math.floor(tokens),
+                           'capacity': capacity,
+                           'per_second': rate,
+                           'retry_after': math.ceil(self._wait(name, tokens, 1)),
+                           }
+        return quota
+
+    def _cleanup(self, now: float) -> None:
+        with self._lock:
+            self._checks += 1
+            if self._checks % self.cleanup_every:
+                return
+        # a bucket that wasn't used for capacity / rate seconds is full again
+        refill = max(capacity / rate for capacity, rate in self.limits.values())
+        if self.path:
+            self._connections.get().execute('DELETE FROM buckets WHERE updated < ?', (now - refill,))
+        else:
+            with self._lock:
+                for bucket in [bucket for bucket, (_, updated) in self._buckets.items() if updated < now - refill]:
+                    del self._buckets[bucket]
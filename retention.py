@@ -0,0 +1,87 @@
+## retention.py - background compaction of old channel messages
+
+import threading
+import time
+from datetime import datetime, timedelta
+
+from project_three.message_store import MessageStore
+from project_three.timestamps import now_timestamp
+
+
+class Compactor(object):
+    """
+    Removes expired messages from a message store in a background thread, so reading messages never has to write.
+    Messages are dropped if they are older than ttl or if the store holds more than max_messages/max_bytes.
+    """
+
+    def __init__(self, store: MessageStore, ttl: timedelta = None, max_messages: int = None, max_bytes: int = None,
+                 interval: float = 60):
+        """
+        :param store: the message store to compact
+        :param ttl: maximum age of a message (None: no limit)
+        :param max_messages: maximum number of stored messages (None: no limit)
+        :param max_bytes: maximum size of all stored messages in bytes (None: no limit)
+        :param interval: seconds between two compactions
+        """
+        self.store = store
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.metrics = {'runs': 0,
+                        'messages_reclaimed': 0,
+                        'bytes_reclaimed': 0,
+                        'last_run': None,
+                        'last_duration': None,
+                        'errors': 0,
+                        }
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def compact(self) -> tuple:
+        """
+        Runs one compaction and updates the metrics.
+        :return: (number of deleted messages, number of deleted bytes)
+        """
+        start = time.perf_counter()
+        before = None
+        if self.ttl is not None:
+            before = now_timestamp() - self.ttl // timedelta(microseconds=1)
+        messages, size = self.store.compact(before_timestamp=before, max_messages=self.max_messages,
+                                            max_bytes=self.max_bytes)
+        with self._lock:
+            self.metrics['runs'] += 1
+            self.metrics['messages_reclaimed'] += messages
+            self.metrics['bytes_reclaimed'] += size
+            self.metrics['last_run'] = datetime.now().isoformat()
+            self.metrics['last_duration'] = time.perf_counter() - start
+        return messages, size
+
+    def ensure_started(self) -> None:
+        """
+        Starts the background thread unless it is already running. Safe to call on every request.
+        """
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='compactor', daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.compact()
+            except Exception as e:
+                # a failed run (e.g. database locked for too long) is simply retried next time
+                print(f"Compaction failed: {e}")
+                with self._lock:
+                    self.metrics['errors'] += 1
+            time.sleep(self.interval)
+
+    def stats(self) -> dict:
+        """
+        :return: a copy of the metrics (runs, reclaimed messages and bytes, ...)
+        """
+        with self._lock:
+            return dict(self.metrics)
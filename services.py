@@ -0,0 +1,83 @@
+## services.py - expensive dependencies of the channel (LLM client, secrets), created on first use
+
+import threading
+import time
+
+
+class Services(object):
+    """
+    Container for the dependencies that are expensive to create or import. Importing the app only registers how to
+    create them; every service is created the first time it is needed (once per process, even if several threads ask
+    at the same time), or by warm_up before a worker takes traffic.
+    """
+
+    def __init__(self):
+        self._factories = {}
+        self._instances = {}
+        # factories may ask for other services (e.g. the LLM client needs the secrets)
+        self._lock = threading.RLock()
+
+    def register(self, name: str, factory) -> None:
+        """
+        :param name: name of the service
+        :param factory: function without parameters that creates the service
+        """
+        with self._lock:
+            self._factories[name] = factory
+            self._instances.pop(name, None)
+
+    def get(self, name: str):
+        """
+        :param name: name of a registered service
+        :return: the service (created now if this is the first time it is needed)
+        """
+        try:
+            return self._instances[name]
+        except KeyError:
+            pass
+        with self._lock:
+            if name not in self._instances:
+                self._instances[name] = self._factories[name]()
+            return self._instances[name]
+
+    def lazy(self, name: str):
+        """
+        :param name: name of a registered service
+        :return: stand-in for the service that creates it on first attribute access (for code that expects the object
+        itself, e.g. the LLM client of the assistant)
+        """
+        return LazyService(self, name)
+
+    def created(self, name: str) -> bool:
+        return name in self._instances
+
+    def warm_up(self, names: list = None) -> dict:
+        """
+        Creates services before they are needed.
+        :param names: the services to create (default: all registered ones)
+        :return: seconds it took to create every service that did not exist yet
+        """
+        durations = {}
+        for name in names if names is not None else list(self._factories):
+            if not self.created(name):
+                start = time.perf_counter()
+                self.get(name)
+                durations[name] = round(time.perf_counter() - start, 3)
+        return durations
+
+
+class LazyService(object):
+    """
+    Stands in for a service of a container until it is used.
+    """
+
+    def __init__(self, services: Services, name: str):
+        self._services = services
+        self._name = name
+
+    def __getattr__(self, attribute: str):
+        return getattr(self._services.get(self._name), attribute)
+
+
+# the services of this process
+services = Services()
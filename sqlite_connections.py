@@ -0,0 +1,36 @@
+## sqlite_connections.py - per-thread SQLite connections for the stores that keep their data in SQLite files
+
+import sqlite3
+import threading
+
+
+class ThreadConnections(object):
+    """
+    SQLite connections can't be shared between threads, so every thread gets its own connection to the file. All of
+    them use WAL (readers don't block the writer, so all workers can share the file) and leave transactions to the
+    caller (BEGIN/COMMIT).
+    """
+
+    def __init__(self, path: str, row_factory=None):
+        """
+        :param path: the SQLite file
+        :param row_factory: optional row factory of the connections (e.g. sqlite3.Row)
+        """
+        self.path = path
+        self.row_factory = row_factory
+        self._local = threading.local()
+
+    def get(self) -> sqlite3.Connection:
+        """
+        :return: the connection of the current thread (opened the first time the thread needs it)
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # isolation_level=None: the callers handle transactions themselves with BEGIN/COMMIT
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            if self.row_factory is not None:
+                connection.row_factory = self.row_factory
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
@@ -0,0 +1,87 @@
+## stub_server.py - local stand-in for the OpenAI API (for testing without an API key or costs)
+# run: python stub_server.py
+# then start the channel with OPENAI_BASE_URL=http://localhost:5009/v1 (the OpenAI client picks it up by itself)
+# and profanity_url=http://localhost:5009/profanity.txt; it also fakes healthy channels for the hub (see benchmark.py)
+
+import json
+import os
+import time
+
+from flask import Flask, request, jsonify, Response
+
+# seconds before the first token and between two tokens of an answer
+STUB_LATENCY = float(os.environ.get('stub_latency', 0.5))
+STUB_TOKEN_DELAY = float(os.environ.get('stub_token_delay', 0.05))
+STUB_HEALTH_LATENCY = float(os.environ.get('stub_health_latency', 0.05))  # seconds a fake channel needs for /health
+STUB_PROFANITY_WORDS = ['damn', 'hell', 'crap', 'bastard', 'idiot', 'moron', 'stupid', 'sucker']
+
+STUB_ANSWER = "Wake up! The earth is flat and the birds are drones, everybody who says otherwise is paid by the lizards."
+
+app = Flask(__name__)
+
+
+def stub_answer(prompt: str) -> str:
+    """
+    :param prompt: the content of the user message sent to the model
+    :return: 'Yes'/'No' for topic checks (messages containing 'unrelated' are unrelated), else a fixed answer
+    """
+    if "Please only answer with one word" in prompt:
+        return "No" if "unrelated" in prompt.lower() else "Yes"
+    return STUB_ANSWER
+
+
+def completion(content: str, model: str, chunk: bool = False) -> dict:
+    choice = {'index': 0, 'finish_reason': None if chunk else 'stop'}
+    if chunk:
+        choice['delta'] = {'role': 'assistant', 'content': content}
+    else:
+        choice['message'] = {'role': 'assistant', 'content': content}
+    return {'id': 'chatcmpl-stub',
+            'object': 'chat.completion.chunk' if chunk else 'chat.completion',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [choice],
+            }
+
+
+@app.route('/v1/chat/completions', methods=['POST'])
+def chat_completions():
+    """
+    Minimal version of the OpenAI chat completions endpoint (with and without stream=true).
+    :return: the completion as json or as event stream
+    """
+    model = request.json.get('model', 'stub')
+    answer = stub_answer(request.json['messages'][-1]['content'])
+    time.sleep(STUB_LATENCY)
+    if not request.json.get('stream'):
+        return jsonify(completion(answer, model))
+
+    def chunks():
+        for word in answer.split(' '):
+            time.sleep(STUB_TOKEN_DELAY)
+            yield "data: %s\n\n" % json.dumps(completion(word + ' ', model, chunk=True))
+        yield "data: [DONE]\n\n"
+
+    return Response(chunks(), mimetype='text/event-stream')
+
+
+@app.route('/profanity.txt', methods=['GET'])
+def profanity_list():
+    """
+    :return: a short bad word list in the format of the real one (one word per line)
+    """
+    return Response("\n".join(STUB_PROFANITY_WORDS) + "\n", mimetype='text/plain', headers={'ETag': '"stub"'})
+
+
+@app.route('/channels/<name>/health', methods=['GET'])
+def channel_health(name):
+    """
+    Health endpoint of a fake channel, register http://localhost:5009/channels/<name> at the hub to use it.
+    :return: the name of the channel
+    """
+    time.sleep(STUB_HEALTH_LATENCY)
+    return jsonify({'name': name})
+
+
+if __name__ == '__main__':
+    app.run(port=5009, threaded=True)
@@ -0,0 +1,68 @@
+## timestamps.py - timestamps of messages as integer microseconds since the epoch (UTC)
+
+import time
+from datetime import datetime, timezone, timedelta
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+# timestamps have to stay within the years 1 to 9999 in UTC (datetime can't represent the others)
+MIN_TIMESTAMP = (datetime.min.replace(tzinfo=timezone.utc) - EPOCH) // MICROSECOND
+MAX_TIMESTAMP = (datetime.max.replace(tzinfo=timezone.utc) - EPOCH) // MICROSECOND
+
+# the date and time of the last formatted second, consecutive messages mostly share it
+_last_formatted = (None, '')
+
+
+def parse_timestamp(timestamp):
+    """
+    Converts an ISO 8601 timestamp into microseconds since the epoch (UTC). The string is parsed once by the C parser of
+    datetime and turned into an integer, nothing else of the message ever parses it again.
+    Timestamps without a timezone are interpreted as local time.
+    :param timestamp: the timestamp as string, e.g. 2024-12-01T10:00:00Z or 2024-12-01T12:00:00.123456+02:00
+    :return: the timestamp as microseconds since the epoch, None if it can't be parsed or is not within the years 1 to
+    9999 (UTC)
+    """
+    try:
+        dt = datetime.fromisoformat(timestamp)
+    except ValueError:
+        # python < 3.11 doesn't know the Z suffix
+        if not timestamp.endswith(('Z', 'z')):
+            return None
+        try:
+            dt = datetime.fromisoformat(timestamp[:-1] + '+00:00')
+        except ValueError:
+            return None
+    except TypeError:
+        return None
+    try:
+        if dt.tzinfo is not None:
+            result = (dt - EPOCH) // MICROSECOND
+        else:
+            # local time: whole seconds are exact as float, the microseconds are added as they are
+            result = int(dt.replace(microsecond=0).timestamp()) * 1000000 + dt.microsecond
+    except (OverflowError, OSError, ValueError):
+        return None
+    if not MIN_TIMESTAMP <= result <= MAX_TIMESTAMP:
+        return None
+    return result
+
+
+def format_timestamp(timestamp: int) -> str:
+    """
+    :param timestamp: microseconds since the epoch (as returned by parse_timestamp)
+    :return: the timestamp in the format of the api, e.g. 2024-12-01T10:00:00Z or 2024-12-01T10:00:00.123456Z
+    """
+    global _last_formatted
+    seconds, micro = divmod(timestamp, 1000000)
+    last_seconds, text = _last_formatted
+    if seconds != last_seconds:
+        text = '%04d-%02d-%02dT%02d:%02d:%02d' % time.gmtime(seconds)[:6]
+        _last_formatted = (seconds, text)
+    return text + '.%06dZ' % micro if micro else text + 'Z'
+
+
+def now_timestamp() -> int:
+    """
+    :return: the current time as microseconds since the epoch
+    """
+    return time.time_ns() // 1000